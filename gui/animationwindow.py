@@ -17,6 +17,17 @@ import anidialogs
 from layerswindow import stock_button
 
 from lib.framelist import DEFAULT_ACTIVE_CELS
+from lib.playbackclock import PlaybackClock
+from playbackwindow import PlaybackWindow
+
+# Choices for where and at which mipmap level the animation plays
+PLAYBACK_RESOLUTIONS = [
+    (None, _("On canvas")),
+    (0, _("Full size")),
+    (1, _("Half size")),
+    (2, _("Quarter size")),
+    (3, _("Eighth size")),
+    ]
 
 COLUMNS_NAME = ('frame_index', 'frame_data')
 COLUMNS_ID = dict((name, i) for i, name in enumerate(COLUMNS_NAME))
@@ -40,6 +51,8 @@ class AnimationTool (gtk.VBox):
         self.app = app
         self.ani = app.doc.ani.model
         self.is_playing = False
+        self.clock = None
+        self.playback_window = None
 
         self.set_size_request(200, 150)
         self.app.doc.model.doc_observers.append(self.doc_structure_modified_cb)
@@ -133,6 +146,9 @@ class AnimationTool (gtk.VBox):
         anibuttons_hbox.pack_start(self.pause_button)
         anibuttons_hbox.pack_start(self.stop_button)
 
+        self.playback_stats_label = gtk.Label()
+        self.playback_stats_label.set_alignment(0.0, 0.5)
+
         # frames edit controls:
         cut_button = stock_button(gtk.STOCK_CUT)
         cut_button.connect('clicked', self.on_cut)
@@ -188,6 +204,12 @@ class AnimationTool (gtk.VBox):
         opacity_checkbox('other keys', _('Other keys'), _("Show the other keys cels."))
         opacity_checkbox('other', _('Other'), _("Show the rest of the cels."))
 
+        tint_cb = gtk.CheckButton(_("Tint previous and next"))
+        tint_cb.set_active(self.app.preferences.get("lightbox.tint", False))
+        tint_cb.connect('toggled', self.on_tint_toggled)
+        tint_cb.set_tooltip_text(_("Tint the previous cels red and the next cels green."))
+        opacityopts_vbox.pack_start(tint_cb, expand=False)
+
         self.framerate_adjustment = gtk.Adjustment(value=self.ani.framerate, lower=1, upper=120, step_incr=1)
         self.framerate_adjustment.connect("value-changed", self.on_framerate_changed)
         self.framerate_entry = gtk.SpinButton(adjustment=self.framerate_adjustment, digits=0, climb_rate=1.5)
@@ -196,6 +218,20 @@ class AnimationTool (gtk.VBox):
         framerate_hbox.pack_start(framerate_lbl, False, False)
         framerate_hbox.pack_start(self.framerate_entry, False, False)
 
+        resolution_combo = gtk.ComboBoxText()
+        proxy_level = self.app.preferences.get("xsheet.playback_proxy_level",
+                                               None)
+        for i, (level, label) in enumerate(PLAYBACK_RESOLUTIONS):
+            resolution_combo.append_text(label)
+            if level == proxy_level:
+                resolution_combo.set_active(i)
+        resolution_combo.connect('changed', self.on_playback_resolution_changed)
+        resolution_combo.set_tooltip_text(_("Play on the canvas, or in a separate window at a reduced resolution, which is faster for big drawings."))
+        resolution_lbl = gtk.Label(_('Play:'))
+        resolution_hbox = gtk.HBox()
+        resolution_hbox.pack_start(resolution_lbl, False, False)
+        resolution_hbox.pack_start(resolution_combo, False, False)
+
         icons_cb = gtk.CheckButton(_("Small icons"))
         icons_cb.set_active(self.app.preferences.get("xsheet.small_icons", False))
         icons_cb.connect('toggled', self.on_smallicons_toggled)
@@ -219,10 +255,12 @@ class AnimationTool (gtk.VBox):
         controls_vbox = gtk.VBox()
         controls_vbox.pack_start(buttons_hbox, expand=False)
         controls_vbox.pack_start(anibuttons_hbox, expand=False)
+        controls_vbox.pack_start(self.playback_stats_label, expand=False)
         controls_vbox.pack_start(editbuttons_hbox, expand=False)
 
         preferences_vbox = gtk.VBox()
         preferences_vbox.pack_start(framerate_hbox, expand=False)
+        preferences_vbox.pack_start(resolution_hbox, expand=False)
         preferences_vbox.pack_start(icons_cb, expand=False)
         preferences_vbox.pack_start(play_lightbox_cb, expand=False)
         preferences_vbox.pack_start(showprev_cb, expand=False)
@@ -258,6 +296,8 @@ class AnimationTool (gtk.VBox):
             default = DEFAULT_ACTIVE_CELS[attr]
             active_cels[attr] = self.app.preferences.get(pref, default)
         self.ani.frames.setup_active_cels(active_cels)
+        self.ani.tint_onion_skin = self.app.preferences.get("lightbox.tint",
+                                                            False)
 
     def setup(self):
         treesel = self.treeview.get_selection()
@@ -436,23 +476,33 @@ class AnimationTool (gtk.VBox):
         pixbuf = getattr(self.app.pixmaps, pixname)
         cell.set_property('pixbuf', pixbuf)
 
-    def _call_player(self, use_lightbox=False):
-        self.ani.player_next(use_lightbox)
-        keep_playing = True
+    def _update_playback_stats(self):
+        clock = self.clock
+        self.playback_stats_label.set_text(
+            _("%.1f fps, %d dropped") % (clock.achieved_fps, clock.dropped))
+
+    def _end_playback(self, idx):
+        self.ani.end_playback(idx)
+        self.is_playing = False
+        self._change_player_buttons()
+        self.ani.player_state = None
+        self._update_playback_stats()
+        self._update()
+
+    def _call_player(self):
         if self.ani.player_state == "stop":
-            self.ani.select_without_undo(self.beforeplay_frame)
-            keep_playing = False
-            self.is_playing = False
-            self._change_player_buttons()
-            self.ani.player_state = None
-            self._update()
+            self._end_playback(self.beforeplay_frame)
+            return False
         elif self.ani.player_state == "pause":
-            keep_playing = False
-            self.is_playing = False
-            self._change_player_buttons()
-            self.ani.player_state = None
-            self._update()
-        return keep_playing
+            self._end_playback(self.ani.frames.idx)
+            return False
+        steps = self.clock.tick()
+        self.ani.player_next(steps)
+        if self.clock.presented % max(1, int(self.clock.framerate)) == 0:
+            self._update_playback_stats()
+        # One-shot timeouts, each one aimed at the next frame's deadline
+        gobject.timeout_add(self.clock.next_delay(), self._call_player)
+        return False
 
     def _play_animation(self, from_first_frame=True, use_lightbox=False):
         self.is_playing = True
@@ -460,15 +510,17 @@ class AnimationTool (gtk.VBox):
         if from_first_frame:
             self.ani.frames.select(0)
         self._change_player_buttons()
-        self.ani.hide_all_frames()
-        # animation timer
-        ms_per_frame = int(round(1000.0/self.framerate_entry.get_value()))
-
-        # show first frame immediately, otherwise there's a single frame delay
-        # @TODO: it seems to wait one frame before stopping too
-        self._call_player(use_lightbox)
-
-        gobject.timeout_add(ms_per_frame, self._call_player, use_lightbox)
+        # the first frame is shown right away, and is due now
+        proxy_level = self.app.preferences.get("xsheet.playback_proxy_level",
+                                               None)
+        if proxy_level is not None:
+            if self.playback_window is None:
+                self.playback_window = PlaybackWindow(self.app, self.ani)
+            self.playback_window.present_for_level(proxy_level)
+        self.ani.start_playback(use_lightbox, proxy_level)
+        self.clock = PlaybackClock(self.ani.framerate)
+        self.clock.start()
+        gobject.timeout_add(self.clock.next_delay(), self._call_player)
 
     def on_animation_play(self, button):
         self.ani.play_animation()
@@ -491,8 +543,18 @@ class AnimationTool (gtk.VBox):
         self.ani.toggle_opacity(attr, checkbox.get_active())
         self.queue_draw()
 
+    def on_tint_toggled(self, checkbox):
+        self.app.preferences["lightbox.tint"] = checkbox.get_active()
+        self.ani.set_onion_tint(checkbox.get_active())
+
     def on_framerate_changed(self, adj):
         self.ani.framerate = adj.get_value()
+        if self.is_playing:
+            self.clock.set_framerate(self.ani.framerate)
+
+    def on_playback_resolution_changed(self, combo):
+        level, label = PLAYBACK_RESOLUTIONS[combo.get_active()]
+        self.app.preferences["xsheet.playback_proxy_level"] = level
 
     def on_smallicons_toggled(self, checkbox):
         self.app.preferences["xsheet.small_icons"] = checkbox.get_active()
@@ -22,6 +22,7 @@ import lib.document
 from lib import brush
 from lib import helpers
 from lib import mypaintlib
+from lib import tiledsurface
 from brushlib import brushsettings
 
 
@@ -332,7 +333,8 @@ class Application (object):
         """Saves the current settings to persistent storage."""
         self.brushmanager.save_brushes_for_devices()
         self.brushmanager.save_brush_history()
-        self.filehandler.save_scratchpad(self.scratchpad_filename)
+        self.filehandler.save_scratchpad(self.scratchpad_filename,
+                save_profile=self.preferences['saving.scrap_profile'])
         settingspath = join(self.user_confpath, 'settings.json')
         jsonstr = helpers.json_dumps(self.preferences)
         f = open(settingspath, 'w')
@@ -346,6 +348,9 @@ class Application (object):
         self.update_input_mapping()
         self.update_input_devices()
         self.update_button_mapping()
+        budget = self.preferences['memory.tile_budget_mb'] * 1024 * 1024
+        tiledsurface.tile_store.set_budget(budget)
+        self.doc.model.eager_mipmaps = self.preferences['view.eager_mipmaps']
         self.preferences_window.update_ui()
 
 
@@ -375,6 +380,7 @@ class Application (object):
             'input.global_pressure_mapping': [(0.0, 1.0), (1.0, 0.0)],
             'view.default_zoom': 1.0,
             'view.high_quality_zoom': True,
+            'view.eager_mipmaps': False,
             'ui.hide_menubar_in_fullscreen': True,
             'ui.hide_toolbar_in_fullscreen': True,
             'ui.hide_subwindows_in_fullscreen': True,
@@ -394,6 +400,11 @@ class Application (object):
                 toolbar1_subwindows=True,
             ),
             'saving.default_format': 'openraster',
+            'saving.profile': 'default',
+            'saving.scrap_profile': 'fast',
+            'saving.scraps_in_background': True,
+            'document.lazy_cel_loading': False,
+            'memory.tile_budget_mb': 1024,
             'brushmanager.selected_brush' : None,
             'brushmanager.selected_groups' : [],
             'frame.color_rgba': (0.12, 0.12, 0.12, 0.92),
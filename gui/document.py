@@ -411,12 +411,14 @@ class Document (CanvasController):
                     return
             return
         x, y = self.tdw.get_cursor_in_model_coordinates()
+        shown = dict((l, opacity) for l, opacity, tint
+                     in self.model.get_shown_layers())
         for idx, layer in reversed(list(enumerate(self.model.layers))):
             if layer.locked:
                 continue
-            if not layer.visible:
+            if layer not in shown:
                 continue
-            alpha = layer.get_alpha (x, y, 5) * layer.effective_opacity
+            alpha = layer.get_alpha (x, y, 5) * shown[layer]
             if alpha > 0.1:
                 old_layer = self.model.layer
                 self.model.select_layer(idx)
@@ -499,12 +501,14 @@ class Document (CanvasController):
 
     def pick_layer_cb(self, action):
         x, y = self.tdw.get_cursor_in_model_coordinates()
+        shown = dict((l, opacity) for l, opacity, tint
+                     in self.model.get_shown_layers())
         for idx, layer in reversed(list(enumerate(self.model.layers))):
             if layer.locked:
                 continue
-            if not layer.visible:
+            if layer not in shown:
                 continue
-            alpha = layer.get_alpha (x, y, 5) * layer.effective_opacity
+            alpha = layer.get_alpha (x, y, 5) * shown[layer]
             if alpha > 0.1:
                 self.model.select_layer(idx)
                 self.layerblink_state.activate(action)
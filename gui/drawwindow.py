@@ -38,6 +38,7 @@ import toolbar
 import animation
 import dialogs
 from lib import helpers
+from lib import tiledsurface
 import canvasevent
 from colors import RGBColor, HSVColor
 
@@ -309,6 +310,18 @@ class DrawWindow (gtk.Window):
     def print_memory_leak_cb(self, action):
         helpers.record_memory_leak_status(print_diff = True)
 
+    def print_tile_memory_cb(self, action):
+        r = tiledsurface.tile_store.get_report()
+        tiles = r['unpacked'] + r['uniform'] + r['packed']
+        logger.info('MEM: %d tiles: %d as pixels, %d of a single colour, '
+                    '%d compressed', tiles, r['unpacked'], r['uniform'],
+                    r['packed'])
+        logger.info('MEM: %.1f MiB used, %.1f MiB saved by packing',
+                    r['nbytes'] / 1048576.0,
+                    (r['full_nbytes'] - r['nbytes']) / 1048576.0)
+        logger.info('MEM: tile buffer pool: %r',
+                    tiledsurface.tile_pool.get_stats())
+
     def run_garbage_collector_cb(self, action):
         helpers.run_garbage_collector()
 
@@ -13,6 +13,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 import glib
+import gobject
 import gtk
 from gettext import gettext as _
 from gettext import ngettext
@@ -28,6 +29,9 @@ SAVE_FORMAT_PNGTRANS = 3
 SAVE_FORMAT_PNGMULTI = 4
 SAVE_FORMAT_JPEG = 5
 
+# How often to check whether a background save is done, in milliseconds
+BACKGROUND_SAVE_POLL_INTERVAL = 100
+
 # Utility function to work around the fact that gtk FileChooser/FileFilter
 # does not have an easy way to use case insensitive filters
 def get_case_insensitive_glob(string):
@@ -73,6 +77,8 @@ class FileHandler(object):
             self.app.kbm.takeover_action(action)
 
         self._filename = None
+        # counts changes of the filename, even to the same one
+        self._filename_changes = 0
         self.current_file_observers = []
         self.file_opened_observers = []
         self.active_scrap_filename = None
@@ -124,6 +130,7 @@ class FileHandler(object):
 
     def set_filename(self, value):
         self._filename = value
+        self._filename_changes += 1
         for f in self.current_file_observers:
             f(self.filename)
 
@@ -232,8 +239,12 @@ class FileHandler(object):
 
     @drawwindow.with_wait_cursor
     def open_file(self, filename):
+        kwargs = {}
+        if os.path.splitext(filename)[1].lower() == '.ora':
+            kwargs['lazy'] = self.app.preferences['document.lazy_cel_loading']
         try:
-            self.doc.model.load(filename, feedback_cb=self.gtk_main_tick)
+            self.doc.model.load(filename, feedback_cb=self.gtk_main_tick,
+                                **kwargs)
         except document.SaveLoadError, e:
             self.app.message_dialog(str(e),type=gtk.MESSAGE_ERROR)
         else:
@@ -268,6 +279,50 @@ class FileHandler(object):
             # Multifile save, or failed save (error dialog was already shown).
             # Skip thumbnail generation attempt and recentmanager stuff.
             return
+        self._file_saved(filename, thumbnail_pixbuf, export)
+
+    def save_file_in_background(self, filename, **options):
+        """Like save_file(), but writes the file on another thread
+
+        Painting can go on while an OpenRaster file is written. Errors
+        are reported, and the filename, recent files and thumbnail are
+        updated, once it is done.
+        """
+        options.setdefault('save_profile',
+                           self.app.preferences['saving.profile'])
+        try:
+            job = self.doc.model.save_in_background(filename, **options)
+        except document.SaveLoadError, e:
+            self.lastsavefailed = True
+            self.app.message_dialog(str(e),type=gtk.MESSAGE_ERROR)
+            return
+        if job is None:
+            # saved right away
+            self.lastsavefailed = False
+            self._file_saved(filename, None)
+            return
+        gobject.timeout_add(BACKGROUND_SAVE_POLL_INTERVAL,
+                            self._background_save_poll_cb, job,
+                            self._filename_changes)
+
+    def _background_save_poll_cb(self, job, filename_changes):
+        if not job.done:
+            return True
+        try:
+            job.finish()
+        except document.SaveLoadError, e:
+            self.lastsavefailed = True
+            self.app.message_dialog(str(e),type=gtk.MESSAGE_ERROR)
+            return False
+        self.lastsavefailed = False
+        logger.info('Saved to %r in the background',
+                    os.path.abspath(job.filename))
+        # another file may have been opened or saved meanwhile
+        export = (self._filename_changes != filename_changes)
+        self._file_saved(job.filename, job.thumbnail, export)
+        return False
+
+    def _file_saved(self, filename, thumbnail_pixbuf, export=False):
         if not export:
             self.filename = os.path.abspath(filename)
             recent_mgr = gtk2compat.gtk.recent_manager_get_default()
@@ -296,6 +351,9 @@ class FileHandler(object):
 
     def save_doc_to_file(self, filename, doc, export=False, **options):
         thumbnail_pixbuf = None
+        # scraps and autosaves ask for a faster profile
+        options.setdefault('save_profile',
+                           self.app.preferences['saving.profile'])
         try:
             x, y, w, h =  doc.model.get_bbox()
             if w == 0 and h == 0:
@@ -533,15 +591,22 @@ class FileHandler(object):
         if not os.path.exists(prefix_dir): 
             os.makedirs(prefix_dir)
 
+        # scraps are saved often, so favour speed over size
+        save_profile = self.app.preferences['saving.scrap_profile']
+        if self.app.preferences['saving.scraps_in_background']:
+            save_file = self.save_file_in_background
+        else:
+            save_file = self.save_file
+
         number = None
         if filename:
             junk, file_fragment = os.path.split(filename)
             if file_fragment.startswith("_md5"):
                 #store direct, don't attempt to increment
                 if main_doc:
-                    self.save_file(filename)
+                    save_file(filename, save_profile=save_profile)
                 else:
-                    self.save_scratchpad(filename)
+                    self.save_scratchpad(filename, save_profile=save_profile)
                 return filename
 
             l = re.findall(re.escape(prefix) + '([0-9]+)', filename)
@@ -579,9 +644,9 @@ class FileHandler(object):
 
         assert not os.path.exists(filename)
         if main_doc:
-            self.save_file(filename)
+            save_file(filename, save_profile=save_profile)
         else:
-            self.save_scratchpad(filename)
+            self.save_scratchpad(filename, save_profile=save_profile)
         return filename
 
     def get_scrap_prefix(self):
@@ -0,0 +1,87 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Subwindow for playing the animation at a reduced resolution"""
+
+## Imports
+
+import cairo
+import gtk
+from gtk import gdk
+from gettext import gettext as _
+
+import windowing
+
+
+## Class defs
+
+
+class PlaybackWindow (windowing.SubWindow):
+    """Subwindow showing the animation while it plays from proxy frames
+
+    Frames are flattened from a mipmap level of the layers (see
+    `lib.animation.Animation.render_frame()`), and scaled up to fit the
+    window, so playback does not depend on the size of the drawing nor
+    on the zoom of the main canvas, which is left untouched.
+    """
+
+    # Largest initial size of the window, in pixels
+    MAX_INITIAL_SIZE = 640
+
+    def __init__(self, app, ani):
+        windowing.SubWindow.__init__(self, app)
+        self.set_title(_("Animation Playback"))
+        self.ani = ani
+        self._view = PlaybackView(ani)
+        self.add(self._view)
+        ani.playback_observers.append(self._playback_frame_cb)
+
+    def present_for_level(self, mipmap_level):
+        """Shows the window, sized after the frames at a mipmap level"""
+        x, y, w, h = self.ani.doc.get_effective_bbox()
+        fac = 2**mipmap_level
+        w, h = max(1, w // fac), max(1, h // fac)
+        if not self.get_visible():
+            scale = min(1.0, float(self.MAX_INITIAL_SIZE) / max(w, h))
+            self.set_default_size(int(w*scale), int(h*scale))
+            self.show_all()
+        self.present()
+
+    def _playback_frame_cb(self, ani):
+        if self.get_visible():
+            self._view.queue_draw()
+
+
+class PlaybackView (gtk.DrawingArea):
+    """Draws the current proxy frame, scaled to fit"""
+
+    def __init__(self, ani):
+        gtk.DrawingArea.__init__(self)
+        self.ani = ani
+        self.connect("draw", self.draw_cb)
+
+    def draw_cb(self, widget, cr):
+        alloc = self.get_allocation()
+        cr.set_source_rgb(0, 0, 0)
+        cr.paint()
+        level = self.ani.proxy_level
+        if level is None:
+            level = self.ani.playback_mipmap_level
+        frame = self.ani.render_frame(self.ani.frames.idx, level)
+        if frame is None:
+            return True
+        scale = min(float(alloc.width) / frame.w,
+                    float(alloc.height) / frame.h)
+        cr.translate((alloc.width - frame.w*scale) / 2.0,
+                     (alloc.height - frame.h*scale) / 2.0)
+        cr.scale(scale, scale)
+        gdk.cairo_set_source_pixbuf(cr, frame.pixbuf, 0, 0)
+        cr.get_source().set_filter(cairo.FILTER_BILINEAR)
+        cr.rectangle(0, 0, frame.w, frame.h)
+        cr.fill()
+        return True
@@ -122,11 +122,23 @@ class PreferencesWindow (windowing.Dialog):
         hq_zoom_checkbutton = self._builder.get_object("hq_zoom_checkbutton")
         hq_zoom_checkbutton.set_active(p['view.high_quality_zoom'])
 
+        # Mipmaps regenerated while idle
+        eager_checkbutton = self._builder.get_object("eager_mipmaps_checkbutton")
+        eager_checkbutton.set_active(p['view.eager_mipmaps'])
+
         # Default save format
         fmt_config = p['saving.default_format']
         fmt_combo = self._builder.get_object("default_save_format_combobox")
         fmt_combo.set_active_id(fmt_config)
 
+        # PNG compression
+        profile_combo = self._builder.get_object("save_profile_combobox")
+        profile_combo.set_active_id(p['saving.profile'])
+
+        # Lazy loading
+        lazy_checkbutton = self._builder.get_object("lazy_loading_checkbutton")
+        lazy_checkbutton.set_active(p['document.lazy_cel_loading'])
+
         # Button mapping
         bm_ed = self._builder.get_object("button_mapping_editor")
         bm_ed.set_bindings(p.get("input.button_mapping", {}))
@@ -197,11 +209,27 @@ class PreferencesWindow (windowing.Dialog):
         self.app.preferences['view.high_quality_zoom'] = hq_zoom
 
 
+    def eager_mipmaps_checkbutton_toggled_cb(self, button):
+        eager = bool(button.get_active())
+        self.app.preferences['view.eager_mipmaps'] = eager
+        self.app.doc.model.eager_mipmaps = eager
+
+
+    def lazy_loading_checkbutton_toggled_cb(self, button):
+        lazy = bool(button.get_active())
+        self.app.preferences['document.lazy_cel_loading'] = lazy
+
+
     def default_save_format_combobox_changed_cb(self, combobox):
         formatstr = combobox.get_active_id()
         self.app.preferences['saving.default_format'] = formatstr
 
 
+    def save_profile_combobox_changed_cb(self, combobox):
+        profile = combobox.get_active_id()
+        self.app.preferences['saving.profile'] = profile
+
+
     def color_wheel_rgb_radiobutton_toggled_cb(self, radiobtn):
         if self.in_update_ui or not radiobtn.get_active():
             return
@@ -693,7 +693,9 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         layers = self.doc.layers
         if not self.show_layers_above:
             layers = self.doc.layers[0:self.doc.layer_idx+1]
-        layers = [l for l in layers if l.visible]
+        # cels in the onion skin are shown according to it
+        onion = self.doc.ani.onion_skin
+        layers = [l for l in layers if l.visible or l in onion]
         return layers
 
 
@@ -855,21 +857,38 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
             surface.pixbuf.fill((int(random.random()*0xff)<<16)+0x00000000)
 
         background = None
+        onion = None
         if self.current_layer_solo:
             background = self.neutral_background_pixbuf
             layers = [self.doc.layer]
+            onion = {}
             # this is for hiding instead
             #layers.pop(self.doc.layer_idx)
         if self.overlay_layer:
             idx = layers.index(self.doc.layer)
             layers.insert(idx+1, self.overlay_layer)
 
+        # Animation playback presents pre-rendered frames
+        frame = None
+        if not self.current_layer_solo:
+            frame = self.doc.ani.get_playback_frame(mipmap_level)
+
         # Composite
         tiles = []
         for tx, ty in surface.get_tiles():
             if self.tile_is_visible(tx, ty, transformation, clip_region, sparse, translation_only):
                 tiles.append((tx, ty))
-        self.doc.render_into(surface, tiles, mipmap_level, layers, background)
+        if frame is not None:
+            # Only the background around the frame needs compositing
+            N = tiledsurface.N
+            def covered(t):
+                tx, ty = t
+                return (tx*N >= frame.x and (tx+1)*N <= frame.x+frame.w and
+                        ty*N >= frame.y and (ty+1)*N <= frame.y+frame.h)
+            tiles = [t for t in tiles if not covered(t)]
+            layers = []
+        self.doc.render_into(surface, tiles, mipmap_level, layers, background,
+                             onion)
 
         # The speedup below worked for GTK2, is there is an equivalent for GTK3?
         #if translation_only:
@@ -896,6 +915,12 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
 
         cr.paint()
 
+        if frame is not None:
+            gdk.cairo_set_source_pixbuf(cr, frame.pixbuf, frame.x, frame.y)
+            if self.scale > self.pixelize_threshold:
+                cr.get_source().set_filter(cairo.FILTER_NEAREST)
+            cr.paint()
+
         if self.visualize_rendering:
             # visualize painted bboxes (blue)
             cr.set_source_rgba(0, 0, random.random(), 0.4)
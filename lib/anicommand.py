@@ -36,6 +36,7 @@ class SelectFrame(Action):
         self.prev_frame_idx = self.frames.idx
         self.frames.select(self.idx)
         self.doc.ani.update_opacities()
+        self.doc.ani.prefetch_frames()
         self._notify_document_observers()
     
     def undo(self):
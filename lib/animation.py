@@ -7,18 +7,39 @@
 # (at your option) any later version.
 
 import os
-import glob
+import errno
 from gettext import gettext as _
 import json
-import tempfile
-from subprocess import call
-
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from distutils.spawn import find_executable
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy
+from gi.repository import GdkPixbuf
+from gi.repository import GObject
+
+import mypaintlib
+import helpers
 import pixbufsurface
+import tiledsurface
 
 import anicommand
 from framelist import FrameList
+from framecache import FrameCache, FramePrefetcher, frame_rect
+from avi import AviWriter
 from xdna import XDNA
 
+# Memory for frames already encoded during video export, in bytes
+VIDEO_CACHE_BUDGET = 128 * 1024 * 1024
+
+# Frames after and before the current one whose cels get loaded in the
+# background, for documents loaded lazily (see Document.load_ora())
+LAZY_LOAD_AHEAD = 24
+LAZY_LOAD_BEHIND = 6
+
 
 class Animation(object):
     
@@ -30,6 +51,12 @@ class Animation(object):
     'other':      0,
     }
     
+    # Colors the previous and next cels are tinted with in the lightbox
+    tints = {
+    'previous': (0.9, 0.1, 0.1),
+    'next':     (0.1, 0.6, 0.1),
+    }
+
     def __init__(self, doc):
         self.doc = doc
         self.frames = None
@@ -41,12 +68,44 @@ class Animation(object):
         # For reproduction, "play", "pause", "stop":
         self.player_state = None
 
+        # Flattened frames for playback, see render_frame():
+        self.frame_cache = FrameCache()
+        # True while playing from the frame cache instead of toggling
+        # the visibility of the cels:
+        self.cached_playback = False
+        # Renders upcoming frames into the cache while playing or
+        # scrubbing, at the mipmap level the canvas last asked for:
+        self.prefetcher = FramePrefetcher(self)
+        self.playback_mipmap_level = 0
+        # False to never start it, e.g. for headless rendering with
+        # forked workers (see mypaint-render.py), which must not inherit
+        # locks held by other threads:
+        self.prefetch_enabled = True
+        # Mipmap level frames are played at in a separate playback view,
+        # or None while not playing in proxy resolution:
+        self.proxy_level = None
+        # Called with this object whenever the playback view has to show
+        # a new frame:
+        self.playback_observers = []
+        # Idle handler loading the cels near the current frame:
+        self._cel_loader_id = None
+        # Idle handler compressing the tiles of cels not used lately:
+        self._tile_budget_id = None
+
+        # How the cels are shown in the lightbox, as a map of cels to
+        # (opacity, tint) pairs for Document.blit_tile_into():
+        self.onion_skin = {}
+        self.tint_onion_skin = False
+
         # For cut/copy/paste operations:
         self.edit_operation = None
         self.edit_frame = None
 
     def clear_xsheet(self, init=False):
         self.frames = FrameList(24, self.opacities)
+        self.onion_skin = {}
+        self.prefetcher.cancel()
+        self.frame_cache.clear()
         self.cleared = True
     
     def legacy_xsheet_as_str(self):
@@ -54,16 +113,20 @@ class Animation(object):
         Return animation X-Sheet as data in json format.
 
         """
+        layer_indices = self._layer_indices()
         data = []
         for f in self.frames:
-            if f.cel is not None:
-                layer_idx = self.doc.layers.index(f.cel)
-            else:
-                layer_idx = None
+            layer_idx = layer_indices[f.cel]
             data.append((f.is_key, f.description, layer_idx))
         str_data = json.dumps(data, sort_keys=True, indent=4)
         return str_data
 
+    def _layer_indices(self):
+        """Return a map of layers to their index, and of None to None."""
+        indices = dict((l, i) for i, l in enumerate(self.doc.layers))
+        indices[None] = None
+        return indices
+
     def xsheet_as_str(self):
         """
         Return animation X-Sheet as data in XDNA format.
@@ -80,18 +143,17 @@ class Animation(object):
             }
         }
 
+        layer_indices = self._layer_indices()
+        raster_frames = data['xsheet']['raster_frame_lists'][0]
         for f in self.frames:
-            if f.cel is not None:
-                layer_idx = self.doc.layers.index(f.cel)
-            else:
-                layer_idx = None
-            data['xsheet']['raster_frame_lists'][0].append({
-                'idx': layer_idx,
+            raster_frames.append({
+                'idx': layer_indices[f.cel],
                 'is_key': f.is_key,
                 'description': f.description
             })
 
-        str_data = json.dumps(data, sort_keys=True, indent=4)
+        # Without indentation and key sorting, json can use its C encoder
+        str_data = json.dumps(data, separators=(',', ':'))
         return str_data
 
     def _write_xsheet(self, xsheetfile):
@@ -109,6 +171,9 @@ class Animation(object):
         """
 
         data = json.loads(ani_data)
+        self.onion_skin = {}
+        self.prefetcher.cancel()
+        self.frame_cache.clear()
 
         # first check if it's in the legacy non-descriptive JSON or new XDNA format
         if type(data) is dict and data['XDNA']:
@@ -122,14 +187,17 @@ class Animation(object):
             self.framerate = data['xsheet']['framerate']
             self.cleared = True
 
-            for i, d in enumerate(raster_frames):
+            # Frames share equal description strings
+            descriptions = {}
+            for f, d in zip(self.frames, raster_frames):
                 if d['idx'] is not None:
                     cel = self.doc.layers[d['idx']]
                 else:
                     cel = None
-                self.frames[i].is_key = d['is_key']
-                self.frames[i].description = d['description']
-                self.frames[i].cel = cel
+                f.is_key = d['is_key']
+                f.description = descriptions.setdefault(d['description'],
+                                                        d['description'])
+                f.cel = cel
 
         else:
             # load in legacy style
@@ -171,97 +239,372 @@ class Animation(object):
         else:
             self._read_xsheet(xsheetfile)
     
-    def save_png(self, filename, **kwargs):
+    def save_png(self, filename, feedback_cb=None, **kwargs):
+        """
+        Save the animation as a numbered sequence of PNG files.
+
+        Each frame gets the cel it shows.  Every different cel is only
+        encoded once, from a snapshot, by a pool of threads, and the
+        frames holding a cel again get a hard link to its file, or a
+        copy where links can't be made.
+
+        """
         prefix, ext = os.path.splitext(filename)
         # if we have a number already, strip it
         l = prefix.rsplit('-', 1)
         if l[-1].isdigit():
             prefix = l[0]
-        doc_bbox = self.doc.get_effective_bbox()
-        for i in range(len(self.frames)):
+        doc_bbox = tuple(self.doc.get_effective_bbox())
+
+        jobs = []
+        links = []
+        first_filename = {}
+        for i in xrange(len(self.frames)):
             filename = '%s-%03d%s' % (prefix, i+1, ext)
             cel = self.frames.cel_at(i)
-            cel._surface.save(filename, *doc_bbox, **kwargs)
-
-    def save_avi(self, filename, vid_width=800, vid_fps=24, **kwargs):
-        """
-        Save video file with codec mpeg4.
-
-        Requires command tools imagemagick and ffmpeg .
-
-        """
-        tempdir = tempfile.mkdtemp()
-        jpgs_tempdir = os.path.join(tempdir, 'jpgs')
-        os.mkdir(jpgs_tempdir)
-        base_filename = os.path.basename(filename)
-        prefix, ext = os.path.splitext(base_filename)
-        out_filename = os.path.join(os.path.dirname(filename), prefix + '.avi')
-
-        pngs_filename = os.path.join(tempdir, 'tempani.png')
-        self.save_png(pngs_filename)
-
-        # convert pngs to jpegs with imagemagick command:
-        pngs_list = glob.glob(tempdir + os.path.sep + '*png')
-        pngs_list.sort()
-        for png_file in pngs_list:
-            f_basename = os.path.basename(png_file)
-            name, ext = os.path.splitext(f_basename)
-            jpg_file = os.path.join(jpgs_tempdir, name + '.jpg')
-            print "converting %s to %s..." % (png_file, jpg_file)
-            call(["convert",
-                  "-resize", str(vid_width),
-                  "-quality", "100",
-                  "-background", "white",
-                  "-flatten",
-                  png_file, jpg_file])
-
-        # convert the previous jpgs to video with ffmpeg command:
-        jpgs = jpgs_tempdir + os.path.sep + 'tempani-%03d.jpg'
-        call(["ffmpeg",
-              "-r", str(vid_fps),
-              "-b", "1800",
-              "-y", "-i",
-              jpgs, out_filename])
-
-    def _notify_canvas_observers(self, affected_layer):
-        bbox = affected_layer._surface.get_bbox()
-        for f in self.doc.canvas_observers:
-            f(*bbox)
+            if cel in first_filename:
+                links.append((first_filename[cel], filename))
+            else:
+                first_filename[cel] = filename
+                if cel is None:
+                    # frames before the first cel
+                    sshot = tiledsurface.Surface().save_snapshot()
+                else:
+                    sshot = cel._surface.save_snapshot()
+                jobs.append((sshot, filename, doc_bbox, kwargs))
+
+        _save_cels_png(jobs, feedback_cb)
+        for src, dst in links:
+            helpers.link_or_copy(src, dst)
+            if feedback_cb is not None:
+                feedback_cb()
+
+    def save_avi(self, filename, vid_width=800, vid_fps=None,
+                 feedback_cb=None, **kwargs):
+        """
+        Save the animation as a video file.
+
+        Frames are flattened as they are played, scaled to vid_width and
+        streamed to ffmpeg as raw RGB, to be encoded with mpeg4.  If
+        ffmpeg can't be found, a Motion-JPEG AVI is written directly,
+        or an uncompressed one if JPEG encoding is not available.
+        Frames showing the same cel are rendered and encoded once.
+
+        """
+        if vid_fps is None:
+            vid_fps = self.framerate
+        prefix, ext = os.path.splitext(filename)
+        out_filename = prefix + '.avi'
+
+        x, y, w, h = self.doc.get_effective_bbox()
+        if w == 0 or h == 0:
+            raise IOError(errno.EINVAL, _('There is nothing to export'))
+        # even sizes, for the chroma subsampling of most codecs
+        vid_w = max(2, int(vid_width) & ~1)
+        vid_h = max(2, int(round(h * float(vid_w) / w)) & ~1)
+
+        ffmpeg = find_executable('ffmpeg')
+        if ffmpeg is not None:
+            self._save_avi_ffmpeg(ffmpeg, out_filename, vid_w, vid_h,
+                                  vid_fps, feedback_cb)
+        else:
+            logger.info('ffmpeg not found, writing Motion-JPEG AVI')
+            self._save_avi_builtin(out_filename, vid_w, vid_h, vid_fps,
+                                   feedback_cb)
+
+    def _video_frames(self, vid_w, vid_h, encode, feedback_cb=None):
+        """
+        Yield each frame of the animation scaled and encoded.
+
+        Encoded frames are remembered by cel, so frames holding the
+        same cel are only rendered and encoded once.
+
+        """
+        encoded = FrameCache(budget=VIDEO_CACHE_BUDGET)
+        for i in xrange(len(self.frames)):
+            key, token, layers = self.get_frame_key(i)
+            data = encoded.get(key, token)
+            if data is None:
+                frame = self.render_frame(i)
+                pixbuf = frame.pixbuf.scale_simple(
+                    vid_w, vid_h, GdkPixbuf.InterpType.BILINEAR)
+                data = encode(pixbuf)
+                encoded.put(key, token, data, len(data))
+            if feedback_cb is not None:
+                feedback_cb()
+            yield data
+
+    def _save_avi_ffmpeg(self, ffmpeg, out_filename, vid_w, vid_h,
+                         vid_fps, feedback_cb=None):
+        def encode(pixbuf):
+            arr = helpers.gdkpixbuf2numpy(pixbuf)
+            return arr[:,:,:3].tostring()
+
+        cmd = [ffmpeg, "-y",
+               "-f", "rawvideo", "-pix_fmt", "rgb24",
+               "-s", "%dx%d" % (vid_w, vid_h),
+               "-r", str(vid_fps),
+               "-i", "-",
+               "-c:v", "mpeg4", "-q:v", "3",
+               out_filename]
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        try:
+            for data in self._video_frames(vid_w, vid_h, encode, feedback_cb):
+                proc.stdin.write(data)
+        except IOError, e:
+            # ffmpeg quit early, its exit status tells why
+            logger.error('Writing to ffmpeg failed: %s', e)
+        finally:
+            proc.stdin.close()
+            status = proc.wait()
+        if status != 0:
+            raise IOError(errno.EIO,
+                          _('ffmpeg failed with exit status %d') % status)
+
+    def _save_avi_builtin(self, out_filename, vid_w, vid_h, vid_fps,
+                          feedback_cb=None):
+        def encode_jpeg(pixbuf):
+            ok, data = pixbuf.save_to_bufferv('jpeg', ['quality'], ['90'])
+            return data
+
+        def encode_dib(pixbuf):
+            # bottom-up BGR rows, padded to 4 bytes
+            arr = helpers.gdkpixbuf2numpy(pixbuf)[::-1, :, 2::-1]
+            padding = (-vid_w*3) % 4
+            if padding:
+                pad = numpy.zeros((vid_h, padding), 'uint8')
+                arr = numpy.hstack((arr.reshape(vid_h, vid_w*3), pad))
+            return arr.tostring()
+
+        codec, encode = 'MJPG', encode_jpeg
+        try:
+            encode_jpeg(GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,
+                                             True, 8, 2, 2))
+        except GObject.GError:
+            logger.warning('No JPEG support, writing uncompressed AVI')
+            codec, encode = 'DIB ', encode_dib
+
+        with open(out_filename, 'wb') as f:
+            writer = AviWriter(f, vid_w, vid_h, vid_fps, codec)
+            for data in self._video_frames(vid_w, vid_h, encode, feedback_cb):
+                writer.write_frame(data)
+            writer.close()
+
+    def _frame_layers(self, cel):
+        """
+        Return (layer, opacity) pairs to composite for a frame showing
+        the cel, bottom to top.
+
+        Cels other than the given one are left out, the rest of the
+        layers are composited as they are shown in the document.
+
+        """
+        cels = set(self.frames.get_all_cels())
+        res = []
+        for l in self.doc.layers:
+            if l is cel:
+                res.append((l, 1.0))
+            elif l not in cels and l.visible:
+                res.append((l, l.opacity))
+        return res
+
+    def get_frame_key(self, idx, mipmap_level=0):
+        """
+        Return the (key, token, layers) used to cache the nth frame.
+
+        Frames that hold the same cel share a key.  The token changes
+        whenever the content, opacity or blending of any of the layers
+        composited changes, or the document grows.
+
+        """
+        cel = self.frames.cel_at(idx)
+        layers = self._frame_layers(cel)
+        key = (cel, self.doc.background, mipmap_level)
+        token = tuple((l, l.revision, opa, l.compositeop)
+                      for l, opa in layers)
+        token += tuple(self.doc.get_effective_bbox())
+        return key, token, layers
+
+    def render_frame(self, idx, mipmap_level=0):
+        """
+        Return the nth frame flattened as a pixbufsurface.Surface.
 
-    def hide_all_frames(self):
-        cels = []
-        for cel in self.frames.get_all_cels():
-            cel.visible = False
-            self._notify_canvas_observers(cel)
+        The surface covers the effective bbox of the document, in the
+        coordinates of the mipmap level.  Rendered frames are kept in
+        the frame cache, frames that hold the same cel share a cache
+        entry.  Returns None if there is nothing to render.
 
-    def change_visible_frame(self, prev_idx, cur_idx):
-        prev_cel = self.frames.cel_at(prev_idx)
-        cur_cel = self.frames.cel_at(cur_idx)
-        if prev_cel == cur_cel:
+        """
+        key, token, layers = self.get_frame_key(idx, mipmap_level)
+        frame = self.frame_cache.get(key, token)
+        if frame is not None:
+            return frame
+
+        rect = frame_rect(self.doc.get_effective_bbox(), mipmap_level)
+        if rect[2] == 0 or rect[3] == 0:
+            return None
+        frame = pixbufsurface.Surface(*rect)
+
+        background = self.doc.background
+        N = tiledsurface.N
+        dst = numpy.empty((N, N, 4), dtype='uint16')
+        for tx, ty in frame.get_tiles():
+            with frame.tile_request(tx, ty, readonly=False) as dst_8bit:
+                background.blit_tile_into(dst, False, tx, ty, mipmap_level)
+                for l, opa in layers:
+                    l._surface.composite_tile(dst, False, tx, ty,
+                                              mipmap_level=mipmap_level,
+                                              opacity=opa,
+                                              mode=l.compositeop)
+                mypaintlib.tile_convert_rgbu16_to_rgbu8(dst, dst_8bit)
+
+        nbytes = frame.ew * frame.eh * 4
+        self.frame_cache.put(key, token, frame, nbytes)
+        return frame
+
+    def prefetch_frames(self):
+        """Start rendering the frames after the current one in the
+        background, at the resolution last used for playback.
+
+        Cels of a lazily loaded document are loaded first, one at a
+        time while the application is idle, and the frames are
+        prefetched once they are there.  Cels not used lately may get
+        their tiles compressed to stay within the memory budget of the
+        tile store.
+        """
+        if (not self.prefetch_enabled or self.frames is None or
+                len(self.frames) < 2):
             return
-        if prev_cel != None:
-            prev_cel.visible = False
-            self._notify_canvas_observers(prev_cel)
-        if cur_cel == None:
+        if self._tile_budget_id is None:
+            self._tile_budget_id = GObject.idle_add(self._enforce_tile_budget)
+        if self._cel_loader_id is None and self._cels_to_load():
+            self._cel_loader_id = GObject.idle_add(self._load_next_cel)
+        self.prefetcher.prefetch(self.frames.idx,
+                                 self.playback_mipmap_level)
+
+    def _cels_to_load(self):
+        """
+        Return the cels near the current frame that are not loaded yet,
+        closest first.
+
+        """
+        n = len(self.frames)
+        idx = self.frames.idx
+        frames = []
+        for i in xrange(max(LAZY_LOAD_AHEAD, LAZY_LOAD_BEHIND) + 1):
+            if i <= LAZY_LOAD_AHEAD and i < n:
+                frames.append((idx + i) % n)
+            if 0 < i <= LAZY_LOAD_BEHIND and idx - i >= 0:
+                frames.append(idx - i)
+        res = []
+        for i in frames:
+            cel = self.frames.cel_at(i)
+            if (cel is not None and cel not in res and
+                    not getattr(cel._surface, 'is_loaded', True)):
+                res.append(cel)
+        return res
+
+    def _enforce_tile_budget(self):
+        self._tile_budget_id = None
+        tiledsurface.tile_store.enforce_budget()
+        return False
+
+    def _load_next_cel(self):
+        cels = self._cels_to_load()
+        if cels:
+            cels[0]._surface.load_lazy()
+            return True
+        self._cel_loader_id = None
+        self.prefetch_frames()
+        return False
+
+    def get_playback_frame(self, mipmap_level=0):
+        """
+        Return the flattened current frame if playing from the cache,
+        else None.
+
+        """
+        if not self.cached_playback:
+            return None
+        self.playback_mipmap_level = mipmap_level
+        return self.render_frame(self.frames.idx, mipmap_level)
+
+    def _notify_playback_frame(self):
+        if self.proxy_level is not None:
+            for f in self.playback_observers:
+                f(self)
             return
-        cur_cel.opacity = 1
-        cur_cel.visible = True
-        self._notify_canvas_observers(cur_cel)
+        bbox = self.doc.get_effective_bbox()
+        for f in self.doc.canvas_observers:
+            f(*bbox)
+
+    def start_playback(self, use_lightbox=False, proxy_level=None):
+        """
+        Prepare the document for playing the animation.
+
+        With a proxy level, frames are flattened from that mipmap level
+        and presented by the playback observers, leaving the canvas
+        untouched.  Without the lightbox, frames are presented from the
+        frame cache and the cels are left untouched.
+
+        """
+        if proxy_level is not None:
+            self.proxy_level = proxy_level
+            self.playback_mipmap_level = proxy_level
+            self._notify_playback_frame()
+            self.prefetch_frames()
+        elif use_lightbox:
+            self.update_opacities()
+        else:
+            self.cached_playback = True
+            self._notify_playback_frame()
+            self.prefetch_frames()
+
+    def end_playback(self, idx):
+        """Stop presenting frames and show the nth frame for editing."""
+        self.cached_playback = False
+        self.proxy_level = None
+        self.prefetcher.cancel()
+        self.select_without_undo(idx)
 
     def update_opacities(self):
-        opacities, visible = self.frames.get_opacities()
+        """
+        Compute the onion skin of the current frame.
 
-        for cel, opa in opacities.items():
-            if cel is None:
-                continue
-            cel.opacity = opa
-            self._notify_canvas_observers(cel)
+        Cels are not modified, the onion skin is applied when the
+        document is rendered.  Only the cels whose onion skin changes
+        are redrawn, and the canvas is updated once for the area
+        covering all of them.
 
-        for cel, vis in visible.items():
-            if cel is None:
-                continue
-            cel.visible = vis
-            self._notify_canvas_observers(cel)
+        """
+        skin = {}
+        for cel, (opa, nextprev) in self.frames.get_onion_skin().iteritems():
+            tint = None
+            if self.tint_onion_skin and nextprev is not None and opa != 0:
+                tint = self.tints[nextprev]
+            skin[cel] = (opa, tint)
+
+        def shown_as(cel, skin):
+            if cel in skin:
+                return skin[cel]
+            return (cel.effective_opacity, None)
+
+        changed = helpers.Rect()
+        prev_skin = self.onion_skin
+        for cel in set(prev_skin) | set(skin):
+            if shown_as(cel, prev_skin) != shown_as(cel, skin):
+                changed.expandToIncludeRect(cel.get_bbox())
+        self.onion_skin = skin
+
+        if changed.empty():
+            return
+        for f in self.doc.canvas_observers:
+            f(*changed)
+
+    def set_onion_tint(self, active):
+        """Tint the previous and next cels in the lightbox."""
+        self.tint_onion_skin = active
+        self.update_opacities()
 
     def select_without_undo(self, idx):
         """Like the command but without undo/redo."""
@@ -285,16 +628,20 @@ class Animation(object):
     def stop_animation(self):
         self.player_state = "stop"
 
-    def player_next(self, use_lightbox=False):
-        prev_idx = self.frames.idx
-        if self.frames.has_next():
-            self.frames.goto_next()
+    def player_next(self, steps=1):
+        """
+        Advance playback by a number of frames, wrapping around.
+
+        Steps greater than one skip the frames in between, which is how
+        the player drops frames when it falls behind.
+
+        """
+        self.frames.select((self.frames.idx + steps) % len(self.frames))
+        if self.proxy_level is not None or self.cached_playback:
+            self._notify_playback_frame()
+            self.prefetch_frames()
         else:
-            self.frames.select(0)
-        if use_lightbox:
             self.update_opacities()
-        else:
-            self.change_visible_frame(prev_idx, self.frames.idx)
 
     def toggle_key(self):
         frame = self.frames.get_selected()
@@ -375,3 +722,36 @@ class Animation(object):
     def paste_cel(self):
         frame = self.frames.get_selected()
         self.doc.do(anicommand.PasteCel(self.doc, frame))
+
+
+def _save_cel_png(job):
+    # The interpreter lock is released while the PNG is compressed, so
+    # the cels are encoded in parallel by the threads.
+    sshot, filename, bbox, kwargs = job
+    data = sshot.encode_as_png(*bbox, **kwargs)
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def _save_cels_png(jobs, feedback_cb=None):
+    """Encode the cel snapshots of save_png() jobs, in parallel if possible."""
+    try:
+        workers = min(len(jobs), multiprocessing.cpu_count())
+    except NotImplementedError:
+        workers = 1
+    if workers < 2:
+        for job in jobs:
+            _save_cel_png(job)
+            if feedback_cb is not None:
+                feedback_cb()
+        return
+    pool = ThreadPool(workers)
+    try:
+        for res in pool.imap_unordered(_save_cel_png, jobs):
+            if feedback_cb is not None:
+                feedback_cb()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,152 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Minimal AVI (RIFF) writer for a single video stream
+
+Used to export animations without external tools. Frames are passed in
+already encoded: JPEG images for Motion-JPEG ('MJPG'), or bottom-up BGR
+rows for uncompressed video ('DIB ').
+
+A single RIFF chunk is written, so files are limited to 1 GiB, which
+is what AVI 1.0 readers reliably handle.
+"""
+
+import struct
+
+# Flags
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+MAX_SIZE = 1 << 30
+
+
+class AviWriter (object):
+    """Writes frames to a seekable file as an AVI
+
+    >>> import StringIO
+    >>> f = StringIO.StringIO()
+    >>> avi = AviWriter(f, 2, 2, 24, 'DIB ')
+    >>> avi.write_frame('\\0' * avi.frame_size())
+    >>> avi.write_frame('\\0' * avi.frame_size())
+    >>> avi.close()
+    >>> data = f.getvalue()
+    >>> data[:4], data[8:12]
+    ('RIFF', 'AVI ')
+    >>> struct.unpack('<I', data[4:8])[0] == len(data) - 8
+    True
+    >>> struct.unpack('<I', data[48:52])[0] # total frames
+    2
+    """
+
+    def __init__(self, fileobj, width, height, fps, codec='MJPG'):
+        object.__init__(self)
+        if codec not in ('MJPG', 'DIB '):
+            raise ValueError('Unsupported codec %r' % (codec,))
+        self.f = fileobj
+        self.width = width
+        self.height = height
+        self.codec = codec
+        # frame rate as a rational, dwRate/dwScale
+        self._scale = 1000
+        self._rate = int(round(fps * self._scale))
+        self._index = []
+        self._max_chunk = 0
+        self._write_headers()
+
+    def frame_size(self):
+        """Size of an uncompressed frame, rows padded to 4 bytes"""
+        stride = (self.width * 3 + 3) & ~3
+        return stride * self.height
+
+    def _write_headers(self):
+        f = self.f
+        f.write('RIFF' + struct.pack('<I', 0) + 'AVI ')
+        hdrl_start = f.tell()
+        f.write('LIST' + struct.pack('<I', 0) + 'hdrl')
+
+        self._avih_pos = f.tell()
+        f.write('avih' + struct.pack('<I', 56))
+        f.write(self._avih())
+
+        strl_start = f.tell()
+        f.write('LIST' + struct.pack('<I', 0) + 'strl')
+        self._strh_pos = f.tell()
+        f.write('strh' + struct.pack('<I', 56))
+        f.write(self._strh())
+        f.write('strf' + struct.pack('<I', 40))
+        if self.codec == 'DIB ':
+            compression = 0  # BI_RGB
+        else:
+            compression = struct.unpack('<I', self.codec)[0]
+        f.write(struct.pack('<IiiHHIIiiII', 40, self.width, self.height,
+                            1, 24, compression, self.frame_size(),
+                            0, 0, 0, 0))
+        self._patch_list_size(strl_start)
+        self._patch_list_size(hdrl_start)
+
+        self._movi_start = f.tell()
+        f.write('LIST' + struct.pack('<I', 0) + 'movi')
+
+    def _avih(self):
+        usec_per_frame = int(round(1e6 * self._scale / self._rate))
+        return struct.pack('<IIIIIIIIII16x',
+                           usec_per_frame, 0, 0, AVIF_HASINDEX,
+                           len(self._index), 0, 1, self._max_chunk,
+                           self.width, self.height)
+
+    def _strh(self):
+        return struct.pack('<4s4sIHHIIIIIIIIhhhh',
+                           'vids', self.codec, 0, 0, 0, 0,
+                           self._scale, self._rate, 0, len(self._index),
+                           self._max_chunk, 0xffffffff, 0,
+                           0, 0, self.width, self.height)
+
+    def _patch_list_size(self, start):
+        f = self.f
+        end = f.tell()
+        f.seek(start + 4)
+        f.write(struct.pack('<I', end - start - 8))
+        f.seek(end)
+
+    def write_frame(self, data):
+        """Appends one encoded frame
+
+        Data can be written more than once to repeat a frame.
+        """
+        f = self.f
+        size = len(data)
+        offset = f.tell() - (self._movi_start + 8)
+        if f.tell() + size + 8 + 16 * (len(self._index) + 1) > MAX_SIZE:
+            raise IOError('AVI file size limit reached')
+        f.write('00dc' + struct.pack('<I', size))
+        f.write(data)
+        if size % 2:
+            f.write('\0')
+        self._index.append((offset, size))
+        self._max_chunk = max(self._max_chunk, size)
+
+    def close(self):
+        """Writes the index and fixes up the headers"""
+        f = self.f
+        self._patch_list_size(self._movi_start)
+        f.write('idx1' + struct.pack('<I', 16 * len(self._index)))
+        for offset, size in self._index:
+            f.write('00dc' + struct.pack('<III', AVIIF_KEYFRAME, offset, size))
+        end = f.tell()
+        f.seek(4)
+        f.write(struct.pack('<I', end - 8))
+        f.seek(self._avih_pos + 8)
+        f.write(self._avih())
+        f.seek(self._strh_pos + 8)
+        f.write(self._strh())
+        f.seek(end)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
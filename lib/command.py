@@ -189,8 +189,10 @@ class FloodFill (Action):
         # Pick a source
         if self.sample_merged:
             src_layer = layer.Layer()
-            for l in self.doc.layers:
-                l.merge_into(src_layer, strokemap=False)
+            # what the canvas shows, see Document.blit_tile_into()
+            for l, opacity, tint in self.doc.get_shown_layers():
+                l.merge_into(src_layer, strokemap=False, opacity=opacity,
+                             tint=tint)
         else:
             src_layer = self.doc.layer
         # Choose a target
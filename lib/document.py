@@ -10,11 +10,14 @@
 
 import os
 import sys
+import struct
 import zipfile
-import tempfile
 import time
 import traceback
-from os.path import join
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
 from cStringIO import StringIO
 import xml.etree.ElementTree as ET
 import logging
@@ -36,6 +39,7 @@ import stroke
 import layer
 import brush
 import animation
+import framecache
 
 ## Module constants
 
@@ -43,6 +47,18 @@ import animation
 N = tiledsurface.N
 LOAD_CHUNK_SIZE = 64*1024
 
+# Layer PNGs queued per worker thread when saving or loading, ahead of
+# the one written to the file or to its layer
+QUEUE_PER_WORKER = 2
+
+# Seconds between calls of the feedback callback, while waiting for the
+# worker threads
+FEEDBACK_INTERVAL = 0.05
+
+# Most mipmap tiles regenerated per idle call, when they are regenerated
+# eagerly (see Document.eager_mipmaps)
+MIPMAP_REGEN_BATCH = 64
+
 # Compositing
 from layer import DEFAULT_COMPOSITE_OP
 from layer import VALID_COMPOSITE_OPS
@@ -58,6 +74,534 @@ class SaveLoadError(Exception):
     pass
 
 
+class LazyLayerLoader (object):
+    """Decodes the layers of an OpenRaster file as they are needed
+
+    Layer surfaces registered with add() are given the bbox read from the
+    header of their PNG, and are only decoded from the file the first
+    time their tiles are accessed (see
+    `tiledsurface.MyPaintSurface.set_lazy_loader()`). The file stays
+    open until all of them are loaded, or close() is called.
+
+    A layer that fails to load is left empty, and listed in `failed`:
+    saving copies its PNG over from the file instead, and exporting
+    raises a SaveLoadError (see `Document.check_failed_layers()`).
+    """
+
+    def __init__(self, filename):
+        object.__init__(self)
+        self.filename = os.path.abspath(filename)
+        self._zip = None
+        self._pid = None
+        self._pending = {} # surface -> (src, x, y)
+        #: Surfaces that failed to load, to the name of their PNG
+        self.failed = {}
+
+    def _get_zipfile(self):
+        # Forked processes (see mypaint-render.py) get their own file
+        # object, a shared file offset would mix up their reads
+        if self._zip is None or self._pid != os.getpid():
+            self._zip = zipfile.ZipFile(self.filename)
+            self._pid = os.getpid()
+        return self._zip
+
+    def add(self, surface, src, x, y):
+        """Defers loading a surface from a PNG in the file"""
+        z = self._get_zipfile()
+        fp = z.open(src)
+        head = fp.read(24)
+        fp.close()
+        if head[12:16] == 'IHDR':
+            w, h = struct.unpack('>II', head[16:24])
+        else:
+            w, h = 0, 0
+        self._pending[surface] = (src, x, y)
+        surface.set_lazy_loader(self._load, (x, y, w, h), self.discard)
+
+    def _load(self, surface):
+        src, x, y = self._pending.pop(surface)
+        t0 = time.time()
+        try:
+            data = self._get_zipfile().read(src)
+            sshot, frame_size = tiledsurface.decode_png(data, x, y)
+            surface.load_snapshot(sshot)
+        except Exception:
+            # Raising would break whatever happened to touch the layer,
+            # saving and exporting report it instead
+            logger.exception('Failed to load layer %r', src)
+            self.failed[surface] = src
+        logger.debug('%.3fs loading layer %s on demand',
+                     time.time() - t0, src)
+        if not self._pending:
+            self.close()
+
+    def discard(self, surface):
+        """Forgets a surface cleared before it was loaded"""
+        self._pending.pop(surface, None)
+        if not self._pending:
+            self.close()
+
+    @property
+    def pending(self):
+        """Number of layers not loaded yet"""
+        return len(self._pending)
+
+    def get_pending(self, surface):
+        """Returns (src, x, y) of a surface not loaded yet, or None"""
+        return self._pending.get(surface)
+
+    def load_all(self):
+        """Loads all the layers still pending"""
+        for surface in self._pending.keys():
+            surface.load_lazy()
+
+    def move_to(self, members):
+        """Prepares for the file to be replaced by a new version
+
+        :param members: maps pending surfaces to the name of their PNG
+          in the new file; the other pending surfaces are loaded now
+
+        The file is closed, and reopened as needed once replaced.
+        """
+        for surface, (src, x, y) in self._pending.items():
+            if surface in members:
+                self._pending[surface] = (members[surface], x, y)
+            else:
+                surface.load_lazy()
+        for surface in self.failed.keys():
+            if surface in members:
+                self.failed[surface] = members[surface]
+        self.close()
+
+    def close(self):
+        """Closes the file, layers still pending stay empty"""
+        if self._zip is not None and self._pid == os.getpid():
+            self._zip.close()
+        self._zip = None
+
+
+def _get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _wait_for_result(result, feedback_cb):
+    """Returns the result of a pool job, calling feedback_cb meanwhile"""
+    while not result.ready():
+        if feedback_cb:
+            feedback_cb()
+        result.wait(FEEDBACK_INTERVAL)
+    return result.get()
+
+
+def _encode_snapshot(sshot, rect, kwargs):
+    """Encodes a surface snapshot as PNG, in a worker thread of save_ora()
+
+    Returns the PNG data and the seconds it took.
+    """
+    t0 = time.time()
+    data = sshot.encode_as_png(*rect, **kwargs)
+    return data, time.time() - t0
+
+
+def _decode_png(data, x, y):
+    """Decodes a layer PNG, in a worker thread of load_ora()
+
+    Returns a snapshot of the tiles and the seconds it took.
+    """
+    t0 = time.time()
+    sshot, frame_size = tiledsurface.decode_png(data, x, y)
+    return sshot, time.time() - t0
+
+
+def _save_error(e):
+    """Returns a SaveLoadError for an expected error, or None"""
+    if isinstance(e, GObject.GError):
+        if e.code == 5:
+            #add a hint due to a very consfusing error message when there is no space left on device
+            return SaveLoadError(_('Unable to save: %s\nDo you have enough space left on the device?') % e.message)
+        return SaveLoadError(_('Unable to save: %s') % e.message)
+    if isinstance(e, (IOError, OSError)):
+        return SaveLoadError(_('Unable to save: %s') % (e.strerror or e))
+    return None
+
+
+def _thumbnail_rect(bbox):
+    """Returns the area and mipmap level to render a thumbnail from"""
+    x, y, w, h = bbox
+    if w == 0 or h == 0:
+        # workaround to save empty documents
+        x, y, w, h = 0, 0, N, N
+    mipmap_level = 0
+    while mipmap_level < tiledsurface.MAX_MIPMAP_LEVEL and max(w, h) >= 512:
+        mipmap_level += 1
+        x, y, w, h = x/2, y/2, w/2, h/2
+    return (x, y, w, h), mipmap_level
+
+
+def _load_failed_error(layer, src):
+    """Returns the SaveLoadError for a layer that failed to load"""
+    return SaveLoadError(_('Layer "%s" could not be loaded from %s. '
+                           'Its contents would be lost, remove the layer '
+                           'to save anyway.') % (layer.name, src))
+
+
+class OraSaveJob (object):
+    """An OpenRaster file being written from snapshots of a document
+
+    Everything that goes into the file is captured when the job is
+    created, on the main thread: snapshots of the changed layers, which
+    only takes marking their tiles read-only, their strokemaps and the
+    X-Sheet. write() then encodes the layers, renders the thumbnail from
+    snapshots of the visible layers and writes the file, and can do that
+    on another thread (see start()) while the document keeps being
+    edited.
+
+    The PNGs and strokemaps of layers that did not change since they
+    were last saved or loaded are copied over from that file if it is
+    still there, instead of being encoded again. Layers that failed to
+    load (see `LazyLayerLoader.failed`) can only be copied, creating
+    the job raises a SaveLoadError if that is not possible. The others are encoded
+    by a pool of threads, straight into the zip file.
+    """
+
+    def __init__(self, doc, filename, **kwargs):
+        object.__init__(self)
+        t0 = time.time()
+        self.doc = doc
+        self.filename = filename
+        self.tmp_filename = filename + '.tmpsave'
+        self.kwargs = kwargs
+        #: Set by the thread of start() if writing failed, as exc_info
+        self.error = None
+        self._thread = None
+        self._finished = False
+        #: What the document looked like, see Document.save_ora()
+        self.ora_layers = {}
+        #: Painting time the document had unsaved, for failed saves
+        self.painting_time = 0.0
+
+        self.save_profile = pixbufsurface.get_save_profile(kwargs)
+        by_size = pixbufsurface.SAVE_PROFILES_BY_SIZE
+        min_size_rank = by_size.index(self.save_profile)
+        self.old_filename = None
+        if (doc._ora_file is not None and
+                doc._ora_file == doc._ora_file_key(doc._ora_file[0])):
+            self.old_filename = doc._ora_file[0]
+
+        image = ET.Element('image')
+        stack = ET.SubElement(image, 'stack')
+        x0, y0, w0, h0 = doc.get_effective_bbox()
+        a = image.attrib
+        a['w'] = str(w0)
+        a['h'] = str(h0)
+
+        # (png name, strokemap name, old png, old strokemap, snapshot,
+        #  rect, strokemap data, layer), top to bottom
+        self._layers = []
+        failed = {}
+        if doc.lazy_layers is not None:
+            failed = doc.lazy_layers.failed
+        for idx, l in enumerate(reversed(doc.layers)):
+            # empty after failing to load, but not in the file
+            failed_src = failed.get(l._surface)
+            if l.is_empty() and failed_src is None:
+                continue
+            png_name = 'data/layer%03d.png' % idx
+            strokemap_name = 'data/layer%03d_strokemap.dat' % idx
+            old = doc._ora_layers.get(l)
+            if (self.old_filename is not None and old
+                    and old[0] == l.revision
+                    and (failed_src is not None or
+                         by_size.index(old[6]) >= min_size_rank)):
+                revision, old_png, old_strokemap, x, y, cost, profile = old
+                if not old_strokemap:
+                    strokemap_name = None
+                self._layers.append((png_name, strokemap_name, old_png,
+                                     old_strokemap, None, None, None, l))
+            elif failed_src is not None:
+                raise _load_failed_error(l, failed_src)
+            else:
+                # the snapshot's tiles are read-only, so they can be
+                # encoded by other threads while the layer changes
+                x, y, w, h = l.get_bbox()
+                sshot = l._surface.save_snapshot()
+                sio = StringIO()
+                l.save_strokemap_to_file(sio, -x, -y)
+                strokemap = sio.getvalue(); sio.close()
+                cost = 0.0
+                profile = self.save_profile
+                self._layers.append((png_name, strokemap_name, None, None,
+                                     sshot, (x, y, w, h), strokemap, l))
+            el = self._layer_element(stack, x-x0, y-y0, l.opacity, png_name,
+                                     l.name, l.visible, locked=l.locked,
+                                     selected=(idx == doc.layer_idx),
+                                     compositeop=l.compositeop)
+            if strokemap_name:
+                el.attrib['mypaint_strokemap_v2'] = strokemap_name
+            self.ora_layers[l] = (l.revision, png_name, strokemap_name,
+                                  x, y, cost, profile)
+
+        self._xsheet = doc.ani.xsheet_as_str()
+
+        # save background as layer (solid color or tiled)
+        self._background = doc.background
+        # save as fully rendered layer
+        x, y, w, h = doc.get_bbox()
+        self._background_rect = (x, y, w, h)
+        l = self._layer_element(stack, x-x0, y-y0, 1.0,
+                                'data/background.png', 'background',
+                                locked=True, selected=False,
+                                compositeop=DEFAULT_COMPOSITE_OP)
+        x, y, w, h = self._background.get_bbox()
+        # save as single pattern (with corrected origin)
+        self._background_tile_rect = (x+x0, y+y0, w, h)
+        l.attrib['background_tile'] = 'data/background_tile.png'
+
+        # preview (256x256), rendered by write() from snapshots of the
+        # layers shown in the current frame, bottom to top. Layers still
+        # to be loaded on demand are decoded there from their PNG, as
+        # (tiledict, (src, x, y), opacity, compositeop).
+        self.thumbnail = None
+        self._thumbnail_rect, self._thumbnail_level = _thumbnail_rect(
+            doc.get_effective_bbox())
+        snapshots = dict((rec[7], rec[4]) for rec in self._layers
+                         if rec[4] is not None)
+        lazy = doc.lazy_layers
+        self._thumbnail_zip = lazy.filename if lazy is not None else None
+        self._thumbnail_layers = []
+        for l, opacity, tint in doc.get_shown_layers():
+            member = None
+            if lazy is not None:
+                member = lazy.get_pending(l._surface)
+            tiledict = None
+            if member is None:
+                sshot = snapshots.get(l)
+                if sshot is None:
+                    sshot = l._surface.save_snapshot()
+                tiledict = sshot.tiledict
+            self._thumbnail_layers.append((tiledict, member, opacity,
+                                           l.compositeop))
+
+        helpers.indent_etree(image)
+        self._xml = ET.tostring(image, encoding='UTF-8')
+        logger.debug('%.3fs capturing the document for saving %r',
+                     time.time() - t0, filename)
+
+    @staticmethod
+    def _layer_element(stack, x, y, opac, name, layer_name, visible=True,
+                       locked=False, selected=False,
+                       compositeop=DEFAULT_COMPOSITE_OP):
+        layer = ET.Element('layer')
+        stack.append(layer)
+        a = layer.attrib
+        if layer_name:
+            a['name'] = layer_name
+        a['src'] = name
+        a['x'] = str(x)
+        a['y'] = str(y)
+        a['opacity'] = str(opac)
+        if compositeop not in VALID_COMPOSITE_OPS:
+            compositeop = DEFAULT_COMPOSITE_OP
+        a['composite-op'] = compositeop
+        if visible:
+            a['visibility'] = 'visible'
+        else:
+            a['visibility'] = 'hidden'
+        if locked:
+            a['edit-locked'] = 'true'
+        if selected:
+            a['selected'] = 'true'
+        return layer
+
+    def _render_thumbnail(self):
+        # Sets self.thumbnail and returns it as PNG data
+        t0 = time.time()
+        layers = []
+        z = None
+        try:
+            for tiledict, member, opacity, mode in self._thumbnail_layers:
+                if tiledict is None:
+                    src, x, y = member
+                    try:
+                        if z is None:
+                            z = zipfile.ZipFile(self._thumbnail_zip)
+                        sshot, frame_size = tiledsurface.decode_png(
+                            z.read(src), x, y)
+                    except Exception:
+                        # only the thumbnail misses it, not the file
+                        logger.exception('Failed to load layer %r for the '
+                                         'thumbnail', src)
+                        continue
+                    tiledict = sshot.tiledict
+                layers.append((tiledict, opacity, mode))
+        finally:
+            if z is not None:
+                z.close()
+        frame = framecache.render_snapshot_frame(self._thumbnail_rect,
+                                                 self._thumbnail_level,
+                                                 self._background, layers)
+        self.thumbnail = helpers.scale_proportionally(frame.pixbuf, 256, 256)
+        ok, data = self.thumbnail.save_to_bufferv('png', [], [])
+        logger.debug('%.3fs rendering the thumbnail', time.time() - t0)
+        return data
+
+    def write(self, feedback_cb=None):
+        """Encodes the layers and writes the file under a temporary name
+
+        The file is only put in place by commit(), so a valid file is
+        not overwritten if there is an exception.
+        """
+        t0 = time.time()
+        n_copied = 0
+        copied_time = 0.0
+        encode_costs = {}
+        # feedback is given by this thread while waiting for the workers
+        encode_kwargs = self.kwargs.copy()
+        encode_kwargs.pop('feedback_cb', None)
+        workers = _get_cpu_count()
+        pending = deque()
+        z = zipfile.ZipFile(self.tmp_filename, 'w',
+                            compression=zipfile.ZIP_STORED)
+        old_z = None
+        if self.old_filename is not None:
+            old_z = zipfile.ZipFile(self.old_filename)
+
+        # work around a permission bug in the zipfile library: http://bugs.python.org/issue3394
+        def write_file_str(filename, data):
+            zi = zipfile.ZipInfo(filename)
+            zi.external_attr = 0100644 << 16
+            z.writestr(zi, data)
+
+        def store_surface(surface, name, rect=[]):
+            t1 = time.time()
+            data = surface.encode_as_png(*rect, feedback_cb=feedback_cb,
+                                         **encode_kwargs)
+            logger.debug('%.3fs surface saving %s', time.time() - t1, name)
+            write_file_str(name, data)
+
+        def store_encoded(limit):
+            # writes the oldest PNGs from the workers, in order
+            while len(pending) > limit:
+                name, l, result = pending.popleft()
+                data, cost = _wait_for_result(result, feedback_cb)
+                logger.debug('%.3fs surface saving %s', cost, name)
+                write_file_str(name, data)
+                encode_costs[l] += cost
+
+        def copy_member(src, name):
+            # already compressed, and stored uncompressed in the zip
+            zi = zipfile.ZipInfo(name)
+            zi.external_attr = 0100644 << 16
+            z.writestr(zi, old_z.read(src))
+
+        pool = ThreadPool(workers)
+        try:
+            write_file_str('mimetype', 'image/openraster') # must be the first file
+            for (png_name, strokemap_name, old_png, old_strokemap, sshot,
+                    rect, strokemap, l) in self._layers:
+                t1 = time.time()
+                if sshot is None:
+                    copy_member(old_png, png_name)
+                    if old_strokemap:
+                        copy_member(old_strokemap, strokemap_name)
+                    copied_time += time.time() - t1
+                    n_copied += 1
+                    continue
+                encode_costs[l] = 0.0
+                result = pool.apply_async(_encode_snapshot,
+                                          (sshot, rect, encode_kwargs))
+                pending.append((png_name, l, result))
+                store_encoded(workers * QUEUE_PER_WORKER)
+                write_file_str(strokemap_name, strokemap)
+                # completed with the encoding time below
+                encode_costs[l] += time.time() - t1
+
+            write_file_str('animation.xsheet', self._xsheet)
+
+            # the background is encoded by this thread while the
+            # workers finish the layers
+            store_surface(self._background, 'data/background.png',
+                          self._background_rect)
+            store_surface(self._background, 'data/background_tile.png',
+                          self._background_tile_rect)
+            write_file_str('Thumbnails/thumbnail.png',
+                           self._render_thumbnail())
+
+            store_encoded(0)
+            pool.close()
+
+            write_file_str('stack.xml', self._xml)
+            z.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            if old_z is not None:
+                old_z.close()
+
+        for l, cost in encode_costs.iteritems():
+            self.ora_layers[l] = (self.ora_layers[l][:5] + (cost,) +
+                                  self.ora_layers[l][6:])
+        encoded_time = sum(encode_costs.itervalues())
+        full_time = sum(rec[5] for rec in self.ora_layers.itervalues())
+        logger.info('%.3fs save_ora total: %.3fs encoding %d changed '
+                    'layers on %d threads, %.3fs copying %d unchanged '
+                    'ones (a full save encodes for about %.3fs)',
+                    time.time() - t0, encoded_time, len(encode_costs),
+                    workers, copied_time, n_copied, full_time)
+
+    def commit(self):
+        """Replaces the file by the one written by write()"""
+        if os.path.exists(self.filename):
+            os.remove(self.filename) # windows needs that
+        os.rename(self.tmp_filename, self.filename)
+
+    def start(self):
+        """Writes and commits the file on a new thread"""
+        # not a daemon, exiting waits for the file to be complete
+        self._thread = threading.Thread(target=self._run,
+                                        name="OraSaveJob")
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self.write()
+            self.commit()
+        except Exception:
+            logger.exception('Saving %r failed', self.filename)
+            self.error = sys.exc_info()
+
+    @property
+    def done(self):
+        """Whether the thread of start() has finished"""
+        return self._thread is None or not self._thread.is_alive()
+
+    def finish(self):
+        """Waits for the thread of start(), and updates the document
+
+        Raises SaveLoadError if the file could not be written, every time
+        it is called.
+        """
+        if self._thread is not None:
+            self._thread.join()
+        if not self._finished:
+            self._finished = True
+            if self.error is None:
+                self.doc._ora_saved(self)
+            else:
+                self.doc.unsaved_painting_time += self.painting_time
+        if self.error is not None:
+            exc_type, exc, tb = self.error
+            error = _save_error(exc)
+            if error is None:
+                raise exc_type, exc, tb
+            raise error
+
+
 class Document():
     """
     This is the "model" in the Model-View-Controller design.
@@ -93,6 +637,16 @@ class Document():
         self.symmetry_observers = []  #: See `set_symmetry_axis()`
         self.__symmetry_axis = None
         self.default_background = (255, 255, 255)
+        self.lazy_layers = None #: See `load_ora()`
+        # ORA file the layers were last saved to or loaded from, and for
+        # each layer where its data is in there, see save_ora()
+        self._ora_file = None
+        self._ora_layers = {}
+        self._background_save = None #: See `save_in_background()`
+        #: Regenerate the mipmaps of changed layers while idle after changes,
+        #: instead of when first rendered zoomed out
+        self.eager_mipmaps = False
+        self._mipmap_regen_id = None
         self.clear(True)
 
         self._frame = [0, 0, 0, 0]
@@ -232,6 +786,11 @@ class Document():
             bbox = self.get_bbox()
         # throw everything away, including undo stack
 
+        if self.lazy_layers is not None:
+            self.lazy_layers.close()
+            self.lazy_layers = None
+        self._ora_file = None
+        self._ora_layers = {}
         self.command_stack = command.CommandStack()
         self.command_stack.stack_observers = self.command_stack_observers
         self.set_background(self.default_background)
@@ -276,7 +835,14 @@ class Document():
             self.unsaved_painting_time += self.stroke.total_painting_time
             for f in self.stroke_observers:
                 f(self.stroke, self.brush)
+            # Strokes are a natural epoch for the tile pool: give back
+            # the buffers that were not needed since the previous one.
+            released = tiledsurface.tile_pool.trim()
+            if released:
+                logger.debug('tile pool: released %d buffers, %r', released,
+                             tiledsurface.tile_pool.get_stats())
         self.stroke = None
+        self._schedule_mipmap_regen()
 
 
     def brushsettings_changed_cb(self, settings, lightweight_settings=set([
@@ -412,6 +978,39 @@ class Document():
         # for now, any layer modification is assumed to be visible
         for f in self.canvas_observers:
             f(*args)
+        if self.stroke is None:
+            # strokes schedule it once they are done, see split_stroke()
+            self._schedule_mipmap_regen()
+
+
+    def _schedule_mipmap_regen(self):
+        if self.eager_mipmaps and self._mipmap_regen_id is None:
+            self._mipmap_regen_id = GObject.idle_add(
+                self._regenerate_mipmaps_cb)
+
+
+    def _regenerate_mipmaps_cb(self):
+        # A batch at a time, so that input and redraws are not held up
+        if self.stroke is not None:
+            # not in the middle of painting
+            self._mipmap_regen_id = None
+            return False
+        t0 = time.time()
+        count = 0
+        for layer in self.layers:
+            regenerate = getattr(layer._surface, 'regenerate_mipmaps', None)
+            if regenerate is not None:
+                count += regenerate(limit=MIPMAP_REGEN_BATCH - count)
+                if count >= MIPMAP_REGEN_BATCH:
+                    break
+        if count:
+            logger.debug('%.3fs regenerating %d mipmap tiles',
+                         time.time() - t0, count)
+        if count >= MIPMAP_REGEN_BATCH:
+            # maybe more to do
+            return True
+        self._mipmap_regen_id = None
+        return False
 
 
     def invalidate_all(self):
@@ -480,19 +1079,38 @@ class Document():
         return self.get_frame() if self.frame_enabled else self.get_bbox()
 
 
-    def render_into(self, surface, tiles, mipmap_level=0, layers=None, background=None):
+    def render_into(self, surface, tiles, mipmap_level=0, layers=None, background=None, onion=None):
+
+        if mipmap_level > 0 and tiles:
+            # all dirty tiles of the levels needed at once, in parallel,
+            # rather than one by one while compositing
+            for layer in (self.layers if layers is None else layers):
+                layer_surface = getattr(layer, '_surface', None)
+                regenerate = getattr(layer_surface, 'regenerate_mipmaps',
+                                     None)
+                if regenerate is not None:
+                    regenerate(mipmap_level)
 
         # TODO: move this loop down in C/C++
         for tx, ty in tiles:
             with surface.tile_request(tx, ty, readonly=False) as dst:
-                self.blit_tile_into(dst, False, tx, ty, mipmap_level, layers, background)
+                self.blit_tile_into(dst, False, tx, ty, mipmap_level, layers, background, onion)
+
+    def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0, layers=None, background=None, onion=None):
+        """Composite the background and layers into one tile
 
-    def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0, layers=None, background=None):
+        :param onion: map of layers to (opacity, tint) pairs overriding
+          how those layers are shown, see Animation.onion_skin.  Layers
+          not in the map are composited as usual.  Defaults to the
+          onion skin of the current animation frame.
+        """
         assert dst_has_alpha is False
         if layers is None:
             layers = self.layers
         if background is None:
             background = self.background
+        if onion is None:
+            onion = self.ani.onion_skin
 
         assert dst.shape[-1] == 4
         if dst.dtype == 'uint8':
@@ -504,11 +1122,42 @@ class Document():
         background.blit_tile_into(dst, dst_has_alpha, tx, ty, mipmap_level)
 
         for layer in layers:
-            layer.composite_tile(dst, dst_has_alpha, tx, ty, mipmap_level)
+            skin = onion.get(layer)
+            if skin is None:
+                layer.composite_tile(dst, dst_has_alpha, tx, ty, mipmap_level)
+                continue
+            opacity, tint = skin
+            if opacity == 0:
+                continue
+            layer.composite_tile(dst, dst_has_alpha, tx, ty, mipmap_level,
+                                 opacity=opacity, tint=tint)
 
         if dst_8bit is not None:
             mypaintlib.tile_convert_rgbu16_to_rgbu8(dst, dst_8bit)
 
+    def get_shown_layers(self, layers=None, onion=None):
+        """Returns the layers as blit_tile_into() composites them
+
+        A list of ``(layer, opacity, tint)``, bottom to top, with the onion
+        skin applied (see `Animation.onion_skin`, the default `onion`).
+        Layers at opacity 0 are left out.
+        """
+        if layers is None:
+            layers = self.layers
+        if onion is None:
+            onion = self.ani.onion_skin
+        res = []
+        for layer in layers:
+            skin = onion.get(layer)
+            if skin is None:
+                opacity, tint = layer.effective_opacity, None
+            else:
+                opacity, tint = skin
+            if opacity == 0:
+                continue
+            res.append((layer, opacity, tint))
+        return res
+
     def get_rendered_image_behind_current_layer(self, tx, ty):
         dst = numpy.empty((N, N, 4), dtype='uint16')
         l = self.layers[0:self.layer_idx]
@@ -642,24 +1291,82 @@ class Document():
             presentable to the user.
 
         """
+        self._wait_for_background_save()
         self.split_stroke()
         junk, ext = os.path.splitext(filename)
         ext = ext.lower().replace('.', '')
+        if ext != 'ora':
+            # exports render all the layers, see OraSaveJob for saving
+            self.check_failed_layers()
         save = getattr(self, 'save_' + ext, self._unsupported)
         try:
             save(filename, **kwargs)
-        except GObject.GError, e:
+        except (GObject.GError, IOError), e:
             traceback.print_exc()
-            if e.code == 5:
-                #add a hint due to a very consfusing error message when there is no space left on device
-                raise SaveLoadError, _('Unable to save: %s\nDo you have enough space left on the device?') % e.message
-            else:
-                raise SaveLoadError, _('Unable to save: %s') % e.message
-        except IOError, e:
-            traceback.print_exc()
-            raise SaveLoadError, _('Unable to save: %s') % e.strerror
+            raise _save_error(e)
         self.unsaved_painting_time = 0.0
 
+    def check_failed_layers(self, layers=None):
+        """Loads the layers, raising SaveLoadError if any failed to load
+
+        Layers loaded on demand (see `load_ora()`) that could not be are
+        left empty, and anything rendered from them would miss their
+        contents. Checks all layers unless given a list of them.
+        """
+        lazy = self.lazy_layers
+        if lazy is None:
+            return
+        if layers is None:
+            layers = self.layers
+            lazy.load_all()
+        else:
+            for l in layers:
+                l._surface.load_lazy()
+        for l in layers:
+            src = lazy.failed.get(l._surface)
+            if src is not None:
+                raise _load_failed_error(l, src)
+
+    def save_in_background(self, filename, **kwargs):
+        """Saves to an OpenRaster file on another thread
+
+        The document is captured right away, see `OraSaveJob`, and can
+        be edited while the file is written. Returns the job, whose
+        finish() must be called once it is done. Other formats, and the
+        file layers are still to be loaded from on demand, are saved by
+        save() before returning None.
+
+        A save waits for the one before it to finish.
+        """
+        self._wait_for_background_save()
+        junk, ext = os.path.splitext(filename)
+        lazy = self.lazy_layers
+        if ext.lower() != '.ora' or (lazy is not None and lazy.pending and
+                lazy.filename == os.path.abspath(filename)):
+            self.save(filename, **kwargs)
+            return None
+        self.split_stroke()
+        # the feedback callback runs the main loop, not for other threads
+        kwargs.pop('feedback_cb', None)
+        logger.info('save_in_background: %r (%r)', filename, kwargs)
+        job = OraSaveJob(self, filename, **kwargs)
+        job.painting_time = self.unsaved_painting_time
+        self.unsaved_painting_time = 0.0
+        job.start()
+        self._background_save = job
+        return job
+
+    def _wait_for_background_save(self):
+        job = self._background_save
+        if job is None:
+            return
+        self._background_save = None
+        try:
+            job.finish()
+        except SaveLoadError:
+            # reported by whoever started it, with job.finish()
+            pass
+
 
     def load(self, filename, **kwargs):
         """Load the document from a file.
@@ -702,15 +1409,7 @@ class Document():
 
     def render_thumbnail(self):
         t0 = time.time()
-        x, y, w, h = self.get_effective_bbox()
-        if w == 0 or h == 0:
-            # workaround to save empty documents
-            x, y, w, h = 0, 0, tiledsurface.N, tiledsurface.N
-        mipmap_level = 0
-        while mipmap_level < tiledsurface.MAX_MIPMAP_LEVEL and max(w, h) >= 512:
-            mipmap_level += 1
-            x, y, w, h = x/2, y/2, w/2, h/2
-
+        (x, y, w, h), mipmap_level = _thumbnail_rect(self.get_effective_bbox())
         pixbuf = self.render_as_pixbuf(x, y, w, h, mipmap_level=mipmap_level)
         assert pixbuf.get_width() == w and pixbuf.get_height() == h
         pixbuf = helpers.scale_proportionally(pixbuf, 256, 256)
@@ -726,15 +1425,15 @@ class Document():
             self.ani.save_png(filename, **kwargs)
         if alpha:
             tmp_layer = layer.Layer()
-            for l in self.layers:
-                l.merge_into(tmp_layer)
-            tmp_layer._surface.save(filename, *doc_bbox)
+            for l, opacity, tint in self.get_shown_layers():
+                l.merge_into(tmp_layer, opacity=opacity, tint=tint)
+            tmp_layer.save_as_png(filename, *doc_bbox, **kwargs)
         else:
             if alpha:
                 tmp_layer = layer.Layer()
-                for l in self.layers:
-                    l.merge_into(tmp_layer)
-                tmp_layer.save_as_png(filename, *doc_bbox)
+                for l, opacity, tint in self.get_shown_layers():
+                    l.merge_into(tmp_layer, opacity=opacity, tint=tint)
+                tmp_layer.save_as_png(filename, *doc_bbox, **kwargs)
             else:
                 pixbufsurface.save_as_png(self, filename, *doc_bbox, alpha=False, **kwargs)
 
@@ -789,125 +1488,41 @@ class Document():
 
     save_jpeg = save_jpg
 
-    def save_ora(self, filename, options=None, **kwargs):
-        logger.info('save_ora: %r (%r, %r)', filename, options, kwargs)
-        t0 = time.time()
-        tempdir = tempfile.mkdtemp('mypaint')
-        if not isinstance(tempdir, unicode):
-            tempdir = tempdir.decode(sys.getfilesystemencoding())
-        # use .tmp extension, so we don't overwrite a valid file if there is an exception
-        z = zipfile.ZipFile(filename + '.tmpsave', 'w', compression=zipfile.ZIP_STORED)
-        # work around a permission bug in the zipfile library: http://bugs.python.org/issue3394
-        def write_file_str(filename, data):
-            zi = zipfile.ZipInfo(filename)
-            zi.external_attr = 0100644 << 16
-            z.writestr(zi, data)
-        write_file_str('mimetype', 'image/openraster') # must be the first file
-        image = ET.Element('image')
-        stack = ET.SubElement(image, 'stack')
-        x0, y0, w0, h0 = self.get_effective_bbox()
-        a = image.attrib
-        a['w'] = str(w0)
-        a['h'] = str(h0)
-
-        def store_pixbuf(pixbuf, name):
-            tmp = join(tempdir, 'tmp.png')
-            t1 = time.time()
-            pixbuf.savev(tmp, 'png', [], [])
-            logger.debug('%.3fs pixbuf saving %s', time.time() - t1, name)
-            z.write(tmp, name)
-            os.remove(tmp)
-
-        def store_surface(surface, name, rect=[]):
-            tmp = join(tempdir, 'tmp.png')
-            t1 = time.time()
-            surface.save_as_png(tmp, *rect, **kwargs)
-            logger.debug('%.3fs surface saving %s', time.time() - t1, name)
-            z.write(tmp, name)
-            os.remove(tmp)
-
-        def add_layer(x, y, opac, surface, name, layer_name, visible=True,
-                      locked=False, selected=False,
-                      compositeop=DEFAULT_COMPOSITE_OP, rect=[]):
-            layer = ET.Element('layer')
-            stack.append(layer)
-            store_surface(surface, name, rect)
-            a = layer.attrib
-            if layer_name:
-                a['name'] = layer_name
-            a['src'] = name
-            a['x'] = str(x)
-            a['y'] = str(y)
-            a['opacity'] = str(opac)
-            if compositeop not in VALID_COMPOSITE_OPS:
-                compositeop = DEFAULT_COMPOSITE_OP
-            a['composite-op'] = compositeop
-            if visible:
-                a['visibility'] = 'visible'
-            else:
-                a['visibility'] = 'hidden'
-            if locked:
-                a['edit-locked'] = 'true'
-            if selected:
-                a['selected'] = 'true'
-            return layer
-
-        for idx, l in enumerate(reversed(self.layers)):
-            if l.is_empty():
-                continue
-            opac = l.opacity
-            x, y, w, h = l.get_bbox()
-            sel = (idx == self.layer_idx)
-            el = add_layer(x-x0, y-y0, opac, l._surface,
-                           'data/layer%03d.png' % idx, l.name, l.visible,
-                           locked=l.locked, selected=sel,
-                           compositeop=l.compositeop, rect=(x, y, w, h))
-
-            # strokemap
-            sio = StringIO()
-            l.save_strokemap_to_file(sio, -x, -y)
-            data = sio.getvalue(); sio.close()
-            name = 'data/layer%03d_strokemap.dat' % idx
-            el.attrib['mypaint_strokemap_v2'] = name
-            write_file_str(name, data)
-
-        ani_data = self.ani.xsheet_as_str()
-        write_file_str('animation.xsheet', ani_data)
-
-        # save background as layer (solid color or tiled)
-        bg = self.background
-        # save as fully rendered layer
-        x, y, w, h = self.get_bbox()
-        l = add_layer(x-x0, y-y0, 1.0, bg, 'data/background.png', 'background',
-                      locked=True, selected=False,
-                      compositeop=DEFAULT_COMPOSITE_OP,
-                      rect=(x,y,w,h))
-        x, y, w, h = bg.get_bbox()
-        # save as single pattern (with corrected origin)
-        store_surface(bg, 'data/background_tile.png', rect=(x+x0, y+y0, w, h))
-        l.attrib['background_tile'] = 'data/background_tile.png'
-
-        # preview (256x256)
-        t2 = time.time()
-        logger.debug('starting to render full image for thumbnail...')
-
-        thumbnail_pixbuf = self.render_thumbnail()
-        store_pixbuf(thumbnail_pixbuf, 'Thumbnails/thumbnail.png')
-        logger.debug('total %.3fs spent on thumbnail', time.time() - t2)
-
-        helpers.indent_etree(image)
-        xml = ET.tostring(image, encoding='UTF-8')
+    @staticmethod
+    def _ora_file_key(filename):
+        """Identifies a version of a file, None if it doesn't exist"""
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (os.path.abspath(filename), st.st_mtime, st.st_size)
 
-        write_file_str('stack.xml', xml)
-        z.close()
-        os.rmdir(tempdir)
-        if os.path.exists(filename):
-            os.remove(filename) # windows needs that
-        os.rename(filename + '.tmpsave', filename)
+    def save_ora(self, filename, options=None, **kwargs):
+        """Saves to an OpenRaster file
 
-        logger.info('%.3fs save_ora total', time.time() - t0)
+        The file is written by an `OraSaveJob`, on this thread. The
+        layers that did not change since they were last saved or loaded
+        are copied over from that file.
 
-        return thumbnail_pixbuf
+        The ``save_profile`` keyword argument trades saving speed for
+        file size, see `pixbufsurface.SAVE_PROFILES`. Layers are only
+        copied over if they were saved at least as compact as asked for.
+        """
+        logger.info('save_ora: %r (%r, %r)', filename, options, kwargs)
+        job = OraSaveJob(self, filename, **kwargs)
+        job.write(kwargs.get('feedback_cb'))
+        lazy = self.lazy_layers
+        if lazy is not None and lazy.filename == os.path.abspath(filename):
+            lazy.move_to(dict((l._surface, job.ora_layers[l][1])
+                              for l in job.ora_layers))
+        job.commit()
+        self._ora_saved(job)
+        return job.thumbnail
+
+    def _ora_saved(self, job):
+        # until they change, saving can copy the layers from the file
+        self._ora_file = self._ora_file_key(job.filename)
+        self._ora_layers = job.ora_layers
 
     @staticmethod
     def __xsd2bool(v):
@@ -915,13 +1530,15 @@ class Document():
         if v in ['true', '1']: return True
         else: return False
 
-    def load_ora(self, filename, feedback_cb=None):
-        """Loads from an OpenRaster file"""
+    def load_ora(self, filename, feedback_cb=None, lazy=False):
+        """Loads from an OpenRaster file
+
+        With `lazy`, the layer PNGs are only decoded when their tiles are
+        first needed, by the `LazyLayerLoader` kept as `self.lazy_layers`.
+        The cels around the current frame get loaded in the background.
+        """
         logger.info('load_ora: %r', filename)
         t0 = time.time()
-        tempdir = tempfile.mkdtemp('mypaint')
-        if not isinstance(tempdir, unicode):
-            tempdir = tempdir.decode(sys.getfilesystemencoding())
         z = zipfile.ZipFile(filename)
         logger.debug('mimetype: %r', z.read('mimetype').strip())
         xml = z.read('stack.xml')
@@ -965,64 +1582,91 @@ class Document():
                     logger.warning('ignoring unsupported tag %r', item.tag)
             return res
 
+        # layers are decoded by a pool of threads, and loaded into their
+        # surfaces in order by this one
+        workers = _get_cpu_count()
+        pending = deque()
+        def load_decoded(limit):
+            while len(pending) > limit:
+                layer, src, result = pending.popleft()
+                sshot, cost = _wait_for_result(result, feedback_cb)
+                layer._surface.load_snapshot(sshot)
+                logger.debug('%.3fs loading and converting layer png %s',
+                             cost, src)
+
         self.clear() # this leaves one empty layer
         no_background = True
+        ora_layers = []
+        lazy_layers = None
+        if lazy and hasattr(tiledsurface.Surface, 'set_lazy_loader'):
+            lazy_layers = LazyLayerLoader(filename)
 
         selected_layer = None
-        for layer in get_layers_list(stack):
-            a = layer.attrib
-
-            if 'background_tile' in a:
-                assert no_background
-                try:
-                    logger.debug("background tile: %r", a['background_tile'])
-                    self.set_background(get_pixbuf(a['background_tile']))
-                    no_background = False
+        pool = None
+        if lazy_layers is None:
+            pool = ThreadPool(workers)
+        try:
+            for layer in get_layers_list(stack):
+                a = layer.attrib
+
+                if 'background_tile' in a:
+                    assert no_background
+                    try:
+                        logger.debug("background tile: %r", a['background_tile'])
+                        self.set_background(get_pixbuf(a['background_tile']))
+                        no_background = False
+                        continue
+                    except tiledsurface.BackgroundError, e:
+                        logger.warning('ORA background tile not usable: %r', e)
+
+                src = a.get('src', '')
+                if not src.lower().endswith('.png'):
+                    logger.warning('Ignoring non-png layer %r', src)
                     continue
-                except tiledsurface.BackgroundError, e:
-                    logger.warning('ORA background tile not usable: %r', e)
-
-            src = a.get('src', '')
-            if not src.lower().endswith('.png'):
-                logger.warning('Ignoring non-png layer %r', src)
-                continue
-            name = a.get('name', '')
-            x = int(a.get('x', '0'))
-            y = int(a.get('y', '0'))
-            opac = float(a.get('opacity', '1.0'))
-            compositeop = str(a.get('composite-op', DEFAULT_COMPOSITE_OP))
-            if compositeop not in VALID_COMPOSITE_OPS:
-                compositeop = DEFAULT_COMPOSITE_OP
-            selected = self.__xsd2bool(a.get("selected", 'false'))
-            locked = self.__xsd2bool(a.get("edit-locked", 'false'))
-
-            visible = not 'hidden' in a.get('visibility', 'visible')
-            self.add_layer(insert_idx=0, name=name)
-            t1 = time.time()
-
-            # extract the png form the zip into a file first
-            # the overhead for doing so seems to be neglegible (around 5%)
-            z.extract(src, tempdir)
-            tmp_filename = join(tempdir, src)
-            self.load_layer_from_png(tmp_filename, x, y, feedback_cb)
-            os.remove(tmp_filename)
-
-            layer = self.layers[0]
-
-            self.set_layer_opacity(helpers.clamp(opac, 0.0, 1.0), layer)
-            self.set_layer_compositeop(compositeop, layer)
-            self.set_layer_visibility(visible, layer)
-            self.set_layer_locked(locked, layer)
-            if selected:
-                selected_layer = layer
-            logger.debug('%.3fs loading and converting layer png',
-                         time.time() - t1)
-            # strokemap
-            fname = a.get('mypaint_strokemap_v2', None)
-            if fname:
-                sio = StringIO(z.read(fname))
-                layer.load_strokemap_from_file(sio, x, y)
-                sio.close()
+                name = a.get('name', '')
+                x = int(a.get('x', '0'))
+                y = int(a.get('y', '0'))
+                opac = float(a.get('opacity', '1.0'))
+                compositeop = str(a.get('composite-op', DEFAULT_COMPOSITE_OP))
+                if compositeop not in VALID_COMPOSITE_OPS:
+                    compositeop = DEFAULT_COMPOSITE_OP
+                selected = self.__xsd2bool(a.get("selected", 'false'))
+                locked = self.__xsd2bool(a.get("edit-locked", 'false'))
+
+                visible = not 'hidden' in a.get('visibility', 'visible')
+                self.add_layer(insert_idx=0, name=name)
+                layer = self.layers[0]
+
+                if lazy_layers is not None:
+                    lazy_layers.add(layer._surface, src, x, y)
+                else:
+                    # the zip file is read by this thread only
+                    result = pool.apply_async(_decode_png, (z.read(src), x, y))
+                    pending.append((layer, src, result))
+                    load_decoded(workers * QUEUE_PER_WORKER)
+
+                self.set_layer_opacity(helpers.clamp(opac, 0.0, 1.0), layer)
+                self.set_layer_compositeop(compositeop, layer)
+                self.set_layer_visibility(visible, layer)
+                self.set_layer_locked(locked, layer)
+                if selected:
+                    selected_layer = layer
+                # strokemap
+                fname = a.get('mypaint_strokemap_v2', None)
+                if fname:
+                    sio = StringIO(z.read(fname))
+                    layer.load_strokemap_from_file(sio, x, y)
+                    sio.close()
+                ora_layers.append((layer, src, fname, x, y))
+            load_decoded(0)
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         if len(self.layers) == 1:
             # no assertion (allow empty documents)
@@ -1059,11 +1703,16 @@ class Document():
         self.set_frame_enabled(frame_enab, user_initiated=False)
 
         z.close()
-
-        # remove empty directories created by zipfile's extract()
-        for root, dirs, files in os.walk(tempdir, topdown=False):
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(tempdir)
+        # until they change, saving can copy the layers from this file
+        self._ora_file = self._ora_file_key(filename)
+        # unknown compression, taken to be that of a default save
+        self._ora_layers = dict((l, (l.revision, src, fname, x, y, 0.0,
+                                     'default'))
+                                for l, src, fname, x, y in ora_layers)
+        if lazy_layers is not None:
+            self.lazy_layers = lazy_layers
+            logger.info('%d layers will be loaded on demand',
+                        lazy_layers.pending)
+            self.ani.prefetch_frames()
 
         logger.info('%.3fs load_ora total', time.time() - t0)
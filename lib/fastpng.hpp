@@ -3,19 +3,77 @@
 #include "lcms2.h"
 
 #ifndef SWIG
+// Error pointer of the PNG read and write structs. The interpreter lock
+// is released while rows are (de)compressed, so other Python threads can
+// run meanwhile (for example, encoding other layers). The thread state
+// is kept here so that the error callbacks can take the lock back.
+typedef struct {
+    PyThreadState *thread_state;
+} PngGilGuard;
+
+static void
+png_release_gil(PngGilGuard *guard)
+{
+  guard->thread_state = PyEval_SaveThread();
+}
+
+static void
+png_acquire_gil(PngGilGuard *guard)
+{
+  if (guard && guard->thread_state) {
+    PyEval_RestoreThread(guard->thread_state);
+    guard->thread_state = NULL;
+  }
+}
+
 static void png_write_error_callback(png_structp png_save_ptr, png_const_charp error_msg)
 {
+  png_acquire_gil((PngGilGuard *)png_get_error_ptr(png_save_ptr));
   // we don't trust libpng to call the error callback only once, so
   // check for already-set error
   if (!PyErr_Occurred()) {
     if (!strcmp(error_msg, "Write Error")) {
       PyErr_SetFromErrno(PyExc_IOError);
+    } else if (!strcmp(error_msg, "Out of memory")) {
+      PyErr_NoMemory();
     } else {
       PyErr_Format(PyExc_RuntimeError, "Error writing PNG: %s", error_msg);
     }
   }
   longjmp (png_jmpbuf(png_save_ptr), 1);
 }
+
+// Growing buffer, for encoding PNGs into memory instead of a file
+typedef struct {
+    png_bytep data;
+    png_size_t size;
+    png_size_t capacity;
+} PngMemoryBuffer;
+
+static void
+png_write_memory_callback(png_structp png_ptr, png_bytep data, png_size_t length)
+{
+  PngMemoryBuffer *buf = (PngMemoryBuffer *)png_get_io_ptr(png_ptr);
+  if (buf->size + length > buf->capacity) {
+    png_size_t capacity = buf->capacity ? buf->capacity : 64*1024;
+    while (capacity < buf->size + length) {
+      capacity *= 2;
+    }
+    png_bytep grown = (png_bytep)realloc(buf->data, capacity);
+    if (!grown) {
+      png_error(png_ptr, "Out of memory");
+    }
+    buf->data = grown;
+    buf->capacity = capacity;
+  }
+  memcpy(buf->data + buf->size, data, length);
+  buf->size += length;
+}
+
+static void
+png_flush_memory_callback(png_structp png_ptr)
+{
+}
 #endif
 
 typedef int (*GetScanlinesFunction) (int width, png_bytep *rows_out, int *rowstride_out, void *user_data);
@@ -80,19 +138,34 @@ python_scanline_next(int width, png_bytep *rows_out, int *rowstride_out, void *u
     return PyArray_DIM(arr, 0);
 }
 
-bool
-save_png_fast_progressive_c(char *filename, int w, int h,
-                            bool has_alpha, bool write_legacy_png,
-                            GetScanlinesFunction next_scanline_func,
-                            void *func_state)
+// Trade-offs between saving speed and file size. The default is a
+// balance for interactive saves, see write_png_fast_progressive_c().
+enum PngSaveProfile {
+    PngSaveProfileDefault,
+    PngSaveProfileFast,    // no filtering, zlib level 1
+    PngSaveProfileSmall,   // adaptive filtering, zlib level 9
+    PngSaveProfileStored,  // no filtering, no compression
+    PngSaveProfiles
+};
 
+#ifndef SWIG
+// Writes a PNG either to fp, or to mem if fp is NULL. The scanline
+// function is called with the interpreter lock held, the compression
+// runs without it.
+static bool
+write_png_fast_progressive_c(FILE *fp, PngMemoryBuffer *mem,
+                             int w, int h,
+                             bool has_alpha, bool write_legacy_png,
+                             int save_profile,
+                             GetScanlinesFunction next_scanline_func,
+                             void *func_state)
 {
   png_structp png_ptr = NULL;
   png_infop info_ptr = NULL;
+  PngGilGuard guard = {NULL};
   bool success = false;
 
   int bpc;
-  FILE * fp = NULL;
 
 
   /* TODO: try if this silliness helps
@@ -106,15 +179,8 @@ save_png_fast_progressive_c(char *filename, int w, int h,
   */
 
   bpc = 8;
-  
-  fp = fopen(filename, "wb");
-  if (!fp) {
-    PyErr_SetFromErrno(PyExc_IOError);
-    //PyErr_Format(PyExc_IOError, "Could not open PNG file for writing: %s", filename);
-    goto cleanup;
-  }
 
-  png_ptr = png_create_write_struct(PNG_LIBPNG_VER_STRING, (png_voidp)NULL, png_write_error_callback, NULL);
+  png_ptr = png_create_write_struct(PNG_LIBPNG_VER_STRING, (png_voidp)&guard, png_write_error_callback, NULL);
   if (!png_ptr) {
     PyErr_SetString(PyExc_MemoryError, "png_create_write_struct() failed");
     goto cleanup;
@@ -130,7 +196,12 @@ save_png_fast_progressive_c(char *filename, int w, int h,
     goto cleanup;
   }
 
-  png_init_io(png_ptr, fp);
+  if (fp) {
+    png_init_io(png_ptr, fp);
+  } else {
+    png_set_write_fn(png_ptr, (png_voidp)mem,
+                     png_write_memory_callback, png_flush_memory_callback);
+  }
 
   png_set_IHDR (png_ptr, info_ptr,
                 w, h, bpc,
@@ -145,15 +216,31 @@ save_png_fast_progressive_c(char *filename, int w, int h,
     png_set_sRGB_gAMA_and_cHRM (png_ptr, info_ptr, PNG_sRGB_INTENT_PERCEPTUAL);
   }
 
-  // default (all filters enabled):                 1350ms, 3.4MB
-  //png_set_filter(png_ptr, 0, PNG_FILTER_NONE);  // 790ms, 3.8MB
-  //png_set_filter(png_ptr, 0, PNG_FILTER_PAETH); // 980ms, 3.5MB
-  png_set_filter(png_ptr, 0, PNG_FILTER_SUB);     // 760ms, 3.4MB
-
-  //png_set_compression_level(png_ptr, 0); // 0.49s, 32MB
-  //png_set_compression_level(png_ptr, 1); // 0.98s, 9.6MB
-  png_set_compression_level(png_ptr, 2);   // 1.08s, 9.4MB
-  //png_set_compression_level(png_ptr, 9); // 18.6s, 9.3MB
+  switch (save_profile) {
+  case PngSaveProfileFast:
+    png_set_filter(png_ptr, 0, PNG_FILTER_NONE);
+    png_set_compression_level(png_ptr, 1);
+    break;
+  case PngSaveProfileSmall:
+    png_set_filter(png_ptr, 0, PNG_ALL_FILTERS);
+    png_set_compression_level(png_ptr, 9);
+    break;
+  case PngSaveProfileStored:
+    png_set_filter(png_ptr, 0, PNG_FILTER_NONE);
+    png_set_compression_level(png_ptr, 0);
+    break;
+  default:
+    // default (all filters enabled):                 1350ms, 3.4MB
+    //png_set_filter(png_ptr, 0, PNG_FILTER_NONE);  // 790ms, 3.8MB
+    //png_set_filter(png_ptr, 0, PNG_FILTER_PAETH); // 980ms, 3.5MB
+    png_set_filter(png_ptr, 0, PNG_FILTER_SUB);     // 760ms, 3.4MB
+
+    //png_set_compression_level(png_ptr, 0); // 0.49s, 32MB
+    //png_set_compression_level(png_ptr, 1); // 0.98s, 9.6MB
+    png_set_compression_level(png_ptr, 2);   // 1.08s, 9.4MB
+    //png_set_compression_level(png_ptr, 9); // 18.6s, 9.3MB
+    break;
+  }
 
   png_write_info(png_ptr, info_ptr);
 
@@ -168,28 +255,60 @@ save_png_fast_progressive_c(char *filename, int w, int h,
       png_bytep data = NULL;
       int rowstride = -1;
       const int rows = next_scanline_func(w, &data, &rowstride, func_state);
-      assert(rows > 0);
+      if (rows <= 0) {
+        // the generator raised, or ended early
+        if (!PyErr_Occurred()) {
+          PyErr_SetString(PyExc_RuntimeError, "Not enough scanlines for the PNG");
+        }
+        goto cleanup;
+      }
       assert(rowstride > 0);
       assert(data);
       y += rows;
       png_bytep p = (png_bytep)data;
+      // the rows stay referenced by the scanline generator meanwhile
+      png_release_gil(&guard);
       for (int row=0; row<rows; row++) {
         png_write_row(png_ptr, p);
         p += rowstride;
       }
+      png_acquire_gil(&guard);
     }
     assert(y == h);
     const int status = next_scanline_func(w, NULL, NULL, func_state);
     assert(status == 0); // iterator should be finished
   }
 
+  png_release_gil(&guard);
   png_write_end (png_ptr, NULL);
+  png_acquire_gil(&guard);
 
   success = true;
 
  cleanup:
   if (info_ptr) png_destroy_write_struct(&png_ptr, &info_ptr);
-  if (fp) fclose(fp);
+  else if (png_ptr) png_destroy_write_struct(&png_ptr, NULL);
+  return success;
+}
+#endif
+
+bool
+save_png_fast_progressive_c(char *filename, int w, int h,
+                            bool has_alpha, bool write_legacy_png,
+                            int save_profile,
+                            GetScanlinesFunction next_scanline_func,
+                            void *func_state)
+
+{
+  FILE * fp = fopen(filename, "wb");
+  if (!fp) {
+    PyErr_SetFromErrno(PyExc_IOError);
+    //PyErr_Format(PyExc_IOError, "Could not open PNG file for writing: %s", filename);
+    return false;
+  }
+  const bool success = write_png_fast_progressive_c(fp, NULL, w, h, has_alpha, write_legacy_png,
+                                                    save_profile, next_scanline_func, func_state);
+  fclose(fp);
   return success;
 }
 
@@ -198,7 +317,8 @@ save_png_fast_progressive (char *filename,
                            int w, int h,
                            bool has_alpha,
                            PyObject *data_generator,
-                           bool write_legacy_png) {
+                           bool write_legacy_png,
+                           int save_profile=PngSaveProfileDefault) {
 
     PyObject * result = NULL;
     PythonScanlineGenerator state;
@@ -206,7 +326,7 @@ save_png_fast_progressive (char *filename,
         return result;
     }
     const bool success = save_png_fast_progressive_c(filename, w, h, has_alpha, write_legacy_png,
-                                                     python_scanline_next, (void *)&state);
+                                                     save_profile, python_scanline_next, (void *)&state);
     if (success) {
         result = Py_BuildValue("{}");
     }
@@ -214,11 +334,42 @@ save_png_fast_progressive (char *filename,
     return result;
 }
 
+/** encode_png_fast_progressive:
+ *
+ * Like save_png_fast_progressive(), but returns the PNG file data as a
+ * string instead of writing a file. Other Python threads can run while
+ * the rows are being compressed.
+ */
+
+PyObject *
+encode_png_fast_progressive (int w, int h,
+                             bool has_alpha,
+                             PyObject *data_generator,
+                             bool write_legacy_png,
+                             int save_profile=PngSaveProfileDefault) {
+
+    PyObject * result = NULL;
+    PythonScanlineGenerator state;
+    PngMemoryBuffer mem = {NULL, 0, 0};
+    if (!python_scanline_init(&state, data_generator)) {
+        return result;
+    }
+    const bool success = write_png_fast_progressive_c(NULL, &mem, w, h, has_alpha, write_legacy_png,
+                                                      save_profile, python_scanline_next, (void *)&state);
+    if (success) {
+        result = PyString_FromStringAndSize((const char *)mem.data, mem.size);
+    }
+    free(mem.data);
+    python_scanline_finalize(&state);
+    return result;
+}
+
 #ifndef SWIG
 static void
 png_read_error_callback (png_structp png_read_ptr,
                          png_const_charp error_msg)
 {
+  png_acquire_gil((PngGilGuard *)png_get_error_ptr(png_read_ptr));
   // we don't trust libpng to call the error callback only once, so
   // check for already-set error
   if (!PyErr_Occurred()) {
@@ -230,6 +381,24 @@ png_read_error_callback (png_structp png_read_ptr,
   }
   longjmp (png_jmpbuf(png_read_ptr), 1);
 }
+
+// PNG data in memory, for decoding without a file
+typedef struct {
+    const png_byte *data;
+    png_size_t size;
+    png_size_t pos;
+} PngMemoryReader;
+
+static void
+png_read_memory_callback(png_structp png_ptr, png_bytep data, png_size_t length)
+{
+  PngMemoryReader *reader = (PngMemoryReader *)png_get_io_ptr(png_ptr);
+  if (length > reader->size - reader->pos) {
+    png_error(png_ptr, "Unexpected end of data");
+  }
+  memcpy(data, reader->data + reader->pos, length);
+  reader->pos += length;
+}
 #endif
 
 
@@ -244,31 +413,13 @@ log_lcms2_error (cmsContext context_id, cmsUInt32Number err_code,
 }
 
 
-/** load_png_fast_progressive:
- *
- * @filename: filename to load, in the system encoding
- * @get_buffer_callback: a Python callable returning writeable arrays
- * returns: a dict of flags describing what was read.
- *
- * Read a PNG progressively as 8bit RGBA. The callback must have the signature
- *
- *   numpy_array = callback(full_image_width, full_image_height)
- *
- * @get_buffer_callback  must return a writeable array of the image width.  If
- * the height is smaller than the image height, the callback will be called
- * again until the full image has been processed. The buffer will be written
- * with 8-bit RGBA data
- *
- * In the return dict, a true value for the "possible_legacy_png" key means
- * that no colour management chunks were found. This *might* be due to the PNG
- * file being a file written by an old version of MyPaint. Those versions
- * assumed sRGB in, sRGB out, but also used incorrect nonlinear compositing.
- * The flag is meaningful in (some) ORA files, not so much when loading a PNG.
- */
-
-PyObject *
-load_png_fast_progressive (char *filename,
-                           PyObject *get_buffer_callback)
+#ifndef SWIG
+// Reads a PNG from fp, or from mem if fp is NULL. The callback is called
+// with the interpreter lock held, the decompression and colour
+// conversion run without it.
+static PyObject *
+read_png_fast_progressive_c (FILE *fp, PngMemoryReader *mem,
+                             PyObject *get_buffer_callback)
 {
   // Note: we are not using the method that libpng calls "Reading PNG
   // files progressively". That method would involve feeding the data
@@ -277,8 +428,8 @@ load_png_fast_progressive (char *filename,
 
   png_structp png_ptr = NULL;
   png_infop info_ptr = NULL;
+  PngGilGuard guard = {NULL};
   PyObject * result = NULL;
-  FILE *fp = NULL;
   uint32_t width, height;
   uint32_t rows_left;
   png_byte color_type;
@@ -328,15 +479,7 @@ load_png_fast_progressive (char *filename,
 
   cmsSetLogErrorHandler(log_lcms2_error);
 
-  fp = fopen(filename, "rb");
-  if (!fp) {
-    PyErr_SetFromErrno(PyExc_IOError);
-    //PyErr_Format(PyExc_IOError, "Could not open PNG file for writing: %s",
-    //             filename);
-    goto cleanup;
-  }
-
-  png_ptr = png_create_read_struct (PNG_LIBPNG_VER_STRING, (png_voidp)NULL,
+  png_ptr = png_create_read_struct (PNG_LIBPNG_VER_STRING, (png_voidp)&guard,
                                     png_read_error_callback, NULL);
   if (!png_ptr) {
     PyErr_SetString(PyExc_MemoryError, "png_create_write_struct() failed");
@@ -353,7 +496,11 @@ load_png_fast_progressive (char *filename,
     goto cleanup;
   }
 
-  png_init_io(png_ptr, fp);
+  if (fp) {
+    png_init_io(png_ptr, fp);
+  } else {
+    png_set_read_fn(png_ptr, (png_voidp)mem, png_read_memory_callback);
+  }
 
   png_read_info(png_ptr, info_ptr);
 
@@ -550,6 +697,8 @@ load_png_fast_progressive (char *filename,
       input_buf_row_pointers[row] = input_buffer + (row * input_buf_row_stride);
     }
 
+    // the buffer stays referenced by obj meanwhile
+    png_release_gil(&guard);
     png_read_rows(png_ptr, input_buf_row_pointers, NULL, rows);
     rows_left -= rows;
 
@@ -569,6 +718,7 @@ load_png_fast_progressive (char *filename,
         pyarr_row[pyarr_alpha_byte] = input_row[buf_alpha_byte];
       }
     }
+    png_acquire_gil(&guard);
 
     free(input_buf_row_pointers);
     free(input_buffer);
@@ -586,9 +736,9 @@ load_png_fast_progressive (char *filename,
 
  cleanup:
   if (info_ptr) png_destroy_read_struct (&png_ptr, &info_ptr, NULL);
+  else if (png_ptr) png_destroy_read_struct (&png_ptr, NULL, NULL);
   // libpng's style is to free internally allocated stuff like the icc
   // tables in png_destroy_*(). I think.
-  if (fp) fclose(fp);
   if (input_buffer_profile) cmsCloseProfile(input_buffer_profile);
   if (nparray_data_profile) cmsCloseProfile(nparray_data_profile);
   if (input_buffer_to_nparray) cmsDeleteTransform(input_buffer_to_nparray);
@@ -596,3 +746,66 @@ load_png_fast_progressive (char *filename,
 
   return result;
 }
+#endif
+
+/** load_png_fast_progressive:
+ *
+ * @filename: filename to load, in the system encoding
+ * @get_buffer_callback: a Python callable returning writeable arrays
+ * returns: a dict of flags describing what was read.
+ *
+ * Read a PNG progressively as 8bit RGBA. The callback must have the signature
+ *
+ *   numpy_array = callback(full_image_width, full_image_height)
+ *
+ * @get_buffer_callback  must return a writeable array of the image width.  If
+ * the height is smaller than the image height, the callback will be called
+ * again until the full image has been processed. The buffer will be written
+ * with 8-bit RGBA data
+ *
+ * In the return dict, a true value for the "possible_legacy_png" key means
+ * that no colour management chunks were found. This *might* be due to the PNG
+ * file being a file written by an old version of MyPaint. Those versions
+ * assumed sRGB in, sRGB out, but also used incorrect nonlinear compositing.
+ * The flag is meaningful in (some) ORA files, not so much when loading a PNG.
+ */
+
+PyObject *
+load_png_fast_progressive (char *filename,
+                           PyObject *get_buffer_callback)
+{
+  FILE *fp = fopen(filename, "rb");
+  if (!fp) {
+    PyErr_SetFromErrno(PyExc_IOError);
+    //PyErr_Format(PyExc_IOError, "Could not open PNG file for writing: %s",
+    //             filename);
+    return NULL;
+  }
+  PyObject *result = read_png_fast_progressive_c(fp, NULL, get_buffer_callback);
+  fclose(fp);
+  return result;
+}
+
+/** decode_png_fast_progressive:
+ *
+ * @data: a string holding the PNG file data
+ * @get_buffer_callback: as for load_png_fast_progressive()
+ * returns: a dict of flags describing what was read.
+ *
+ * Like load_png_fast_progressive(), but decodes PNG data from memory.
+ * Other Python threads can run while the rows are being decompressed.
+ */
+
+PyObject *
+decode_png_fast_progressive (PyObject *data,
+                             PyObject *get_buffer_callback)
+{
+  char *buf = NULL;
+  Py_ssize_t size = 0;
+  if (PyString_AsStringAndSize(data, &buf, &size) < 0) {
+    return NULL;
+  }
+  // data is kept alive by the caller's reference
+  PngMemoryReader mem = {(const png_byte *)buf, (png_size_t)size, 0};
+  return read_png_fast_progressive_c(NULL, &mem, get_buffer_callback);
+}
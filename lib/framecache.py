@@ -0,0 +1,312 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Cache of flattened animation frames, used during playback"""
+
+from collections import OrderedDict
+import threading
+import Queue
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy
+
+import mypaintlib
+import pixbufsurface
+import tiledsurface
+
+N = tiledsurface.N
+
+# Default memory budget for the cached frames, in bytes
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+# How many frames ahead of the current one the prefetcher renders
+PREFETCH_FRAMES = 12
+
+# Number of prefetch worker threads
+PREFETCH_WORKERS = 2
+
+
+def frame_rect(bbox, mipmap_level):
+    """Returns the rectangle covering a bbox at a mipmap level
+
+    >>> frame_rect((-3, 0, 10, 7), 1)
+    (-2, 0, 6, 4)
+    """
+    x, y, w, h = bbox
+    fac = 2**mipmap_level
+    x0, y0 = x // fac, y // fac
+    x1, y1 = -(-(x+w) // fac), -(-(y+h) // fac)
+    return x0, y0, x1-x0, y1-y0
+
+
+class FrameCache (object):
+    """LRU store of pre-rendered frames, bounded by a memory budget
+
+    Entries are stored under a hashable key, together with a validation
+    token. A lookup only hits if the token passed in compares equal to the
+    one stored with the entry, which lets callers fold things like layer
+    content revisions into the token instead of having to invalidate
+    entries explicitly. Stale entries are dropped as they are found.
+
+    When the total size of the cached values exceeds the budget, the least
+    recently used entries are evicted.
+
+    >>> cache = FrameCache(budget=10)
+    >>> cache.put('a', 1, 'frame a', 4)
+    >>> cache.put('b', 1, 'frame b', 4)
+    >>> cache.get('a', 1)
+    'frame a'
+    >>> cache.get('a', 2) is None  # stale token
+    True
+    >>> cache.put('a', 2, 'new frame a', 4)
+    >>> cache.put('c', 1, 'frame c', 4)  # evicts 'b', the oldest
+    >>> cache.get('b', 1) is None
+    True
+    >>> cache.nbytes
+    8
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        object.__init__(self)
+        self.budget = budget
+        self._entries = OrderedDict() # key -> (token, value, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Entries are added by the prefetch workers too
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def is_valid(self, key, token):
+        """True if there is an up to date entry, without touching it"""
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] == token
+
+    def get(self, key, token):
+        """Returns the value stored for `key`, or None if missing or stale"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != token:
+                self.nbytes -= entry[2]
+                self.misses += 1
+                return None
+            # Re-insert, making it the most recently used entry
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, token, value, nbytes):
+        """Stores a value, evicting old entries to stay within budget"""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            if nbytes > self.budget:
+                logger.debug("Frame of %d bytes exceeds the cache budget",
+                             nbytes)
+                return
+            self._entries[key] = (token, value, nbytes)
+            self.nbytes += nbytes
+            self._trim()
+
+    def _trim(self):
+        while self.nbytes > self.budget and self._entries:
+            key, (token, value, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+
+    def set_budget(self, budget):
+        """Changes the memory budget, evicting entries if needed"""
+        with self._lock:
+            self.budget = budget
+            self._trim()
+
+    def clear(self):
+        """Drops all entries"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+def _snapshot_tile(tiledict, tx, ty, mipmap_level, memo):
+    """Returns a tile array of a snapshot at a mipmap level, or None
+
+    Snapshots only hold full resolution tiles. Mipmap tiles are built by
+    downscaling, and memoized in `memo` for the duration of one frame.
+    Tiles of a single colour are returned as that colour, a tuple (see
+    tiledsurface.Tile.uniform), so that they stay packed.
+    """
+    if mipmap_level == 0:
+        t = tiledict.get((tx, ty))
+        if t is None:
+            return None
+        # read once, the main thread may unpack the tile meanwhile
+        uniform = t.uniform
+        if uniform is not None:
+            return uniform
+        return t.rgba
+    key = (tx, ty, mipmap_level)
+    if key in memo:
+        return memo[key]
+    srcs = []
+    for x in xrange(2):
+        for y in xrange(2):
+            src = _snapshot_tile(tiledict, tx*2 + x, ty*2 + y,
+                                 mipmap_level-1, memo)
+            if src is not None:
+                srcs.append((x, y, src))
+    res = None
+    colors = [c for x, y, c in srcs if isinstance(c, tuple)]
+    if len(colors) == 4 and len(set(colors)) == 1:
+        # downscaling keeps a single colour as it is
+        res = colors[0]
+    else:
+        for x, y, src in srcs:
+            if res is None:
+                res = numpy.zeros((N, N, 4), 'uint16')
+            if isinstance(src, tuple):
+                res[y*N/2:(y+1)*N/2, x*N/2:(x+1)*N/2] = src
+            else:
+                mypaintlib.tile_downscale_rgba16(src, res, x*N/2, y*N/2)
+    memo[key] = res
+    return res
+
+
+def render_snapshot_frame(rect, mipmap_level, background, layers):
+    """Flattens layer snapshots into a new pixbufsurface.Surface
+
+    :param rect: area to render, in coordinates of the mipmap level
+    :param background: the document's tiledsurface.Background
+    :param layers: list of ``(tiledict, opacity, compositeop)``, bottom to
+      top, with tiledicts taken from surface snapshots
+
+    Only reads from read-only snapshot tiles, so it can be run outside
+    the main thread while the document keeps being edited.
+    """
+    frame = pixbufsurface.Surface(*rect)
+    dst = numpy.empty((N, N, 4), dtype='uint16')
+    memos = [{} for l in layers]
+    for tx, ty in frame.get_tiles():
+        with frame.tile_request(tx, ty, readonly=False) as dst_8bit:
+            background.blit_tile_into(dst, False, tx, ty, mipmap_level)
+            for (tiledict, opacity, mode), memo in zip(layers, memos):
+                src = _snapshot_tile(tiledict, tx, ty, mipmap_level, memo)
+                if src is None:
+                    continue
+                if isinstance(src, tuple):
+                    tiledsurface.composite_uniform(src, dst, False,
+                                                   opacity, mode)
+                    continue
+                tiledsurface.svg2composite_func[mode](src, dst, False,
+                                                     opacity)
+            mypaintlib.tile_convert_rgbu16_to_rgbu8(dst, dst_8bit)
+    return frame
+
+
+class FramePrefetcher (object):
+    """Renders upcoming animation frames into a FrameCache in the background
+
+    The frames after the current one are resolved and snapshotted on the
+    calling (main) thread, which only takes marking the layers' tiles
+    read-only. Compositing happens on worker threads, from the snapshots.
+    """
+
+    def __init__(self, ani, count=PREFETCH_FRAMES, workers=PREFETCH_WORKERS):
+        object.__init__(self)
+        self.ani = ani
+        self.count = count
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._threads = []
+        self._generation = 0
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker,
+                                 name="FramePrefetcher")
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def prefetch(self, idx, mipmap_level=0):
+        """Queues rendering of the frames following the nth one"""
+        ani = self.ani
+        n_frames = len(ani.frames)
+        rect = frame_rect(ani.doc.get_effective_bbox(), mipmap_level)
+        if rect[2] == 0 or rect[3] == 0:
+            return
+        snapshots = {}
+        queued = False
+        for i in xrange(1, min(self.count, n_frames-1) + 1):
+            frame_idx = (idx + i) % n_frames
+            key, token, layers = ani.get_frame_key(frame_idx, mipmap_level)
+            if ani.frame_cache.is_valid(key, token):
+                continue
+            if not all(getattr(l._surface, 'is_loaded', True)
+                       for l, opacity in layers):
+                # snapshotting would load it here, on the main thread,
+                # leave it to the idle loader of the animation
+                continue
+            with self._pending_lock:
+                if key in self._pending:
+                    continue
+                self._pending.add(key)
+            layer_snapshots = []
+            for l, opacity in layers:
+                sshot = snapshots.get(l)
+                if sshot is None:
+                    sshot = l._surface.save_snapshot()
+                    snapshots[l] = sshot
+                layer_snapshots.append((sshot.tiledict, opacity,
+                                        l.compositeop))
+            job = (self._generation, key, token, rect, mipmap_level,
+                   ani.doc.background, layer_snapshots)
+            self._queue.put(job)
+            queued = True
+        if queued:
+            self._start_workers()
+
+    def cancel(self):
+        """Discards the queued work"""
+        self._generation += 1
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+        with self._pending_lock:
+            self._pending.clear()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            generation, key, token, rect, mipmap_level, background, layers = job
+            try:
+                if generation != self._generation:
+                    continue
+                frame = render_snapshot_frame(rect, mipmap_level,
+                                              background, layers)
+                if generation != self._generation:
+                    continue
+                nbytes = frame.ew * frame.eh * 4
+                self.ani.frame_cache.put(key, token, frame, nbytes)
+            except Exception:
+                logger.exception("Failed to prefetch frame %r", key)
+            finally:
+                with self._pending_lock:
+                    self._pending.discard(key)
@@ -6,6 +6,8 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import bisect
+
 DEFAULT_OPACITIES = {
     'cel': 1./2, # The inmediate next and previous cels
     'key': 1./2, # The cel keys that are after and before the current cel 
@@ -28,12 +30,51 @@ DEFAULT_NEXTPREV = {
 }
 
 class Frame(object):
+    # Sheets can have many thousands of frames
+    __slots__ = ('_frames', '_is_key', '_cel', '_skip_visible', 'description')
+
     def __init__(self, is_key=False, cel=None):
-        self.is_key = is_key
+        # FrameList indexing this frame, see FrameList._reindex():
+        self._frames = None
+        self._is_key = is_key
+        self._cel = cel
+        self._skip_visible = False
         self.description = ""
-        self.cel = cel
-        self.skip_visible = False
-    
+
+    def _set(self, name, value):
+        """Set an indexed attribute, keeping the FrameList index updated."""
+        frames = self._frames
+        if frames is None:
+            setattr(self, name, value)
+            return
+        n = frames._unindex_frame(self)
+        setattr(self, name, value)
+        frames._index_frame(self, n)
+
+    @property
+    def is_key(self):
+        return self._is_key
+
+    @is_key.setter
+    def is_key(self, value):
+        self._set('_is_key', value)
+
+    @property
+    def cel(self):
+        return self._cel
+
+    @cel.setter
+    def cel(self, value):
+        self._set('_cel', value)
+
+    @property
+    def skip_visible(self):
+        return self._skip_visible
+
+    @skip_visible.setter
+    def skip_visible(self, value):
+        self._set('_skip_visible', value)
+
     def set_key(self):
         self.is_key = True
     
@@ -53,12 +94,25 @@ class Frame(object):
         self.cel = None
     
 
+def _remove_sorted(positions, n):
+    i = bisect.bisect_left(positions, n)
+    if i < len(positions) and positions[i] == n:
+        del positions[i]
+
+
 class FrameList(list):
     """
     The list of frames that constitutes an animation.
+
+    Navigation queries are answered from an index of the positions of
+    the key frames and of the frames holding cels, and of how many
+    frames hold each cel.  The index is rebuilt lazily after the list
+    changes structurally, and updated in place when the key, cel or
+    skip flags of a frame change.
     
     """
     def __init__(self, length, opacities=None, active_cels=None, nextprev=None):
+        self._indexed = False
         self.append_frames(length)
         self.idx = 0
         if opacities is None:
@@ -133,6 +187,88 @@ class FrameList(list):
         for l in range(length):
             self.insert(self.idx, Frame())
     
+    def _reindex(self):
+        """Rebuild the navigation index from scratch."""
+        self._positions = {}
+        self._keys = []
+        self._cels = []
+        self._visible_cels = []
+        self._cel_positions = {}
+        self._skipped_cels = {}
+        for n, f in enumerate(self):
+            f._frames = self
+            self._positions.setdefault(f, n)
+            if f.is_key and not f.skip_visible:
+                self._keys.append(n)
+            if f.cel is not None:
+                self._cels.append(n)
+                self._cel_positions.setdefault(f.cel, []).append(n)
+                if f.skip_visible:
+                    self._skipped_cels[f.cel] = \
+                        self._skipped_cels.get(f.cel, 0) + 1
+                else:
+                    self._visible_cels.append(n)
+        self._indexed = True
+
+    def _ensure_index(self):
+        if not self._indexed:
+            self._reindex()
+
+    def _unindex_frame(self, frame):
+        """
+        Remove the frame from the index before it changes, and return
+        its position, or None if there is no index to update.
+
+        """
+        if not self._indexed:
+            return None
+        n = self._positions.get(frame)
+        if n is None:
+            # no longer in this list
+            return None
+        if frame.is_key and not frame.skip_visible:
+            _remove_sorted(self._keys, n)
+        cel = frame.cel
+        if cel is not None:
+            _remove_sorted(self._cels, n)
+            positions = self._cel_positions[cel]
+            _remove_sorted(positions, n)
+            if not positions:
+                del self._cel_positions[cel]
+            if frame.skip_visible:
+                count = self._skipped_cels[cel] - 1
+                if count:
+                    self._skipped_cels[cel] = count
+                else:
+                    del self._skipped_cels[cel]
+            else:
+                _remove_sorted(self._visible_cels, n)
+        return n
+
+    def _index_frame(self, frame, n):
+        """Add back a changed frame at the position _unindex_frame()
+        returned."""
+        if n is None or not self._indexed:
+            return
+        if frame.is_key and not frame.skip_visible:
+            bisect.insort(self._keys, n)
+        cel = frame.cel
+        if cel is not None:
+            bisect.insort(self._cels, n)
+            bisect.insort(self._cel_positions.setdefault(cel, []), n)
+            if frame.skip_visible:
+                self._skipped_cels[cel] = self._skipped_cels.get(cel, 0) + 1
+            else:
+                bisect.insort(self._visible_cels, n)
+
+    def _position(self, frame):
+        """Like index() but using the navigation index."""
+        self._ensure_index()
+        n = self._positions.get(frame)
+        if n is None:
+            raise ValueError("Frame is not in the list.")
+        return n
+
     def get_selected(self):
         return self[self.idx]
     
@@ -143,10 +279,10 @@ class FrameList(list):
     
     def goto_next(self, with_cel=False):
         if with_cel:
-            next_frame = self._get_next_frame_with_cel()
-            if next_frame is None:
+            n = self._next_frame_with_cel_idx()
+            if n is None:
                 raise IndexError("There is no next frame with cel.")
-            self.idx = self.index(next_frame)
+            self.idx = n
             return
         if not self.has_next():
             raise IndexError("Trying to go to next at the last frame.")
@@ -154,10 +290,10 @@ class FrameList(list):
     
     def goto_previous(self, with_cel=False):
         if with_cel:
-            prev_frame = self._get_previous_frame_with_cel()
-            if prev_frame is None:
+            n = self._previous_frame_with_cel_idx()
+            if n is None:
                 raise IndexError("There is no previous frame with cel.")
-            self.idx = self.index(prev_frame)
+            self.idx = n
             return
         if not self.has_previous():
             raise IndexError("Trying to go to previous at the first frame.")
@@ -165,64 +301,81 @@ class FrameList(list):
     
     def has_next(self, with_cel=False):
         if with_cel:
-            return self._get_next_frame_with_cel() is not None
+            return self._next_frame_with_cel_idx() is not None
         if self.idx == len(self)-1:
             return False
         return True
     
     def has_previous(self, with_cel=False):
         if with_cel:
-            return self._get_previous_frame_with_cel() is not None
+            return self._previous_frame_with_cel_idx() is not None
         if self.idx == 0:
             return False
         return True
+
+    def _next_key_idx(self, n=None):
+        """Return the position of the first key frame after the nth."""
+        if n is None:
+            n = self.idx
+        self._ensure_index()
+        i = bisect.bisect_right(self._keys, n)
+        if i < len(self._keys):
+            return self._keys[i]
+        return None
+
+    def _previous_key_idx(self, n=None):
+        """Return the position of the last key frame before the nth."""
+        if n is None:
+            n = self.idx
+        self._ensure_index()
+        i = bisect.bisect_left(self._keys, n)
+        if i > 0:
+            return self._keys[i-1]
+        return None
     
     def get_next_key(self):
-        for f in (self[self.idx+1:]):
-            if f.is_key and not f.skip_visible:
-                return f
-        return None
+        n = self._next_key_idx()
+        if n is None:
+            return None
+        return self[n]
     
     def get_previous_key(self):
-        for f in reversed(self[:self.idx]):
-            if f.is_key and not f.skip_visible:
-                return f
-        return None
+        n = self._previous_key_idx()
+        if n is None:
+            return None
+        return self[n]
     
     def goto_next_key(self):
-        f = self.get_next_key()
-        if f is None:
+        n = self._next_key_idx()
+        if n is None:
             raise IndexError("Trying to go to inexistent next keyframe.")
-        self.idx = self.index(f)
+        self.idx = n
     
     def goto_previous_key(self):
-        f = self.get_previous_key()
-        if f is None:
+        n = self._previous_key_idx()
+        if n is None:
             raise IndexError("Trying to go to inexistent previous keyframe.")
-        self.idx = self.index(f)
+        self.idx = n
     
     def has_next_key(self):
-        f = self.get_next_key()
-        if f is None:
-            return False
-        return True
+        return self._next_key_idx() is not None
     
     def has_previous_key(self):
-        f = self.get_previous_key()
-        if f is None:
-            return False
-        return True
+        return self._previous_key_idx() is not None
     
     def cel_at(self, n):
         """
         Return the cel at the nth frame.
         
         """
-        if self[n].cel is not None:
-            return self[n].cel
-        for f in reversed(self[:n]):
-            if f.cel is not None:
-                return f.cel
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError("list index out of range")
+        self._ensure_index()
+        i = bisect.bisect_right(self._cels, n)
+        if i > 0:
+            return self[self._cels[i-1]].cel
         return None
     
     def get_previous_cel(self):
@@ -231,9 +384,9 @@ class FrameList(list):
         current frame.
         
         """
-        prev_frame = self._get_previous_frame_with_cel()
-        if prev_frame is not None:
-            return prev_frame.cel
+        n = self._previous_frame_with_cel_idx()
+        if n is not None:
+            return self[n].cel
         return None
 
     def get_next_cel(self):
@@ -242,45 +395,63 @@ class FrameList(list):
         current frame.
         
         """
-        next_frame = self._get_next_frame_with_cel()
-        if next_frame is not None:
-            return next_frame.cel
+        n = self._next_frame_with_cel_idx()
+        if n is not None:
+            return self[n].cel
         return None
 
     def get_all_cels(self):
-        cels = []
-        for f in self:
-            if f.cel is not None and f.cel not in cels:
-                cels.append(f.cel)
-        return cels
+        self._ensure_index()
+        positions = self._cel_positions
+        return sorted(positions, key=lambda cel: positions[cel][0])
 
-    def _get_previous_frame_with_cel(self):
+    def _previous_frame_with_cel_idx(self):
         """
-        Return the previous frame with a cel that is different than
-        the cel of the current frame.
+        Return the position of the previous frame with a cel that is
+        different than the cel of the current frame.
         
         """
         cur_cel = self.cel_at(self.idx)
         if not cur_cel:
             return None
-        for f in reversed(self[:self.idx]):
-            if f.cel is not None and f.cel != cur_cel and not f.skip_visible:
-                return f
+        visible_cels = self._visible_cels
+        i = bisect.bisect_left(visible_cels, self.idx) - 1
+        while i >= 0:
+            n = visible_cels[i]
+            if self[n].cel != cur_cel:
+                return n
+            i -= 1
         return None
     
-    def _get_next_frame_with_cel(self):
+    def _next_frame_with_cel_idx(self):
         """
-        Return the next frame with a cel that is different than the
-        cel of the current frame.
+        Return the position of the next frame with a cel that is
+        different than the cel of the current frame.
         
         """
         cur_cel = self.cel_at(self.idx)
         if not cur_cel:
             return None
-        for f in (self[self.idx+1:]):
-            if f.cel is not None and f.cel != cur_cel and not f.skip_visible:
-                return f
+        visible_cels = self._visible_cels
+        i = bisect.bisect_right(visible_cels, self.idx)
+        while i < len(visible_cels):
+            n = visible_cels[i]
+            if self[n].cel != cur_cel:
+                return n
+            i += 1
         return None
+
+    def _get_previous_frame_with_cel(self):
+        n = self._previous_frame_with_cel_idx()
+        if n is None:
+            return None
+        return self[n]
+
+    def _get_next_frame_with_cel(self):
+        n = self._next_frame_with_cel_idx()
+        if n is None:
+            return None
+        return self[n]
     
     def cel_for_frame(self, frame):
         """
@@ -291,7 +462,7 @@ class FrameList(list):
         to be shown in the animation at the nth frame.
         
         """
-        return self.cel_at(self.index(frame))
+        return self.cel_at(self._position(frame))
     
     def get_opacities(self):
         """
@@ -299,10 +470,41 @@ class FrameList(list):
 
         To draw the current cel, the artist have to see it 100%
         opaque, and she may want to see the neighbour cels
-        transparented.
+        transparented.  The second map tells which of the cels are
+        visible at all.  See get_onion_skin() for the rules.
 
         """
         opacities = {}
+        visible = {}
+        for cel, (opa, nextprev) in self.get_onion_skin().iteritems():
+            opacities[cel] = opa
+            visible[cel] = opa != 0
+        return opacities, visible
+
+    def get_onion_skin(self):
+        """
+        Return a map of cels to (opacity, side) pairs.
+
+        The side is 'previous' or 'next' for the cels shown as onion
+        skin before or after the current frame, and None for the
+        current cel and the skipped ones.
+
+        When a cel appears in several frames, the first rule below that
+        matches one of them wins:
+
+        - explicitly skipped cels are hidden, unless current
+        - the current cel is fully opaque
+        - the previous and next cels
+        - the cels of the previous and next keys
+        - the inbetweens, forwards and then backwards from the
+          current frame until the next and previous keys
+        - the other cels after the next key, then before the
+          previous key
+
+        """
+        self._ensure_index()
+        idx = self.idx
+        skin = {}
 
         def get_opa(nextprev, c):
             can_nextprev = self.nextprev[nextprev]
@@ -310,93 +512,94 @@ class FrameList(list):
                 return self.converted_opacities[c]
             return 0
 
-        # explicit skip of cels:
-        for frame in self:
-            if frame.skip_visible:
-                opacities[frame.cel] = 0
+        prevkey_idx = self._previous_key_idx()
+        if prevkey_idx is None:
+            prevkey_idx = 0
+            prevkey_cel = None
+        else:
+            prevkey_cel = self.cel_at(prevkey_idx)
+        nextkey_idx = self._next_key_idx()
+        if nextkey_idx is None:
+            nextkey_idx = len(self)-1
+            nextkey_cel = None
+        else:
+            nextkey_cel = self.cel_at(nextkey_idx)
+
+        # For each cel, the rank of the first rule that applies to one
+        # of its frames, and whether that frame is a key.  Found by
+        # bisecting the positions of the cel, so the cost depends on
+        # the number of different cels, not on the length of the sheet.
+        best = {}
+        for cel, positions in self._cel_positions.iteritems():
+            if cel in self._skipped_cels:
+                # explicit skip of cels:
+                skin[cel] = (0, None)
+            i = bisect.bisect_left(positions, idx)
+            if i < len(positions) and positions[i] < nextkey_idx:
+                # inbetweens after the current frame
+                best[cel] = (0, False)
+                continue
+            j = bisect.bisect_left(positions, prevkey_idx)
+            if j < len(positions) and positions[j] < idx:
+                # inbetweens before the current frame
+                best[cel] = (1, False)
+                continue
+            k = bisect.bisect_left(positions, nextkey_idx)
+            if k < len(positions):
+                best[cel] = (2, self[positions[k]].is_key)
+            else:
+                best[cel] = (3, self[positions[0]].is_key)
 
         # current cel, always full opacity:
-        cel = self.cel_for_frame(self.get_selected())
+        cel = self.cel_at(idx)
         if cel:
-            opacities[cel] = 1
-
-        # next:
-        cel = self.get_previous_cel()
-        if cel and cel not in opacities.keys():
-            opacities[cel] = get_opa('previous', 'cel')
-
-        # previous:
-        cel = self.get_next_cel()
-        if cel and cel not in opacities.keys():
-            opacities[cel] = get_opa('next', 'cel')
-
-        # previous key:
-        prevkey_idx = 0
-        if self.has_previous_key():
-            prevkey = self.get_previous_key()
-            prevkey_idx = self.index(prevkey)
-            cel = self.cel_for_frame(prevkey)
-            if cel and cel not in opacities.keys():
-                opacities[cel] = get_opa('previous', 'key')
-        
-        # next key:
-        nextkey_idx = len(self)-1
-        if self.has_next_key():
-            nextkey = self.get_next_key()
-            nextkey_idx = self.index(nextkey)
-            cel = self.cel_for_frame(nextkey)
-            if cel and cel not in opacities.keys():
-                opacities[cel] = get_opa('next', 'key')
-        
-        def has_cel(f):
-            return f.cel is not None
-        
-        # inbetweens:
-        next_inbetweens_range = self[self.idx:nextkey_idx]
-        for frame in filter(has_cel, next_inbetweens_range):
-            cel = frame.cel
-            if cel not in opacities.keys():
-                opacities[cel] = get_opa('next', 'inbetweens')
-        prev_inbetweens_range = self[prevkey_idx:self.idx]
-        for frame in filter(has_cel, prev_inbetweens_range):
-            cel = frame.cel
-            if cel not in opacities.keys():
-                opacities[cel] = get_opa('previous', 'inbetweens')
-        
-        # frames outside inmediate keys:
-        next_outside_range = self[nextkey_idx:]
-        for frame in filter(has_cel, next_outside_range):
-            cel = frame.cel
-            if cel not in opacities.keys():
-                if frame.is_key:
-                    opacities[cel] = get_opa('next', 'other keys')
-                else:
-                    opacities[cel] = get_opa('next', 'other')
-
-        prev_outside_range = self[:prevkey_idx]
-        for frame in filter(has_cel, prev_outside_range):
-            cel = frame.cel
-            if cel not in opacities.keys():
-                if frame.is_key:
-                    opacities[cel] = get_opa('previous', 'other keys')
-                else:
-                    opacities[cel] = get_opa('previous', 'other')
-        
-        visible = {}
-        for cel, opa in opacities.items():
-            visible[cel] = True
-            if opa == 0:
-                visible[cel] = False
-
-#        print opacities, visible
-        return opacities, visible
+            skin[cel] = (1, None)
+
+        candidates = [
+            (self.get_previous_cel(), 'previous', 'cel'),
+            (self.get_next_cel(), 'next', 'cel'),
+            (prevkey_cel, 'previous', 'key'),
+            (nextkey_cel, 'next', 'key'),
+        ]
+        for cel, nextprev, c in candidates:
+            if cel and cel not in skin:
+                skin[cel] = (get_opa(nextprev, c), nextprev)
+
+        for cel, (rank, is_key) in best.iteritems():
+            if cel in skin:
+                continue
+            if rank == 0:
+                skin[cel] = (get_opa('next', 'inbetweens'), 'next')
+            elif rank == 1:
+                skin[cel] = (get_opa('previous', 'inbetweens'), 'previous')
+            else:
+                nextprev = 'next' if rank == 2 else 'previous'
+                c = 'other keys' if is_key else 'other'
+                skin[cel] = (get_opa(nextprev, c), nextprev)
+
+        return skin
 
     def count_cel(self, item):
-        count = 0
-        for f in self:
-            if f.cel and f.cel == item:
-                count += 1
-        return count
+        self._ensure_index()
+        return len(self._cel_positions.get(item, ()))
+
+
+def _invalidating(name):
+    """Wrap a list method so that it drops the navigation index."""
+    method = getattr(list, name)
+    def wrapper(self, *args):
+        self._indexed = False
+        return method(self, *args)
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+for _name in ('append', 'extend', 'insert', 'pop', 'remove', 'reverse',
+              'sort', '__setitem__', '__delitem__', '__setslice__',
+              '__delslice__', '__iadd__', '__imul__'):
+    setattr(FrameList, _name, _invalidating(_name))
+del _name
+
 
 def print_list(frames):
     """
@@ -810,6 +1013,50 @@ True
 >>> set(frames.get_opacities()[1].items()) == set([('a', False), ('b', True), ('c', False)])
 True
 
+
+Keeping the index updated
+-------------------------
+
+>>> frames = FrameList(6)
+>>> frames[1].add_cel('a')
+>>> frames[4].add_cel('b')
+>>> frames.cel_at(3), frames.cel_at(5), frames.count_cel('a')
+('a', 'b', 1)
+
+>>> frames[3].add_cel('a')
+>>> frames[4].set_key()
+>>> frames.cel_at(3), frames.count_cel('a'), frames.index(frames.get_next_key())
+('a', 2, 4)
+
+>>> frames.select(1)
+>>> frames.get_next_cel()
+'b'
+
+>>> frames[4].skip_visible = True
+>>> frames.get_next_cel() is None, frames.has_next_key()
+(True, False)
+
+>>> removed = frames.remove_frames(2)
+>>> removed[0].remove_cel()
+>>> frames.cel_at(1), frames.count_cel('a')
+('a', 1)
+
+>>> frames.insert(0, Frame(cel='c'))
+>>> frames.cel_at(0), frames.get_all_cels()
+('c', ['c', 'a', 'b'])
+
+
+Sides of the onion skin
+-----------------------
+
+>>> frames = FrameList(5)
+>>> frames[0].add_cel('a')
+>>> frames[2].add_cel('b')
+>>> frames[4].add_cel('c')
+>>> frames.select(2)
+>>> sorted(frames.get_onion_skin().items())
+[('a', (0.5, 'previous')), ('b', (1, None)), ('c', (0.5, 'next'))]
+
 """)
 
 import doctest
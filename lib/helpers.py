@@ -7,7 +7,7 @@
 # (at your option) any later version.
 
 from math import floor, ceil, isnan
-import os, sys, hashlib, zipfile, colorsys, urllib, gc
+import os, sys, hashlib, zipfile, colorsys, urllib, gc, shutil
 import numpy
 import logging
 logger = logging.getLogger(__name__)
@@ -381,6 +381,19 @@ def expanduser_unicode(s):
     return s
 
 
+def link_or_copy(src, dst):
+    """Hard-links a file to a new name, or copies it if links fail.
+
+    An existing file at `dst` is replaced.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+
 def escape(u, quot=False, apos=False):
     """Escapes a Unicode string for use in XML/HTML.
 
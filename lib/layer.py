@@ -83,6 +83,10 @@ class Layer (object):
         self.locked = False
         self.compositeop = compositeop
 
+        #: Content revision, bumped whenever the surface reports a change.
+        #: Caches of rendered layer data can compare against this.
+        self.revision = 0
+
         #: List of content observers
         #: These callbacks are invoked when the contents of the layer change,
         #: with the bounding box of the changed region (x, y, w, h).
@@ -94,6 +98,7 @@ class Layer (object):
         self.clear()
 
     def _notify_content_observers(self, *args):
+        self.revision += 1
         for f in self.content_observers:
             f(*args)
 
@@ -114,6 +119,11 @@ class Layer (object):
         return self._surface.is_empty()
 
     def save_as_png(self, filename, *args, **kwargs):
+        """Saves the layer as a PNG file
+
+        Keyword arguments are passed on to `pixbufsurface.save_as_png()`,
+        including ``save_profile`` to trade saving speed for file size.
+        """
         self._surface.save_as_png(filename, *args, **kwargs)
 
     def stroke_to(self, brush, x, y, pressure, xtilt, ytilt, dtime):
@@ -269,19 +279,43 @@ class Layer (object):
             else:
                 assert False, 'invalid strokemap'
 
-    def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
-        self._surface.composite_tile(
-            dst, dst_has_alpha, tx, ty,
-            mipmap_level=mipmap_level,
-            opacity=self.effective_opacity,
-            mode=self.compositeop
-            )
+    def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0,
+                       opacity=None, tint=None):
+        """Composite one tile of this layer over a NumPy array
 
-    def merge_into(self, dst, strokemap=True):
+        :param opacity: used instead of the layer's effective opacity
+        :param tint: RGB color, components in the range 0..1, the colors
+          of the layer are mixed halfway with before compositing
+        """
+        if opacity is None:
+            opacity = self.effective_opacity
+        if tint is None:
+            self._surface.composite_tile(
+                dst, dst_has_alpha, tx, ty,
+                mipmap_level=mipmap_level,
+                opacity=opacity,
+                mode=self.compositeop
+                )
+            return
+        N = tiledsurface.N
+        src = zeros((N, N, 4), dtype='uint16')
+        self._surface.composite_tile(src, True, tx, ty,
+                                     mipmap_level=mipmap_level)
+        # Premultiplied, so the tint color is scaled by alpha
+        alpha = src[:,:,3].astype('uint32')
+        for i, c in enumerate(tint):
+            tinted = (src[:,:,i] + alpha * int(c * (1<<15))/(1<<15)) / 2
+            src[:,:,i] = tinted
+        func = tiledsurface.svg2composite_func[self.compositeop]
+        func(src, dst, dst_has_alpha, opacity)
+
+    def merge_into(self, dst, strokemap=True, opacity=None, tint=None):
         """Merge this layer into another, modifying only the target
 
         :param dst: The target layer
         :param strokemap: Set to false to ignore the layers' strokemaps.
+        :param opacity: used instead of the layer's effective opacity
+        :param tint: see composite_tile()
 
         The target layer must always have an alpha channel. After this
         operation, the target layer's opacity is set to 1.0 and it is made
@@ -301,12 +335,12 @@ class Layer (object):
             dst.visible = True
         # We must respect layer visibility, because saving a
         # transparent PNG just calls this function for each layer.
-        src = self
-        for tx, ty in src._surface.get_tiles():
+        if opacity is None:
+            opacity = self.effective_opacity
+        for tx, ty in self._surface.get_tiles():
             with dst._surface.tile_request(tx, ty, readonly=False) as surf:
-                src._surface.composite_tile(surf, True, tx, ty,
-                    opacity=self.effective_opacity,
-                    mode=self.compositeop)
+                self.composite_tile(surf, True, tx, ty, opacity=opacity,
+                                    tint=tint)
 
     def convert_to_normal_mode(self, get_bg):
         """
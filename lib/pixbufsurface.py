@@ -112,6 +112,24 @@ class Surface (object):
 # throttle excesssive calls to the save/render feedback_cb
 TILES_PER_CALLBACK = 256
 
+# PNG save profiles, trading saving speed against file size
+SAVE_PROFILES = {
+    'default': mypaintlib.PngSaveProfileDefault,
+    'fast': mypaintlib.PngSaveProfileFast,    # autosaves and scraps
+    'small': mypaintlib.PngSaveProfileSmall,  # archives and deliverables
+    'stored': mypaintlib.PngSaveProfileStored,
+    }
+
+# Profile names, from the largest files to the smallest
+SAVE_PROFILES_BY_SIZE = ('stored', 'fast', 'default', 'small')
+
+def get_save_profile(kwargs):
+    """Returns the name of the save profile asked for by save kwargs"""
+    name = kwargs.get('save_profile') or 'default'
+    if name not in SAVE_PROFILES:
+        raise ValueError('Unknown PNG save profile %r' % (name,))
+    return name
+
 def render_as_pixbuf(surface, *rect, **kwargs):
     alpha = kwargs.get('alpha', False)
     mipmap_level = kwargs.get('mipmap_level', 0)
@@ -129,10 +147,10 @@ def render_as_pixbuf(surface, *rect, **kwargs):
             tn += 1
     return s.pixbuf
 
-def save_as_png(surface, filename, *rect, **kwargs):
+def _png_scanlines(surface, rect, kwargs):
+    """Returns the size and a scanline generator for saving a PNG"""
     alpha = kwargs['alpha']
     feedback_cb = kwargs.get('feedback_cb', None)
-    write_legacy_png = kwargs.get("write_legacy_png", True)
     if not rect:
         rect = surface.get_bbox()
     x, y, w, h = rect
@@ -181,8 +199,33 @@ def save_as_png(surface, filename, *rect, **kwargs):
                 res = res[y-render_ty*N:,:,:]
             yield res
 
+    return w, h, render_tile_scanlines()
+
+def save_as_png(surface, filename, *rect, **kwargs):
+    """Saves a rectangle of a surface as a PNG file
+
+    The ``save_profile`` keyword argument names one of `SAVE_PROFILES`:
+    "fast" saves quickly to larger files, "small" takes its time to make
+    them as small as possible, "stored" does not compress at all.
+    """
+    save_profile = SAVE_PROFILES[get_save_profile(kwargs)]
+    w, h, scanlines = _png_scanlines(surface, rect, kwargs)
+    write_legacy_png = kwargs.get("write_legacy_png", True)
     filename_sys = filename.encode(sys.getfilesystemencoding())
     # FIXME: should not do that, should use open(unicode_object)
-    mypaintlib.save_png_fast_progressive(filename_sys, w, h, alpha,
-                                         render_tile_scanlines(),
-                                         write_legacy_png)
+    mypaintlib.save_png_fast_progressive(filename_sys, w, h, kwargs['alpha'],
+                                         scanlines, write_legacy_png,
+                                         save_profile)
+
+def encode_as_png(surface, *rect, **kwargs):
+    """Like save_as_png(), but returns the PNG data as a string
+
+    The interpreter lock is released while the data is compressed, so
+    surfaces can be encoded in parallel by threads.
+    """
+    save_profile = SAVE_PROFILES[get_save_profile(kwargs)]
+    w, h, scanlines = _png_scanlines(surface, rect, kwargs)
+    write_legacy_png = kwargs.get("write_legacy_png", True)
+    return mypaintlib.encode_png_fast_progressive(w, h, kwargs['alpha'],
+                                                  scanlines, write_legacy_png,
+                                                  save_profile)
@@ -60,6 +60,43 @@ void tile_downscale_rgba16(PyObject *src, PyObject *dst, int dst_x, int dst_y) {
 
 }
 
+// Downscales many tiles at once, each into a quarter of another, like
+// tile_downscale_rgba16(). Used to regenerate all dirty tiles of a mipmap
+// level in one go, spread over the cores. `jobs` is a list of (src, dst,
+// dst_x, dst_y) tuples, no two of them writing the same quarter.
+void tile_downscale_rgba16_many(PyObject *jobs) {
+
+#ifdef HEAVY_DEBUG
+  assert(PyList_Check(jobs));
+  for (int i = 0; i < PyList_GET_SIZE(jobs); i++) {
+    PyObject *job = PyList_GET_ITEM(jobs, i);
+    assert(PyTuple_Check(job));
+    assert(PyTuple_GET_SIZE(job) == 4);
+    assert(PyArray_ISCARRAY((PyArrayObject*)PyTuple_GET_ITEM(job, 0)));
+    assert(PyArray_ISCARRAY((PyArrayObject*)PyTuple_GET_ITEM(job, 1)));
+    assert(PyInt_Check(PyTuple_GET_ITEM(job, 2)));
+    assert(PyInt_Check(PyTuple_GET_ITEM(job, 3)));
+  }
+#endif
+
+  const int n = PyList_GET_SIZE(jobs);
+
+  // Without the GIL, only reading the tuples and arrays, which the list
+  // keeps alive meanwhile.
+  Py_BEGIN_ALLOW_THREADS
+#pragma omp parallel for schedule(dynamic) if (n > 8)
+  for (int i = 0; i < n; i++) {
+    PyObject *job = PyList_GET_ITEM(jobs, i);
+    PyArrayObject* src_arr = (PyArrayObject*)PyTuple_GET_ITEM(job, 0);
+    PyArrayObject* dst_arr = (PyArrayObject*)PyTuple_GET_ITEM(job, 1);
+    tile_downscale_rgba16_c((uint16_t*)PyArray_DATA(src_arr), PyArray_STRIDES(src_arr)[0],
+                            (uint16_t*)PyArray_DATA(dst_arr), PyArray_STRIDES(dst_arr)[0],
+                            PyInt_AS_LONG(PyTuple_GET_ITEM(job, 2)),
+                            PyInt_AS_LONG(PyTuple_GET_ITEM(job, 3)));
+  }
+  Py_END_ALLOW_THREADS
+}
+
 
 #include "compositing.hpp"
 #include "blendmodes.hpp"
@@ -154,6 +191,31 @@ void tile_clear(PyObject * dst) {
   }
 }
 
+// whether all pixels of a tile are the same, e.g. after a fill
+// (returns at the first pixel that differs, so it is cheap on most tiles)
+bool tile_is_uniform(PyObject * src) {
+  PyArrayObject* src_arr = ((PyArrayObject*)src);
+
+#ifdef HEAVY_DEBUG
+  assert(PyArray_Check(src));
+  assert(PyArray_DIM(src_arr, 0) == MYPAINT_TILE_SIZE);
+  assert(PyArray_DIM(src_arr, 1) == MYPAINT_TILE_SIZE);
+  assert(PyArray_DIM(src_arr, 2) == 4);
+  assert(PyArray_TYPE(src_arr) == NPY_UINT16);
+  assert(PyArray_ISCARRAY(src_arr));
+#endif
+
+  const uint16_t *src_p = (uint16_t*)PyArray_DATA(src_arr);
+  const uint16_t *end_p = src_p + MYPAINT_TILE_SIZE*MYPAINT_TILE_SIZE*4;
+  const uint16_t r = src_p[0], g = src_p[1], b = src_p[2], a = src_p[3];
+  for (src_p += 4; src_p < end_p; src_p += 4) {
+    if (src_p[0] != r || src_p[1] != g || src_p[2] != b || src_p[3] != a) {
+      return false;
+    }
+  }
+  return true;
+}
+
 // noise used for dithering (the same for each tile)
 static const int dithering_noise_size = MYPAINT_TILE_SIZE*MYPAINT_TILE_SIZE*sizeof(uint16_t);
 static uint16_t dithering_noise[dithering_noise_size];
@@ -0,0 +1,99 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Wall-time clock for animation playback"""
+
+import time
+
+
+class PlaybackClock (object):
+    """Schedules animation frames against wall time
+
+    Frame n is due at ``start + n/framerate``. Rather than counting timer
+    ticks, which drift whenever a frame takes longer to show than the
+    interval, each tick asks the clock how many frames to advance: if
+    presenting fell behind, the frames whose time has already passed are
+    dropped. The delay until the next tick is measured to the next
+    deadline, so rounding errors in the timer interval do not accumulate.
+
+    >>> now = [0.0]
+    >>> clock = PlaybackClock(24.0, timer=lambda: now[0])
+    >>> clock.start()
+    >>> clock.next_delay()
+    41
+    >>> now[0] = 0.042
+    >>> clock.tick()
+    1
+    >>> now[0] = 0.2  # a slow frame: frames 2 and 3 were missed
+    >>> clock.tick()
+    3
+    >>> clock.frame, clock.presented, clock.dropped
+    (4, 2, 2)
+    >>> clock.next_delay()  # frame 5 is due at 0.2083
+    8
+    >>> round(clock.achieved_fps, 1)
+    10.0
+    """
+
+    def __init__(self, framerate, timer=time.time):
+        object.__init__(self)
+        self.framerate = float(framerate)
+        self._timer = timer
+        self._start = None
+        #: Number of the frame due last
+        self.frame = 0
+        #: Frames presented and skipped since start()
+        self.presented = 0
+        self.dropped = 0
+
+    def start(self):
+        """Starts counting, with frame 0 due now"""
+        self._start = self._timer()
+        self.frame = 0
+        self.presented = 0
+        self.dropped = 0
+
+    def set_framerate(self, framerate):
+        """Changes the rate, keeping the current frame's deadline"""
+        framerate = float(framerate)
+        if self._start is not None:
+            due = self._start + self.frame / self.framerate
+            self._start = due - self.frame / framerate
+        self.framerate = framerate
+
+    def tick(self):
+        """Returns how many frames to advance to show the one now due
+
+        Always at least 1, since ticks are only meant to happen once the
+        next frame is due. Frames skipped over count as dropped.
+        """
+        elapsed = self._timer() - self._start
+        due = int(elapsed * self.framerate)
+        steps = max(1, due - self.frame)
+        self.dropped += steps - 1
+        self.presented += 1
+        self.frame += steps
+        return steps
+
+    def next_delay(self):
+        """Returns the time until the next frame is due, in milliseconds"""
+        due = self._start + (self.frame + 1) / self.framerate
+        return max(0, int((due - self._timer()) * 1000))
+
+    @property
+    def achieved_fps(self):
+        """Frames actually presented per second since start()"""
+        elapsed = self._timer() - self._start
+        if elapsed <= 0:
+            return 0.0
+        return self.presented / elapsed
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -9,14 +9,121 @@
 
 #include "pythontiledsurface.h"
 
+#include <map>
+#include <utility>
+
+extern "C" {
+#include "operationqueue.h"
+}
+
+// Tile buffers handed out by tiledsurface.py since begin_atomic(). They
+// stay valid until end_atomic(), see MyPaintSurface._get_tile_numpy().
+// Entries requested for reading only may be shared with snapshots, or
+// be the transparent tile, so they can't be handed out for writing.
+typedef struct {
+    uint16_t *buffer;
+    bool writable;
+} TileCacheEntry;
+
+typedef std::map<std::pair<int, int>, TileCacheEntry> TileCache;
+
 struct _MyPaintPythonTiledSurface {
     MyPaintTiledSurface parent;
     PyObject * py_obj;
+    int atomic; // begin_atomic() nesting, the cache is used while > 0
+    TileCache *tile_cache;
 };
 
 // Forward declare
 void free_tiledsurf(MyPaintSurface *surface);
 
+static bool
+tile_cache_lookup(MyPaintPythonTiledSurface *self, MyPaintTileRequest *request)
+{
+    bool found = false;
+#pragma omp critical (tile_cache)
+{
+    TileCache::iterator it = self->tile_cache->find(std::make_pair(request->tx, request->ty));
+    if (it != self->tile_cache->end() && (request->readonly || it->second.writable)) {
+        request->buffer = it->second.buffer;
+        found = true;
+    }
+} // #end pragma omp critical
+    return found;
+}
+
+static void
+tile_cache_insert(MyPaintPythonTiledSurface *self, MyPaintTileRequest *request)
+{
+#pragma omp critical (tile_cache)
+{
+    TileCacheEntry &entry = (*self->tile_cache)[std::make_pair(request->tx, request->ty)];
+    // a writable buffer replaces the tile read before, never the reverse
+    if (!entry.buffer || !request->readonly) {
+        entry.buffer = request->buffer;
+        entry.writable = !request->readonly;
+    }
+} // #end pragma omp critical
+}
+
+// Whether a tile buffer is fully transparent. Pixels are premultiplied,
+// so every channel is zero then. Rows are or-ed together before testing,
+// which is cheap compared to painting the tile.
+static bool
+tile_buffer_is_empty(const uint16_t *buffer, int tile_size)
+{
+    const int row_n = tile_size * 4;
+    for (int y = 0; y < tile_size; y++) {
+        uint16_t any = 0;
+        for (int i = 0; i < row_n; i++) {
+            any |= buffer[i];
+        }
+        if (any) {
+            return false;
+        }
+        buffer += row_n;
+    }
+    return true;
+}
+
+// Passes the tiles painted on since begin_atomic() which ended up fully
+// transparent, e.g. after erasing, to tiledsurface.py for removal.
+static void
+drop_empty_tiles(MyPaintPythonTiledSurface *self)
+{
+    PyObject *empty = NULL;
+    for (TileCache::iterator it = self->tile_cache->begin(); it != self->tile_cache->end(); ++it) {
+        if (!it->second.writable || !tile_buffer_is_empty(it->second.buffer, self->parent.tile_size)) {
+            continue;
+        }
+        if (!empty) {
+            empty = PyList_New(0);
+            if (!empty) {
+                break;
+            }
+        }
+        PyObject *pos = Py_BuildValue("(ii)", it->first.first, it->first.second);
+        if (pos) {
+            PyList_Append(empty, pos);
+            Py_DECREF(pos);
+        }
+    }
+    if (!empty) {
+        PyErr_Clear();
+        return;
+    }
+    PyObject *res = PyObject_CallMethod(self->py_obj, "_drop_empty_tiles", "(O)", empty);
+    Py_DECREF(empty);
+    if (res == NULL) {
+        printf("Python exception during _drop_empty_tiles()!\n");
+        if (PyErr_Occurred()) {
+            PyErr_Print();
+        }
+    } else {
+        Py_DECREF(res);
+    }
+}
+
 static void
 tile_request_start(MyPaintTiledSurface *tiled_surface, MyPaintTileRequest *request)
 {
@@ -27,6 +134,12 @@ tile_request_start(MyPaintTiledSurface *tiled_surface, MyPaintTileRequest *reque
     const int ty = request->ty;
     PyArrayObject* rgba = NULL;
 
+    // Calling into the interpreter serializes the threads of end_atomic()
+    // and get_color(), tiles already handed out come from the cache
+    if (self->atomic > 0 && tile_cache_lookup(self, request)) {
+        return;
+    }
+
 #pragma omp critical
 {
     rgba = (PyArrayObject*)PyObject_CallMethod(self->py_obj, "_get_tile_numpy", "(iii)", tx, ty, readonly);
@@ -52,7 +165,9 @@ tile_request_start(MyPaintTiledSurface *tiled_surface, MyPaintTileRequest *reque
     }
 } // #end pragma opt critical
 
-
+    if (self->atomic > 0 && request->buffer) {
+        tile_cache_insert(self, request);
+    }
 }
 
 static void
@@ -61,6 +176,45 @@ tile_request_end(MyPaintTiledSurface *tiled_surface, MyPaintTileRequest *request
     // We modify tiles directly, so don't need to do anything here
 }
 
+static void
+begin_atomic_python(MyPaintSurface *surface)
+{
+    MyPaintPythonTiledSurface *self = (MyPaintPythonTiledSurface *)surface;
+    self->atomic++;
+    mypaint_tiled_surface_begin_atomic(&self->parent);
+}
+
+static MyPaintRectangle
+end_atomic_python(MyPaintSurface *surface)
+{
+    MyPaintPythonTiledSurface *self = (MyPaintPythonTiledSurface *)surface;
+
+    // Fetch the tiles with pending dabs from tiledsurface.py up front,
+    // on this thread, so that processing them in parallel only takes
+    // buffers from the cache.
+    if (self->atomic > 0) {
+        TileIndex *tiles;
+        const int tiles_n = operation_queue_get_dirty_tiles(self->parent.operation_queue, &tiles);
+        for (int i = 0; i < tiles_n; i++) {
+            if (!operation_queue_peek_first(self->parent.operation_queue, tiles[i])) {
+                continue; // already flushed by get_color()
+            }
+            MyPaintTileRequest request;
+            mypaint_tile_request_init(&request, 0, tiles[i].x, tiles[i].y, FALSE);
+            tile_request_start(&self->parent, &request);
+        }
+    }
+
+    const MyPaintRectangle bbox = mypaint_tiled_surface_end_atomic(&self->parent);
+
+    if (self->atomic > 0 && --self->atomic == 0) {
+        // all dabs are processed, and the buffers still valid
+        drop_empty_tiles(self);
+        self->tile_cache->clear();
+    }
+    return bbox;
+}
+
 MyPaintPythonTiledSurface *
 mypaint_python_tiled_surface_new(PyObject *py_object)
 {
@@ -71,8 +225,12 @@ mypaint_python_tiled_surface_new(PyObject *py_object)
 
     // MyPaintSurface vfuncs
     self->parent.parent.destroy = free_tiledsurf;
+    self->parent.parent.begin_atomic = begin_atomic_python;
+    self->parent.parent.end_atomic = end_atomic_python;
 
     self->py_obj = py_object; // no need to incref
+    self->atomic = 0;
+    self->tile_cache = new TileCache();
 
     return self;
 }
@@ -81,5 +239,6 @@ void free_tiledsurf(MyPaintSurface *surface)
 {
     MyPaintPythonTiledSurface *self = (MyPaintPythonTiledSurface *)surface;
     mypaint_tiled_surface_destroy(&self->parent);
+    delete self->tile_cache;
     free(self);
 }
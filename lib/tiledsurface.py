@@ -15,6 +15,9 @@ import sys
 import os
 import contextlib
 import functools
+import itertools
+import zlib
+import threading
 import logging
 logger = logging.getLogger(__name__)
 
@@ -22,6 +25,8 @@ import mypaintlib
 import helpers
 import math
 import pixbufsurface
+from tilestore import TileStore
+from tilepool import TileBufferPool
 from layer import DEFAULT_COMPOSITE_OP
 
 TILE_SIZE = N = mypaintlib.TILE_SIZE
@@ -29,23 +34,200 @@ MAX_MIPMAP_LEVEL = mypaintlib.MAX_MIPMAP_LEVEL
 
 use_gegl = True if os.environ.get('MYPAINT_ENABLE_GEGL', 0) else False
 
+# zlib level for tiles compressed by the tile store, see Tile.compress()
+TILE_COMPRESSION_LEVEL = 1
+
+# Tiles of snapshots are read by the frame prefetcher's threads too
+_packing_lock = threading.Lock()
+
+# Buffers of dropped tiles, handed out again to new ones
+tile_pool = TileBufferPool(N)
 
 
 class Tile (object):
-    def __init__(self, copy_from=None):
+
+    # Pixels while compressed, see compress()
+    _packed = None
+
+    #: The colour of all pixels, as an (r, g, b, a) tuple, while the tile
+    #: is stored that way instead of as pixels (see pack_uniform()).
+    #: Compositing, mipmaps and saving use it directly, accessing `rgba`
+    #: fills in the pixels again.
+    uniform = None
+
+    def __init__(self, copy_from=None, clear=True, uniform=None):
         object.__init__(self)
         # note: pixels are stored with premultiplied alpha
         #       15bits are used, but fully opaque or white is stored as 2**15 (requiring 16 bits)
         #       This is to allow many calcuations to divide by 2**15 instead of (2**16-1)
-        if copy_from is None:
-            self.rgba = zeros((N, N, 4), 'uint16')
+        # Pass clear=False if every pixel is going to be written anyway.
+        if uniform is not None:
+            self.uniform = tuple(uniform)
+        elif copy_from is None:
+            self.rgba = tile_pool.get(clear)
         else:
-            self.rgba = copy_from.rgba.copy()
+            rgba = tile_pool.get(clear=False)
+            # read once, other threads may unpack it meanwhile
+            uniform = copy_from.uniform
+            if uniform is not None:
+                # leaves the source packed
+                rgba[...] = uniform
+            else:
+                rgba[...] = copy_from.rgba
+            self.rgba = rgba
         self.readonly = False
 
+    def release(self):
+        """Gives the pixels back to the tile pool, when dropping the tile
+
+        The tile must not be used afterwards. Read-only tiles keep their
+        pixels, they may be shared with snapshots read by other threads.
+        """
+        if self.readonly:
+            return
+        with _packing_lock:
+            rgba = self.__dict__.pop('rgba', None)
+        if rgba is not None:
+            tile_pool.put(rgba)
+
     def copy(self):
         return Tile(copy_from=self)
 
+    def get_pixels(self):
+        """Returns the pixels for reading, leaving a uniform tile packed"""
+        uniform = self.uniform
+        if uniform is None:
+            return self.rgba
+        rgba = empty((N, N, 4), 'uint16')
+        rgba[...] = uniform
+        return rgba
+
+    def is_empty(self):
+        """Whether all pixels are fully transparent"""
+        uniform = self.uniform
+        if uniform is None:
+            rgba = self.rgba
+            # stops at the first pixel that differs, unlike rgba.any()
+            if not mypaintlib.tile_is_uniform(rgba):
+                return False
+            uniform = rgba[0, 0]
+        return not any(uniform)
+
+    def pack_uniform(self):
+        """Keeps only the colour if all pixels are the same
+
+        Returns the number of bytes freed. Like compress(), this must
+        not be used while the surface is painted to.
+        """
+        if self is transparent_tile:
+            return 0
+        with _packing_lock:
+            rgba = self.__dict__.get('rgba')
+            if rgba is None or not mypaintlib.tile_is_uniform(rgba):
+                return 0
+            self.uniform = tuple(int(c) for c in rgba[0, 0])
+            del self.rgba
+        if not self.readonly:
+            # see release()
+            tile_pool.put(rgba)
+        return rgba.nbytes
+
+    def compress(self):
+        """Packs the pixels with zlib until they are next accessed
+
+        Tiles of a single colour only keep that (see pack_uniform()).
+        Returns the number of bytes freed.
+        """
+        if self is transparent_tile:
+            return 0
+        freed = self.pack_uniform()
+        if freed:
+            return freed
+        with _packing_lock:
+            rgba = self.__dict__.get('rgba')
+            if rgba is None:
+                return 0
+            packed = zlib.compress(rgba.tostring(), TILE_COMPRESSION_LEVEL)
+            self._packed = packed
+            del self.rgba
+        if not self.readonly:
+            # see release()
+            tile_pool.put(rgba)
+        return rgba.nbytes - len(packed)
+
+    def __getattr__(self, name):
+        # Only called while the pixels are missing, i.e. packed
+        if name != 'rgba':
+            raise AttributeError(name)
+        with _packing_lock:
+            rgba = self.__dict__.get('rgba')
+            if rgba is None:
+                if self._packed is not None:
+                    rgba = tile_pool.get(clear=False)
+                    rgba.reshape(-1)[:] = frombuffer(
+                        zlib.decompress(self._packed), 'uint16')
+                    self.rgba = rgba
+                    self._packed = None
+                elif self.uniform is not None:
+                    rgba = tile_pool.get(clear=False)
+                    rgba[...] = self.uniform
+                    self.rgba = rgba
+                    self.uniform = None
+                else:
+                    raise AttributeError(name)
+        return rgba
+
+
+def composite_uniform(color, dst, dst_has_alpha, opacity=1.0,
+                      mode=DEFAULT_COMPOSITE_OP):
+    """Composites a tile of a single colour over dst
+
+    Like mypaintlib.tile_composite() with a tile filled with `color`,
+    and with the same results, but without needing one in the usual
+    cases.
+    """
+    if color[3] == 0:
+        # premultiplied, so nothing at all
+        return
+    if (mode == 'svg:src-over' and color[3] == 1<<15 and opacity == 1.0
+            and not dst_has_alpha):
+        # Exactly what tile_composite() gives. Not with alpha, where it
+        # can be off by one over a partly transparent backdrop.
+        dst[:, :, :3] = color[:3]
+        return
+    src = tile_pool.get(clear=False)
+    src[...] = color
+    svg2composite_func[mode](src, dst, dst_has_alpha, opacity)
+    tile_pool.put(src)
+
+
+# 8 bit pixels of uniform tiles, by colour and alpha flag. Dithering
+# makes them vary across the tile, but the same way for every tile.
+_uniform_rgba8_cache = {}
+_UNIFORM_RGBA8_CACHE_SIZE = 64
+
+def blit_uniform_into(color, dst, dst_has_alpha):
+    """Fills dst like blit_tile_into() does for a tile of a single colour"""
+    if dst.dtype == 'uint16':
+        dst[...] = color
+        return
+    if dst.dtype != 'uint8':
+        raise ValueError, 'Unsupported destination buffer type'
+    key = (color, dst_has_alpha)
+    src8 = _uniform_rgba8_cache.get(key)
+    if src8 is None:
+        src = tile_pool.get(clear=False)
+        src[...] = color
+        src8 = empty((N, N, 4), 'uint8')
+        if dst_has_alpha:
+            mypaintlib.tile_convert_rgba16_to_rgba8(src, src8)
+        else:
+            mypaintlib.tile_convert_rgbu16_to_rgbu8(src, src8)
+        tile_pool.put(src)
+        if len(_uniform_rgba8_cache) >= _UNIFORM_RGBA8_CACHE_SIZE:
+            _uniform_rgba8_cache.clear()
+        _uniform_rgba8_cache[key] = src8
+    dst[...] = src8
 
 
 svg2mypaintlibmode = {
@@ -79,14 +261,122 @@ transparent_tile.readonly = True
 mipmap_dirty_tile = Tile()
 del mipmap_dirty_tile.rgba
 
+# Keeps the memory taken by the tiles of all surfaces within a budget
+tile_store = TileStore()
+
 def get_tiles_bbox(tiles):
     res = helpers.Rect()
     for tx, ty in tiles:
         res.expandToIncludeRect(helpers.Rect(N*tx, N*ty, N, N))
     return res
 
+def _load_png_tiles(load, x, y, feedback_cb=None):
+    """Reads a PNG into new tiles, one tilerow at a time
+
+    :param load: decodes the PNG, called as load(get_buffer) with the
+      callback expected by mypaintlib.load_png_fast_progressive()
+
+    Empty tiles are discarded. Returns the tiledict and the (x, y, w, h)
+    of the image.
+    """
+    tiles = {}
+
+    state = {}
+    state['buf'] = None # array of height N, width depends on image
+    state['ty'] = y/N # current tile row being filled into buf
+    state['frame_size'] = None
+
+    def get_buffer(png_w, png_h):
+        state['frame_size'] = x, y, png_w, png_h
+        if feedback_cb:
+            feedback_cb()
+        buf_x0 = x/N*N
+        buf_x1 = ((x+png_w-1)/N+1)*N
+        buf_y0 = state['ty']*N
+        buf_y1 = buf_y0+N
+        buf_w = buf_x1-buf_x0
+        buf_h = buf_y1-buf_y0
+        assert buf_w % N == 0
+        assert buf_h == N
+        if state['buf'] is not None:
+            consume_buf()
+        else:
+            state['buf'] = empty((buf_h, buf_w, 4), 'uint8')
+
+        png_x0 = x
+        png_x1 = x+png_w
+        subbuf = state['buf'][:,png_x0-buf_x0:png_x1-buf_x0]
+        if 1: # optimize: only needed for first and last
+            state['buf'].fill(0)
+            png_y0 = max(buf_y0, y)
+            png_y1 = min(buf_y0+buf_h, y+png_h)
+            assert png_y1 > png_y0
+            subbuf = subbuf[png_y0-buf_y0:png_y1-buf_y0,:]
+
+        state['ty'] += 1
+        return subbuf
+
+    def consume_buf():
+        ty = state['ty']-1
+        for i in xrange(state['buf'].shape[1]/N):
+            tx = x/N + i
+            src = state['buf'][:,i*N:(i+1)*N,:]
+            if src[:,:,3].any():
+                t = Tile(clear=False)
+                mypaintlib.tile_convert_rgba8_to_rgba16(src, t.rgba)
+                t.pack_uniform()
+                tiles[(tx, ty)] = t
+
+    flags = load(get_buffer)
+    consume_buf() # also process the final chunk of data
+    logger.debug("PNG loader flags: %r", flags)
+    return tiles, state['frame_size']
+
+def decode_png(data, x, y):
+    """Decodes PNG data into tiles, with the image placed at x, y
+
+    Returns a SurfaceSnapshot of the tiles, which can be loaded into a
+    surface with load_snapshot(), and the (x, y, w, h) of the image.
+    No surface is involved, so this can run on any thread; other threads
+    run while the rows are decompressed.
+    """
+    def load(get_buffer):
+        return mypaintlib.decode_png_fast_progressive(data, get_buffer)
+    sshot = SurfaceSnapshot()
+    sshot.tiledict, frame_size = _load_png_tiles(load, x, y)
+    return sshot, frame_size
+
 class SurfaceSnapshot (object):
-    pass
+    """Tiles of a surface at one point, see MyPaintSurface.save_snapshot()
+
+    The tiles are read-only, so a snapshot can be read by other threads
+    while the surface keeps changing.
+    """
+
+    def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
+        # like MyPaintSurface.blit_tile_into(), for saving the snapshot
+        assert mipmap_level == 0
+        assert dst.shape[2] == 4
+        tile = self.tiledict.get((tx, ty))
+        uniform = tile.uniform if tile is not None else None
+        if tile is None or tile is transparent_tile:
+            mypaintlib.tile_clear(dst)
+        elif uniform is not None:
+            blit_uniform_into(uniform, dst, dst_has_alpha)
+        elif dst.dtype == 'uint8':
+            if dst_has_alpha:
+                mypaintlib.tile_convert_rgba16_to_rgba8(tile.rgba, dst)
+            else:
+                mypaintlib.tile_convert_rgbu16_to_rgbu8(tile.rgba, dst)
+        else:
+            raise ValueError, 'Unsupported destination buffer type'
+
+    def encode_as_png(self, *rect, **kwargs):
+        """Returns the snapshot as PNG data, see pixbufsurface.encode_as_png()"""
+        kwargs.setdefault('alpha', True)
+        if len(self.tiledict) == 1:
+            kwargs['single_tile_pattern'] = True
+        return pixbufsurface.encode_as_png(self, *rect, **kwargs)
 
 if use_gegl:
 
@@ -160,6 +450,15 @@ if use_gegl:
 # - move the tile storage from MyPaintSurface to a separate class
 class MyPaintSurface (object):
     # the C++ half of this class is in tiledsurface.hpp
+
+    # Pending loader, see set_lazy_loader()
+    _lazy_loader = None
+    _lazy_discard = None
+    _lazy_bbox = None
+
+    # When the tiles were last used, see lib/tilestore.py
+    store_stamp = 0
+
     def __init__(self, mipmap_level=0, mipmap_surfaces=None,
                  looped=False, looped_size=(0,0)):
         object.__init__(self)
@@ -177,6 +476,10 @@ class MyPaintSurface (object):
 
         self.mipmap_level = mipmap_level
         self.mipmaps = mipmap_surfaces
+        # Level 0: tiles changed since the mipmaps were last marked dirty.
+        # Above: dirty tiles to regenerate, see regenerate_mipmaps().
+        self._mipmap_pending = set()
+        self._mipmap_dirty = set()
 
         if mipmap_level == 0:
             mipmaps = [self]
@@ -196,6 +499,8 @@ class MyPaintSurface (object):
                 except IndexError:
                     s.mipmap = None
 
+            tile_store.add(self)
+
         # Forwarding API
         self.set_symmetry_state = self._backend.set_symmetry_state
         self.begin_atomic = self._backend.begin_atomic
@@ -207,6 +512,7 @@ class MyPaintSurface (object):
 
     def end_atomic(self):
 	bbox = self._backend.end_atomic()
+	self._flush_mipmap_dirty()
 	if (bbox[2] > 0 and bbox[3] > 0):
 	    self.notify_observers(*bbox)
 
@@ -219,7 +525,23 @@ class MyPaintSurface (object):
             f(*args)
 
     def clear(self):
+        tile_store.touch(self.mipmaps[0])
+        if self._lazy_loader is not None:
+            # no need to load what gets thrown away
+            bbox = self.get_bbox()
+            discard = self._lazy_discard
+            del self._lazy_loader
+            del self._lazy_bbox
+            self.__dict__.pop('_lazy_discard', None)
+            if discard is not None:
+                discard(self)
+            for s in self.mipmaps:
+                s.tiledict = {}
+            self.notify_observers(*bbox)
+            return
         tiles = self.tiledict.keys()
+        for t in self.tiledict.itervalues():
+            t.release()
         self.tiledict = {}
         self.notify_observers(*get_tiles_bbox(tiles))
         if self.mipmap: self.mipmap.clear()
@@ -235,6 +557,7 @@ class MyPaintSurface (object):
         """
         x, y, w, h = rect
         logger.info("Trim %dx%d%+d%+d", w, h, x, y)
+        tile_store.touch(self)
         trimmed = []
         for tx, ty in list(self.tiledict.keys()):
             if tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h:
@@ -255,34 +578,104 @@ class MyPaintSurface (object):
         self._set_tile_numpy(tx, ty, numpy_tile, readonly)
 
     def _regenerate_mipmap(self, t, tx, ty):
-        t = Tile()
-        self.tiledict[(tx, ty)] = t
-        empty = True
+        jobs = []
+        t = self._build_mipmap_tile(tx, ty, jobs)
+        if jobs:
+            mypaintlib.tile_downscale_rgba16_many(jobs)
+        self._mipmap_dirty.discard((tx, ty))
+        return t
 
+    def _build_mipmap_tile(self, tx, ty, jobs):
+        # Replaces a dirty tile with one made from the four below it. The
+        # downscaling is left to the caller, as (src, dst, x, y) jobs for
+        # mypaintlib.tile_downscale_rgba16_many().
+        srcs = []
         for x in xrange(2):
             for y in xrange(2):
                 src = self.parent.tiledict.get((tx*2 + x, ty*2 + y), transparent_tile)
                 if src is mipmap_dirty_tile:
                     src = self.parent._regenerate_mipmap(src, tx*2 + x, ty*2 + y)
-                mypaintlib.tile_downscale_rgba16(src.rgba, t.rgba, x*N/2, y*N/2)
-                if src.rgba is not transparent_tile.rgba:
-                    empty = False
-        if empty:
-            # rare case, no need to speed it up
-            del self.tiledict[(tx, ty)]
-            t = transparent_tile
+                srcs.append((x, y, src, src.uniform))
+
+        if all(src is transparent_tile for x, y, src, uniform in srcs):
+            self.tiledict.pop((tx, ty), None)
+            return transparent_tile
+        colors = set(uniform for x, y, src, uniform in srcs)
+        if len(colors) == 1 and None not in colors:
+            # downscaling keeps a single colour as it is
+            t = Tile(uniform=colors.pop())
+            self.tiledict[(tx, ty)] = t
+            return t
+
+        # quarters below transparent tiles are left cleared
+        clear = any(src is transparent_tile for x, y, src, uniform in srcs)
+        t = Tile(clear=clear)
+        self.tiledict[(tx, ty)] = t
+        for x, y, src, uniform in srcs:
+            if src is transparent_tile:
+                continue
+            elif uniform is not None:
+                t.rgba[y*N/2:(y+1)*N/2, x*N/2:(x+1)*N/2] = uniform
+            else:
+                jobs.append((src.rgba, t.rgba, x*N/2, y*N/2))
         return t
 
+    def regenerate_mipmaps(self, max_level=MAX_MIPMAP_LEVEL, limit=None):
+        """Regenerates the dirty mipmap tiles, level by level
+
+        All dirty tiles of a level are downscaled together, on all cores,
+        rather than one by one as they get rendered. With `limit`, at most
+        that many are taken on, the rest are left for the next call.
+        Returns the number of tiles regenerated.
+        """
+        base = self.mipmaps[0]
+        if base._lazy_loader is not None:
+            return 0
+        base._flush_mipmap_dirty()
+        count = 0
+        for mipmap in base.mipmaps[1:max_level+1]:
+            dirty = mipmap._mipmap_dirty
+            if not dirty:
+                continue
+            if limit is not None:
+                if count >= limit:
+                    break
+                dirty = set(itertools.islice(dirty, limit - count))
+                mipmap._mipmap_dirty.difference_update(dirty)
+            else:
+                mipmap._mipmap_dirty = set()
+            jobs = []
+            for tx, ty in dirty:
+                # also in the set after being regenerated on demand
+                if mipmap.tiledict.get((tx, ty)) is mipmap_dirty_tile:
+                    mipmap._build_mipmap_tile(tx, ty, jobs)
+                    count += 1
+            if jobs:
+                mypaintlib.tile_downscale_rgba16_many(jobs)
+        return count
+
     def _get_tile_numpy(self, tx, ty, readonly):
+        return self._get_tile(tx, ty, readonly).rgba
+
+    def _get_tile(self, tx, ty, readonly):
+        # Like _get_tile_numpy(), but returns the Tile, which may still be
+        # packed (see Tile.uniform).
         # OPTIMIZE: do some profiling to check if this function is a bottleneck
         #           yes it is
         # Note: we must return memory that stays valid for writing until the
         # last end_atomic(), because of the caching in tiledsurface.hpp.
+        # Between begin_atomic() and end_atomic(), each tile is only asked
+        # for once for reading and once for writing (pythontiledsurface.cpp
+        # caches the buffers), so the tiledict must not change meanwhile.
 
         if self.looped:
             tx = tx % (self.looped_size[0] / N)
             ty = ty % (self.looped_size[1] / N)
 
+        base = self.mipmaps[0]
+        if self.mipmap_level > 0 and base._mipmap_pending:
+            base._flush_mipmap_dirty()
+        base.store_stamp = tile_store.stamp
         t = self.tiledict.get((tx, ty))
         if t is None:
             if readonly:
@@ -293,26 +686,48 @@ class MyPaintSurface (object):
         if t is mipmap_dirty_tile:
             t = self._regenerate_mipmap(t, tx, ty)
         if t.readonly and not readonly:
-            # shared memory, get a private copy for writing
+            # shared memory, get a private copy for writing (the shared
+            # tile stays with the snapshots, so it isn't released)
             t = t.copy()
             self.tiledict[(tx, ty)] = t
         if not readonly:
             # assert self.mipmap_level == 0
             self._mark_mipmap_dirty(tx, ty)
-        return t.rgba
+        return t
 
     def _set_tile_numpy(self, tx, ty, obj, readonly):
         pass # Data can be modified directly, no action needed
 
     def _mark_mipmap_dirty(self, tx, ty):
+        # Only noted here, the mipmap levels are updated in bulk at
+        # end_atomic(), or before they are next read.
         #assert self.mipmap_level == 0
-        for level, mipmap in enumerate(self.mipmaps):
-            if level == 0:
-                continue
-            fac = 2**(level)
-            if mipmap.tiledict.get((tx/fac, ty/fac), None) == mipmap_dirty_tile:
+        self.mipmaps[0]._mipmap_pending.add((tx, ty))
+
+    def _flush_mipmap_dirty(self):
+        # Marks the mipmap tiles above the tiles changed since the last
+        # call dirty, a level at a time. Tiles already dirty have dirty
+        # tiles above them too, so their branch stops there.
+        base = self.mipmaps[0]
+        changed = base._mipmap_pending
+        if not changed:
+            return
+        base._mipmap_pending = set()
+        for mipmap in base.mipmaps[1:]:
+            tiledict = mipmap.tiledict
+            marked = set()
+            for tx, ty in changed:
+                pos = (tx/2, ty/2)
+                old = tiledict.get(pos)
+                if old is not mipmap_dirty_tile:
+                    if old is not None:
+                        old.release()
+                    tiledict[pos] = mipmap_dirty_tile
+                    marked.add(pos)
+            if not marked:
                 break
-            mipmap.tiledict[(tx/fac, ty/fac)] = mipmap_dirty_tile
+            mipmap._mipmap_dirty.update(marked)
+            changed = marked
 
     def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
         # used mainly for saving (transparent PNG)
@@ -320,27 +735,32 @@ class MyPaintSurface (object):
         #assert dst_has_alpha is True
 
         if self.mipmap_level < mipmap_level:
+            self._flush_mipmap_dirty()
             return self.mipmap.blit_tile_into(dst, dst_has_alpha, tx, ty, mipmap_level)
 
         assert dst.shape[2] == 4
 
-        with self.tile_request(tx, ty, readonly=True) as src:
-
-            if src is transparent_tile.rgba:
-                #dst[:] = 0 # <-- notably slower than memset()
-                mypaintlib.tile_clear(dst)
-            else:
+        # the tile, not its pixels, so that single colours stay packed
+        t = self._get_tile(tx, ty, readonly=True)
+        uniform = t.uniform
 
-                if dst.dtype == 'uint16':
-                    # this will do memcpy, not worth to bother skipping the u channel
-                    mypaintlib.tile_copy_rgba16_into_rgba16(src, dst)
-                elif dst.dtype == 'uint8':
-                    if dst_has_alpha:
-                        mypaintlib.tile_convert_rgba16_to_rgba8(src, dst)
-                    else:
-                        mypaintlib.tile_convert_rgbu16_to_rgbu8(src, dst)
+        if t is transparent_tile:
+            #dst[:] = 0 # <-- notably slower than memset()
+            mypaintlib.tile_clear(dst)
+        elif uniform is not None:
+            blit_uniform_into(uniform, dst, dst_has_alpha)
+        else:
+            src = t.rgba
+            if dst.dtype == 'uint16':
+                # this will do memcpy, not worth to bother skipping the u channel
+                mypaintlib.tile_copy_rgba16_into_rgba16(src, dst)
+            elif dst.dtype == 'uint8':
+                if dst_has_alpha:
+                    mypaintlib.tile_convert_rgba16_to_rgba8(src, dst)
                 else:
-                    raise ValueError, 'Unsupported destination buffer type'
+                    mypaintlib.tile_convert_rgbu16_to_rgbu8(src, dst)
+            else:
+                raise ValueError, 'Unsupported destination buffer type'
 
     def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0, opacity=1.0,
                        mode=DEFAULT_COMPOSITE_OP):
@@ -349,13 +769,18 @@ class MyPaintSurface (object):
         Composite one tile of this surface over the array dst, modifying only dst.
         """
         if self.mipmap_level < mipmap_level:
+            self._flush_mipmap_dirty()
             return self.mipmap.composite_tile(dst, dst_has_alpha, tx, ty, mipmap_level, opacity, mode)
         if not (tx,ty) in self.tiledict:
             return
 
-        with self.tile_request(tx, ty, readonly=True) as src:
+        t = self._get_tile(tx, ty, readonly=True)
+        uniform = t.uniform
+        if uniform is not None:
+            composite_uniform(uniform, dst, dst_has_alpha, opacity, mode)
+        else:
             func = svg2composite_func[mode]
-            func(src, dst, dst_has_alpha, opacity)
+            func(t.rgba, dst, dst_has_alpha, opacity)
 
 
     ## Snapshotting
@@ -363,6 +788,7 @@ class MyPaintSurface (object):
     def save_snapshot(self):
         """Creates and returns a snapshot of the surface"""
         sshot = SurfaceSnapshot()
+        tile_store.touch(self)
         for t in self.tiledict.itervalues():
             t.readonly = True
         sshot.tiledict = self.tiledict.copy()
@@ -380,6 +806,7 @@ class MyPaintSurface (object):
             # common case optimization, called from split_stroke() via stroke.redo()
             # testcase: comparison above (if equal) takes 0.6ms, code below 30ms
             return
+        tile_store.touch(self)
         old = set(self.tiledict.iteritems())
         self.tiledict = d.copy()
         new = set(self.tiledict.iteritems())
@@ -437,64 +864,69 @@ class MyPaintSurface (object):
     def load_from_png(self, filename, x, y, feedback_cb=None):
         """Load from a PNG, one tilerow at a time, discarding empty tiles.
         """
-        dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        filename_sys = filename.encode(sys.getfilesystemencoding()) # FIXME: should not do that, should use open(unicode_object)
+        def load(get_buffer):
+            return mypaintlib.load_png_fast_progressive(filename_sys, get_buffer)
+        tiles, frame_size = _load_png_tiles(load, x, y, feedback_cb)
+        self._load_tiledict(tiles)
 
-        state = {}
-        state['buf'] = None # array of height N, width depends on image
-        state['ty'] = y/N # current tile row being filled into buf
-        state['frame_size'] = None
-
-        def get_buffer(png_w, png_h):
-            state['frame_size'] = x, y, png_w, png_h
-            if feedback_cb:
-                feedback_cb()
-            buf_x0 = x/N*N
-            buf_x1 = ((x+png_w-1)/N+1)*N
-            buf_y0 = state['ty']*N
-            buf_y1 = buf_y0+N
-            buf_w = buf_x1-buf_x0
-            buf_h = buf_y1-buf_y0
-            assert buf_w % N == 0
-            assert buf_h == N
-            if state['buf'] is not None:
-                consume_buf()
-            else:
-                state['buf'] = empty((buf_h, buf_w, 4), 'uint8')
-
-            png_x0 = x
-            png_x1 = x+png_w
-            subbuf = state['buf'][:,png_x0-buf_x0:png_x1-buf_x0]
-            if 1: # optimize: only needed for first and last
-                state['buf'].fill(0)
-                png_y0 = max(buf_y0, y)
-                png_y1 = min(buf_y0+buf_h, y+png_h)
-                assert png_y1 > png_y0
-                subbuf = subbuf[png_y0-buf_y0:png_y1-buf_y0,:]
-
-            state['ty'] += 1
-            return subbuf
-
-        def consume_buf():
-            ty = state['ty']-1
-            for i in xrange(state['buf'].shape[1]/N):
-                tx = x/N + i
-                src = state['buf'][:,i*N:(i+1)*N,:]
-                if src[:,:,3].any():
-                    with self.tile_request(tx, ty, readonly=False) as dst:
-                        mypaintlib.tile_convert_rgba8_to_rgba16(src, dst)
+        # return the bbox of the loaded image
+        return frame_size
 
-        filename_sys = filename.encode(sys.getfilesystemencoding()) # FIXME: should not do that, should use open(unicode_object)
-        flags = mypaintlib.load_png_fast_progressive(filename_sys, get_buffer)
-        consume_buf() # also process the final chunk of data
-        logger.debug("PNG loader flags: %r", flags)
+    ## Loading on demand
 
-        dirty_tiles.update(self.tiledict.keys())
-        bbox = get_tiles_bbox(dirty_tiles)
-        self.notify_observers(*bbox)
+    def set_lazy_loader(self, loader, bbox, discard=None):
+        """Defers loading the tile data until it is first accessed
 
-        # return the bbox of the loaded image
-        return state['frame_size']
+        :param loader: callable, run with the surface as its argument the
+          first time the tiles are needed, which loads them (for instance
+          with load_from_png())
+        :param bbox: the area the data is expected to cover, returned
+          (expanded to whole tiles) by get_bbox() until then
+        :param discard: callable, run with the surface as its argument
+          instead of the loader if the surface is cleared before loading
+
+        Observers are not notified when the tiles get loaded: as far as
+        the rest of the document is concerned, they were there all along.
+        """
+        assert self.mipmap_level == 0
+        self._lazy_loader = loader
+        self._lazy_discard = discard
+        self._lazy_bbox = helpers.Rect(*bbox)
+        # Any access to the tiledict of any level ends up in __getattr__
+        for s in self.mipmaps:
+            s.__dict__.pop('tiledict', None)
+
+    @property
+    def is_loaded(self):
+        """False while a loader set with set_lazy_loader() is pending"""
+        return self.mipmaps[0]._lazy_loader is None
+
+    def load_lazy(self):
+        """Runs the pending loader now, if there is one"""
+        base = self.mipmaps[0]
+        loader = base._lazy_loader
+        if loader is None:
+            return
+        del base._lazy_loader
+        del base._lazy_bbox
+        base.__dict__.pop('_lazy_discard', None)
+        for s in base.mipmaps:
+            s.tiledict = {}
+        observers = base.observers
+        base.observers = []
+        try:
+            loader(base)
+        finally:
+            base.observers = observers
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, so it costs nothing once
+        # the tiledict is there again.
+        if name == 'tiledict' and 'mipmaps' in self.__dict__:
+            self.load_lazy()
+            return self.__dict__['tiledict']
+        raise AttributeError(name)
 
     def render_as_pixbuf(self, *args, **kwargs):
         if not self.tiledict:
@@ -513,21 +945,105 @@ class MyPaintSurface (object):
             kwargs['single_tile_pattern'] = True
         pixbufsurface.save_as_png(self, filename, *args, **kwargs)
 
+    def encode_as_png(self, *args, **kwargs):
+        """Like save_as_png(), but returns the PNG data as a string"""
+        if not 'alpha' in kwargs:
+            kwargs['alpha'] = True
+
+        if len(self.tiledict) == 1:
+            kwargs['single_tile_pattern'] = True
+        return pixbufsurface.encode_as_png(self, *args, **kwargs)
+
     def get_tiles(self):
         return self.tiledict
 
+    def get_tile_memory(self):
+        """Bytes taken by the uncompressed tiles of all mipmap levels"""
+        if self._lazy_loader is not None:
+            return 0
+        count = 0
+        for s in self.mipmaps:
+            for t in s.tiledict.itervalues():
+                if 'rgba' in t.__dict__:
+                    count += 1
+        return count * N * N * 4 * 2
+
+    def get_tile_stats(self):
+        """Counts the tiles of all mipmap levels by how they are stored
+
+        Returns a dict with the number of tiles kept as pixels
+        (``unpacked``), as a single colour (``uniform``) and compressed
+        (``packed``), the bytes they take (``nbytes``) and the bytes they
+        would take as pixels (``full_nbytes``). Used for the memory report
+        of the tile store.
+        """
+        stats = dict(unpacked=0, uniform=0, packed=0, nbytes=0,
+                     full_nbytes=0)
+        if self._lazy_loader is not None:
+            return stats
+        tile_nbytes = N * N * 4 * 2
+        for s in self.mipmaps:
+            for t in s.tiledict.itervalues():
+                if t is transparent_tile or t is mipmap_dirty_tile:
+                    continue
+                if 'rgba' in t.__dict__:
+                    stats['unpacked'] += 1
+                    stats['nbytes'] += tile_nbytes
+                elif t.uniform is not None:
+                    stats['uniform'] += 1
+                elif t._packed is not None:
+                    stats['packed'] += 1
+                    stats['nbytes'] += len(t._packed)
+                else:
+                    continue
+                stats['full_nbytes'] += tile_nbytes
+        return stats
+
+    def compress_tiles(self):
+        """Compresses all tiles until they are next accessed
+
+        Returns the number of bytes freed. Used by the tile store, see
+        lib/tilestore.py.
+        """
+        if self._lazy_loader is not None:
+            return 0
+        freed = 0
+        for s in self.mipmaps:
+            for t in s.tiledict.itervalues():
+                freed += t.compress()
+        return freed
+
     def get_bbox(self):
+        bbox = self._lazy_bbox
+        if bbox is not None and not bbox.empty():
+            # not loaded yet, the tiles covering the expected area
+            tx0, ty0 = bbox.x // N, bbox.y // N
+            tx1 = (bbox.x + bbox.w - 1) // N
+            ty1 = (bbox.y + bbox.h - 1) // N
+            return helpers.Rect(tx0*N, ty0*N, (tx1-tx0+1)*N, (ty1-ty0+1)*N)
         return get_tiles_bbox(self.tiledict)
 
     def is_empty(self):
+        if self._lazy_loader is not None:
+            return False
         return not self.tiledict
 
     def remove_empty_tiles(self):
         """Removes tiles from the tiledict which contain no data"""
         for pos, data in self.tiledict.items():
-            if not data.rgba.any():
+            if data.is_empty():
                 self.tiledict.pop(pos)
 
+    def _drop_empty_tiles(self, tiles):
+        # Called by pythontiledsurface.cpp at the last end_atomic(), with
+        # the tiles painted on meanwhile that ended up fully transparent.
+        # Their mipmaps were marked dirty when they were asked for.
+        # The tile cache lets go of their pixels right after.
+        for pos in tiles:
+            t = self.tiledict.pop(pos, None)
+            if t is not None:
+                t.release()
+
     def get_move(self, x, y, sort=True):
         """Returns a move object for this surface
 
@@ -651,6 +1167,9 @@ class MyPaintSurface (object):
             with dst_surface.tile_request(tx, ty, readonly=False) as dst:
                 comp(src, dst, True, 1.0)
             dst_surface._mark_mipmap_dirty(tx, ty)
+        # tiles inside the filled area are left with a single colour
+        for pos in filled:
+            dst_surface.tiledict[pos].pack_uniform()
         bbox = get_tiles_bbox(filled)
         dst_surface.notify_observers(*bbox)
 
@@ -782,8 +1301,9 @@ class TiledSurfaceMove (object):
                     targ_ty = src_ty + targ_tdy
                     targ_t = targ_tx, targ_ty
                     if is_integral:
-                        # We're lucky. Perform a straight data copy.
-                        self.surface.tiledict[targ_t] = src_tile.copy()
+                        # We're lucky. Share the read-only snapshot tile,
+                        # it gets copied on the first write.
+                        self.surface.tiledict[targ_t] = src_tile
                         continue
                     # Get a tile to write
                     targ_tile = None
@@ -0,0 +1,132 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Pool of tile pixel buffers
+
+Tiles are created and dropped all the time: on the first write to an
+empty spot, when the read-only tiles of a snapshot are copied before
+writing, when mipmaps are regenerated, and when layers are moved. The
+pool keeps the buffers of dropped tiles for the next ones, instead of
+giving each of them back to the allocator, which also keeps the heap
+from fragmenting during long sessions.
+"""
+
+import threading
+
+import numpy
+
+# Most free buffers kept, 32 MiB of 64x64 tiles
+DEFAULT_MAX_FREE = 1024
+
+
+class TileBufferPool (object):
+    """Free list of NxNx4 uint16 buffers
+
+    Buffers are handed out by get(), and given back explicitly with
+    put() by their owner (see `tiledsurface.Tile.release()`), once
+    nothing refers to them any more: only the owner can tell when that
+    is. The free list shrinks with trim(), which releases the buffers
+    that were not needed since the last trim, i.e. as many as the
+    fewest that were free meanwhile (the low-water mark).
+
+    >>> pool = TileBufferPool(4)
+    >>> a = pool.get(); b = pool.get()
+    >>> pool.put(a)
+    True
+    >>> pool.get() is a
+    True
+    >>> pool.allocated, pool.reused
+    (2, 1)
+    >>> pool.put(pool.get()[1:])  # not a whole buffer
+    False
+    >>> pool.put(b)
+    True
+    >>> pool.trim()  # b was put back after the last trim
+    0
+    >>> pool.trim()  # but not taken since
+    1
+    """
+
+    def __init__(self, size, max_free=DEFAULT_MAX_FREE):
+        object.__init__(self)
+        self.shape = (size, size, 4)
+        self.max_free = max_free
+        self._free = []
+        self._low_water = 0
+        # get() and put() are called by the threads of the frame prefetcher
+        # and of the save and load pools too
+        self._lock = threading.Lock()
+        #: Buffers allocated, because the free list was empty
+        self.allocated = 0
+        #: Buffers handed out again from the free list
+        self.reused = 0
+        #: Buffers given back to the allocator by trim() or a full list
+        self.released = 0
+
+    def get(self, clear=True):
+        """Returns a buffer, zeroed unless `clear` is false"""
+        with self._lock:
+            if self._free:
+                buf = self._free.pop()
+                self._low_water = min(self._low_water, len(self._free))
+                self.reused += 1
+            else:
+                buf = None
+                self.allocated += 1
+        if buf is None:
+            if clear:
+                return numpy.zeros(self.shape, 'uint16')
+            return numpy.empty(self.shape, 'uint16')
+        if clear:
+            buf.fill(0)
+        return buf
+
+    def put(self, buf):
+        """Takes back a buffer that is no longer used
+
+        Returns whether it was taken: views and buffers of other shapes
+        are not.
+        """
+        if buf.base is not None:
+            return False
+        if buf.shape != self.shape or not buf.flags.c_contiguous:
+            return False
+        with self._lock:
+            if len(self._free) >= self.max_free:
+                self.released += 1
+                return False
+            self._free.append(buf)
+        return True
+
+    def trim(self):
+        """Releases the buffers not needed since the last call
+
+        Returns how many were released.
+        """
+        with self._lock:
+            n = self._low_water
+            if n:
+                del self._free[:n]
+                self.released += n
+            self._low_water = len(self._free)
+        return n
+
+    @property
+    def free(self):
+        """Number of buffers in the free list"""
+        return len(self._free)
+
+    def get_stats(self):
+        """Returns the counters as a dict, for logging and tests"""
+        return dict(allocated=self.allocated, reused=self.reused,
+                    released=self.released, free=len(self._free))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
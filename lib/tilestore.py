@@ -0,0 +1,132 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Memory budget for the tiles of surfaces
+
+An animation has a layer for each cel, and every layer keeps all of its
+tiles in memory, uncompressed, even when the cel is far away from the
+frame being worked on. The tile store keeps track of the surfaces, and
+when their uncompressed tiles take more memory than the budget, it
+compresses the tiles of the surfaces used least recently. Tiles unpack
+themselves again as soon as their pixels are accessed.
+"""
+
+import weakref
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+# Default memory budget for uncompressed tiles, in bytes
+DEFAULT_BUDGET = 1024 * 1024 * 1024
+
+
+class TileStore (object):
+    """Compresses the tiles of least recently used surfaces to a budget
+
+    Surfaces are expected to provide:
+
+    * ``store_stamp``, set to the store's `stamp` whenever their tiles
+      are accessed or replaced (see `touch()`)
+    * ``get_tile_memory()``, the bytes taken by their uncompressed tiles
+    * ``compress_tiles()``, which packs the tiles and returns the bytes
+      it freed
+
+    >>> class FakeSurface (object):
+    ...     store_stamp = 0
+    ...     def __init__(self, nbytes):
+    ...         self.nbytes = nbytes
+    ...     def get_tile_memory(self):
+    ...         return self.nbytes
+    ...     def compress_tiles(self):
+    ...         freed, self.nbytes = self.nbytes - 1, 1
+    ...         return freed
+    >>> store = TileStore(budget=25)
+    >>> a, b, c = FakeSurface(12), FakeSurface(10), FakeSurface(8)
+    >>> for s in a, b, c:
+    ...     store.add(s)
+    >>> store.enforce_budget()  # none used yet, the largest goes first
+    >>> a.nbytes, b.nbytes, c.nbytes
+    (1, 10, 8)
+    >>> b.nbytes = 20; store.touch(b)
+    >>> store.enforce_budget()  # b was just used, c has to go
+    >>> a.nbytes, b.nbytes, c.nbytes
+    (1, 20, 1)
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        object.__init__(self)
+        self.budget = budget
+        #: Current epoch, surfaces touched during it are left alone
+        self.stamp = 1
+        # surface -> (stamp when counted, bytes counted)
+        self._surfaces = weakref.WeakKeyDictionary()
+        #: Bytes of uncompressed tiles, as of the last enforce_budget()
+        self.nbytes = 0
+
+    def add(self, surface):
+        """Starts keeping track of a surface"""
+        self._surfaces[surface] = (0, 0)
+
+    def touch(self, surface):
+        """Marks a surface as used, and its memory as changed"""
+        surface.store_stamp = self.stamp
+
+    def set_budget(self, budget):
+        """Changes the budget, which applies from the next enforcement"""
+        self.budget = budget
+
+    def enforce_budget(self):
+        """Compresses tiles of the least recently used surfaces
+
+        Surfaces touched since the last call are never compressed. This
+        must not run while a surface is painted to (between
+        begin_atomic() and end_atomic()), since the brush engine holds
+        on to the pixel memory of tiles meanwhile.
+        """
+        stamp = self.stamp
+        self.stamp += 1
+        total = 0
+        idle = []
+        for surface, (counted, nbytes) in self._surfaces.items():
+            if surface.store_stamp >= counted:
+                nbytes = surface.get_tile_memory()
+                self._surfaces[surface] = (stamp, nbytes)
+            total += nbytes
+            if surface.store_stamp < stamp and nbytes:
+                idle.append((surface.store_stamp, surface, nbytes))
+        if total > self.budget:
+            t0 = time.time()
+            before = total
+            # oldest first, and the largest of those used as long ago
+            idle.sort(key=lambda entry: (entry[0], -entry[2]))
+            for last_used, surface, nbytes in idle:
+                if total <= self.budget:
+                    break
+                freed = surface.compress_tiles()
+                total -= freed
+                self._surfaces[surface] = (stamp, nbytes - freed)
+            logger.debug('%.3fs compressing tiles, %d MiB down to %d MiB',
+                         time.time() - t0, before >> 20, total >> 20)
+        self.nbytes = total
+
+    def get_report(self):
+        """Adds up the tile statistics of all surfaces
+
+        Surfaces need a ``get_tile_stats()`` for this, returning a dict of
+        counts, which are summed key by key.
+        """
+        report = {}
+        for surface in self._surfaces.keys():
+            for key, value in surface.get_tile_stats().iteritems():
+                report[key] = report.get(key, 0) + value
+        return report
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Renders the X-Sheet of an OpenRaster file without starting the GUI.
+
+Frames are flattened with the background, as they are played back, and
+written as a numbered PNG sequence or as a video, depending on the
+extension of the output file:
+
+    python mypaint-render.py -j 8 --scale 0.5 shot.ora out/shot.png
+    python mypaint-render.py --start 10 --end 60 shot.ora shot.avi
+
+Frames holding the same cel are only rendered once. Videos are encoded
+with ffmpeg if it is installed; otherwise only AVI (Motion-JPEG) output
+is available. Run from the source tree, like mypaint.py.
+"""
+
+import sys, os
+import time
+import errno
+import subprocess
+import multiprocessing
+from collections import deque
+from optparse import OptionParser
+from distutils.spawn import find_executable
+import logging
+logger = logging.getLogger('mypaint-render')
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gi.repository import GdkPixbuf
+
+from lib import document, helpers
+from lib.avi import AviWriter
+from lib.framecache import FrameCache, frame_rect
+from lib.animation import VIDEO_CACHE_BUDGET
+
+# Video file extensions, anything else is rejected
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mov', '.mkv', '.webm', '.ogv')
+
+# Frames queued per worker ahead of the one being written
+QUEUE_PER_WORKER = 2
+
+# The job, inherited by the worker processes at fork
+_job = None
+
+
+class RenderJob (object):
+    """Renders frames of a loaded document at an output size"""
+
+    def __init__(self, doc, scale):
+        object.__init__(self)
+        self.doc = doc
+        self.ani = doc.ani
+        x, y, w, h = doc.get_effective_bbox()
+        if w == 0 or h == 0:
+            raise IOError(errno.EINVAL, 'There is nothing to render')
+        # render from the smallest mipmap level still at least as big
+        # as the output, then scale down the rest of the way
+        self.mipmap_level = 0
+        while 2.0**-(self.mipmap_level+1) >= scale:
+            self.mipmap_level += 1
+        self.width = max(1, int(round(w * scale)))
+        self.height = max(1, int(round(h * scale)))
+        # encoded data is returned to the parent process, where the
+        # encode function is None the frames are saved as PNG files
+        self.encode = None
+        self.filenames = {}
+
+    def key(self, idx):
+        """Returns a key shared by the frames that look the same"""
+        return self.ani.get_frame_key(idx, self.mipmap_level)[0]
+
+    def render(self, idx):
+        """Returns the nth frame as a pixbuf of the output size"""
+        frame = self.ani.render_frame(idx, self.mipmap_level)
+        pixbuf = frame.pixbuf
+        rect = frame_rect(self.doc.get_effective_bbox(), self.mipmap_level)
+        if (rect[2], rect[3]) != (self.width, self.height):
+            pixbuf = pixbuf.scale_simple(self.width, self.height,
+                                         GdkPixbuf.InterpType.BILINEAR)
+        # the frame cache is not needed for a single pass
+        self.ani.frame_cache.clear()
+        return pixbuf
+
+    def process(self, idx):
+        pixbuf = self.render(idx)
+        if self.encode is None:
+            pixbuf.savev(self.filenames[idx], 'png', [], [])
+            return None
+        return self.encode(pixbuf)
+
+
+def _process_frame(idx):
+    return _job.process(idx)
+
+
+def process_frames(job, indices, jobs):
+    """Yields the result of job.process() for each index, in order
+
+    With more than one job, frames are processed by a pool of forked
+    worker processes, a few frames ahead of the ones consumed. No other
+    thread may be running then, see Animation.prefetch_enabled.
+    """
+    global _job
+    if jobs < 2 or len(indices) < 2 or not hasattr(os, 'fork'):
+        for idx in indices:
+            yield job.process(idx)
+        return
+    _job = job
+    pool = multiprocessing.Pool(min(jobs, len(indices)))
+    try:
+        pending = deque()
+        todo = iter(indices)
+        window = jobs * QUEUE_PER_WORKER
+        for idx in todo:
+            pending.append(pool.apply_async(_process_frame, (idx,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _job = None
+
+
+def render_png(job, indices, filename, jobs, progress):
+    """Writes frames as a numbered PNG sequence, returns the unique count"""
+    prefix, ext = os.path.splitext(filename)
+    first_filename = {}
+    unique = []
+    links = []
+    for i in indices:
+        filename = '%s-%03d%s' % (prefix, i+1, ext)
+        key = job.key(i)
+        if key in first_filename:
+            links.append((first_filename[key], filename))
+        else:
+            first_filename[key] = filename
+            job.filenames[i] = filename
+            unique.append(i)
+    for res in process_frames(job, unique, jobs):
+        progress()
+    for src, dst in links:
+        helpers.link_or_copy(src, dst)
+        progress()
+    return len(unique)
+
+
+def render_video(job, indices, filename, fps, jobs, progress):
+    """Writes frames as a video, returns the number rendered"""
+    ffmpeg = find_executable('ffmpeg')
+    if ffmpeg is None and os.path.splitext(filename)[1].lower() != '.avi':
+        raise IOError(errno.ENOENT, 'ffmpeg is needed to write %s' % filename)
+    # even sizes, for the chroma subsampling of most codecs
+    job.width = max(2, job.width & ~1)
+    job.height = max(2, job.height & ~1)
+
+    # frames are encoded in order of first appearance, repeats come from
+    # the cache, or are encoded again in this process once evicted
+    keys = [job.key(i) for i in indices]
+    first = {}
+    for i, key in zip(indices, keys):
+        first.setdefault(key, i)
+    unique = [i for i, key in zip(indices, keys) if first[key] == i]
+
+    if ffmpeg is not None:
+        job.encode = encode_rgb
+        cmd = [ffmpeg, "-y", "-loglevel", "error",
+               "-f", "rawvideo", "-pix_fmt", "rgb24",
+               "-s", "%dx%d" % (job.width, job.height),
+               "-r", str(fps),
+               "-i", "-",
+               "-c:v", "mpeg4", "-q:v", "3",
+               filename]
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        write, out = proc.stdin.write, None
+    else:
+        logger.info('ffmpeg not found, writing Motion-JPEG AVI')
+        job.encode = encode_jpeg
+        proc = None
+        out = open(filename, 'wb')
+        writer = AviWriter(out, job.width, job.height, fps, 'MJPG')
+        write = writer.write_frame
+
+    rendered = len(unique)
+    cache = FrameCache(budget=VIDEO_CACHE_BUDGET)
+    encoded = process_frames(job, unique, jobs)
+    try:
+        for i, key in zip(indices, keys):
+            if first[key] == i:
+                data = encoded.next()
+                cache.put(key, None, data, len(data))
+            else:
+                data = cache.get(key, None)
+                if data is None:
+                    data = job.process(i)
+                    cache.put(key, None, data, len(data))
+                    rendered += 1
+            write(data)
+            progress()
+        if out is not None:
+            writer.close()
+    finally:
+        encoded.close()
+        if out is not None:
+            out.close()
+        if proc is not None:
+            proc.stdin.close()
+            status = proc.wait()
+    if proc is not None and status != 0:
+        raise IOError(errno.EIO, 'ffmpeg failed with exit status %d' % status)
+    return rendered
+
+
+def encode_rgb(pixbuf):
+    arr = helpers.gdkpixbuf2numpy(pixbuf)
+    return arr[:,:,:3].tostring()
+
+
+def encode_jpeg(pixbuf):
+    ok, data = pixbuf.save_to_bufferv('jpeg', ['quality'], ['90'])
+    return data
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] FILE.ora OUTPUT",
+                          description="Render the X-Sheet of FILE.ora to "
+                          "a numbered PNG sequence (OUTPUT.png) or a video "
+                          "(OUTPUT.avi, .mp4, ...) without the GUI.")
+    parser.add_option("-s", "--start", type="int", default=1,
+                      help="first frame to render, counting from 1")
+    parser.add_option("-e", "--end", type="int", default=None,
+                      help="last frame to render [default: last frame]")
+    parser.add_option("--scale", type="float", default=1.0,
+                      help="size of the output relative to the drawing "
+                      "[default: %default]")
+    parser.add_option("-r", "--fps", type="float", default=None,
+                      help="video frame rate [default: the document's]")
+    parser.add_option("-j", "--jobs", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="number of worker processes [default: %default]")
+    parser.add_option("-q", "--quiet", action="store_true", default=False,
+                      help="only print errors")
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error("expected an input and an output file")
+    in_filename, out_filename = args
+    if os.path.splitext(in_filename)[1].lower() != '.ora':
+        parser.error("the input must be an OpenRaster (.ora) file")
+    if not 0 < options.scale <= 1:
+        parser.error("the scale must be greater than 0 and at most 1")
+    if options.jobs < 1:
+        parser.error("at least one job is needed")
+    ext = os.path.splitext(out_filename)[1].lower()
+    if ext != '.png' and ext not in VIDEO_EXTENSIONS:
+        parser.error("unknown output format %r" % ext)
+
+    logging.basicConfig(format="%(levelname)s: %(name)s: %(message)s",
+                        level=logging.ERROR if options.quiet
+                        else logging.WARNING)
+
+    def report(msg, *args):
+        if not options.quiet:
+            print msg % args
+
+    t0 = time.time()
+    doc = document.Document()
+    # no threads in the background when forking the workers
+    doc.ani.prefetch_enabled = False
+    try:
+        # only the layers of the frames in the range get decoded
+        doc.load(in_filename, lazy=True)
+    except document.SaveLoadError, e:
+        logger.error('%s', e)
+        return 1
+
+    n_frames = len(doc.ani.frames)
+    start = options.start
+    end = options.end if options.end is not None else n_frames
+    if not 1 <= start <= end <= n_frames:
+        parser.error("frame range %d-%d outside of 1-%d"
+                     % (start, end, n_frames))
+    indices = range(start-1, end)
+
+    # Decoded here rather than by each worker, so that a layer failing
+    # to load stops the render instead of leaving frames empty.
+    layers = set()
+    for i in indices:
+        key, token, frame_layers = doc.ani.get_frame_key(i)
+        layers.update(l for l, opacity in frame_layers)
+    try:
+        doc.check_failed_layers([l for l in doc.layers if l in layers])
+    except document.SaveLoadError, e:
+        logger.error('%s', e)
+        return 1
+    t_load = time.time() - t0
+    fps = options.fps or doc.ani.framerate
+
+    report("Loaded %s in %.2f s: %d frames, %d layers",
+           in_filename, t_load, n_frames, len(doc.layers))
+
+    done = [0]
+    def progress():
+        done[0] += 1
+        if not options.quiet and sys.stdout.isatty():
+            sys.stdout.write("\rframe %d/%d" % (done[0], len(indices)))
+            sys.stdout.flush()
+
+    t0 = time.time()
+    try:
+        job = RenderJob(doc, options.scale)
+        if ext == '.png':
+            rendered = render_png(job, indices, out_filename, options.jobs,
+                                  progress)
+        else:
+            rendered = render_video(job, indices, out_filename, fps,
+                                    options.jobs, progress)
+    except (IOError, OSError), e:
+        logger.error('Rendering failed: %s', e.strerror or e)
+        return 1
+    t_render = time.time() - t0
+    if not options.quiet and sys.stdout.isatty():
+        print
+
+    report("Rendered frames %d-%d at %dx%d (mipmap level %d) "
+           "with %d jobs", start, end, job.width, job.height,
+           job.mipmap_level, options.jobs)
+    report("%d frames, %d rendered, in %.2f s: %.1f frames/s, "
+           "%.1f ms per rendered frame", len(indices), rendered, t_render,
+           len(indices) / max(t_render, 1e-6),
+           1000.0 * t_render / max(rendered, 1))
+    report("Total %.2f s", t_load + t_render)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
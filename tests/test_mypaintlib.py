@@ -7,7 +7,7 @@ import sys, os, gc
 os.chdir(os.path.dirname(sys.argv[0]))
 sys.path.insert(0, '..')
 
-from lib import mypaintlib, tiledsurface, brush, document, command, helpers
+from lib import mypaintlib, tiledsurface, pixbufsurface, brush, document, command, helpers
 
 def tileConversions():
     # fully transparent tile stays fully transparent (without noise)
@@ -120,6 +120,162 @@ def brushPaint():
 
     s.save_as_png('test_brushPaint.png')
 
+def tileCompression():
+    s = tiledsurface.Surface()
+    events = loadtxt('painting30sec.dat')
+    s.begin_atomic()
+    for t, x, y, pressure in events:
+        s.draw_dab(x, y, 12, 0.3, 0.5, 0.9, pressure, 0.6)
+    s.end_atomic()
+    s.save_as_png('test_tileCompression_before.png')
+    n = s.get_tile_memory()
+    assert n > 0
+    assert s.compress_tiles() > 0
+    assert s.get_tile_memory() == 0
+    s.save_as_png('test_tileCompression_after.png')
+    assert s.get_tile_memory() > 0
+    assert files_equal('test_tileCompression_before.png',
+                       'test_tileCompression_after.png')
+
+def tilePool():
+    pool = tiledsurface.tile_pool
+    events = loadtxt('painting30sec.dat')
+    s = tiledsurface.Surface()
+    for i in range(2):
+        s.begin_atomic()
+        for t, x, y, pressure in events:
+            s.draw_dab(x, y, 12, 0.3, 0.5, 0.9, pressure, 0.6)
+        s.end_atomic()
+        s.save_as_png('test_tilePool_%d.png' % i)
+        if i == 0:
+            n = len(s.tiledict)
+            s.clear()
+            assert pool.free >= n
+            reused = pool.reused
+    # the second time, the buffers of the first painting get reused,
+    # and cleared before that
+    assert pool.reused - reused >= n
+    assert files_equal('test_tilePool_0.png', 'test_tilePool_1.png')
+    # tiles shared with a snapshot keep their pixels
+    sshot = s.save_snapshot()
+    free = pool.free
+    s.clear()
+    assert pool.free == free
+    assert sshot.tiledict.values()[0].rgba.any()
+
+def uniformTiles():
+    N = tiledsurface.N
+    surfaces = []
+    for unpack in False, True:
+        s = tiledsurface.Surface()
+        s.flood_fill(0, 0, (0.2, 0.5, 0.9), (0, 0, 4*N, 4*N), 0.0, s)
+        assert s.get_tile_stats()['uniform'] == 16
+        if unpack:
+            # fill in the pixels again
+            for t in s.tiledict.values():
+                t.rgba
+            assert s.get_tile_stats()['unpacked'] == 16
+        s.save_as_png('test_uniformTiles_%d.png' % unpack)
+        surfaces.append(s)
+    assert files_equal('test_uniformTiles_0.png', 'test_uniformTiles_1.png')
+    # compositing and mipmaps give the same results
+    dsts = []
+    for s in surfaces:
+        dst = zeros((N, N, 4), 'uint16')
+        s.composite_tile(dst, False, 0, 0, mipmap_level=1, opacity=0.5)
+        dsts.append(dst)
+    assert (dsts[0] == dsts[1]).all()
+    # also opaque over a partly transparent backdrop, with and without alpha
+    for dst_has_alpha in False, True:
+        dsts = []
+        for s in surfaces:
+            dst = zeros((N, N, 4), 'uint16')
+            dst[...] = (3000, 7000, 11000, 1<<14)
+            s.composite_tile(dst, dst_has_alpha, 1, 1)
+            dsts.append(dst)
+        assert (dsts[0] == dsts[1]).all()
+    # the tile store keeps just the colours
+    s = surfaces[1]
+    assert s.compress_tiles() > 0
+    stats = s.get_tile_stats()
+    assert stats['unpacked'] == stats['packed'] == 0
+    assert stats['nbytes'] == 0 and stats['full_nbytes'] > 0
+
+def emptyTiles():
+    s = tiledsurface.Surface()
+    s.begin_atomic()
+    s.draw_dab(100, 100, 20, 0.3, 0.5, 0.9, 1.0, 1.0)
+    s.end_atomic()
+    assert s.tiledict
+    # a larger eraser dab leaves nothing behind, neither the tiles painted
+    # before nor the ones it created around them
+    s.begin_atomic()
+    s.draw_dab(100, 100, 80, 0.0, 0.0, 0.0, 1.0, 1.0, 0.0)
+    s.end_atomic()
+    assert not s.tiledict
+    assert s.get_bbox().empty()
+
+def mipmaps():
+    N = tiledsurface.N
+    events = loadtxt('painting30sec.dat')
+    surfaces = []
+    for batch in False, True:
+        s = tiledsurface.Surface()
+        s.begin_atomic()
+        for t, x, y, pressure in events:
+            s.draw_dab(x, y, 12, 0.3, 0.5, 0.9, pressure, 0.6)
+        s.end_atomic()
+        if batch:
+            assert s.regenerate_mipmaps(limit=1) == 1
+            assert s.regenerate_mipmaps() > 0
+            assert s.regenerate_mipmaps() == 0
+        surfaces.append(s)
+    # regenerated all at once or tile by tile as rendered, the same
+    for level in 1, 3:
+        tiles = set((tx >> level, ty >> level)
+                    for tx, ty in surfaces[0].tiledict)
+        for tx, ty in tiles:
+            dsts = []
+            for s in surfaces:
+                dst = zeros((N, N, 4), 'uint16')
+                s.composite_tile(dst, True, tx, ty, mipmap_level=level)
+                dsts.append(dst)
+            assert dsts[0].any()
+            assert (dsts[0] == dsts[1]).all()
+
+def pngEncoding():
+    s = tiledsurface.Surface()
+    events = loadtxt('painting30sec.dat')
+    s.begin_atomic()
+    for t, x, y, pressure in events:
+        s.draw_dab(x, y, 12, 0.9, 0.5, 0.3, pressure, 0.6)
+    s.end_atomic()
+    s.save_as_png('test_pngEncoding.png')
+    data = open('test_pngEncoding.png', 'rb').read()
+    assert s.encode_as_png() == data
+    sshot = s.save_snapshot()
+    bbox = s.get_bbox()
+    s.clear()
+    # the snapshot keeps the tiles, whatever happens to the surface
+    assert sshot.encode_as_png(*bbox) == data
+    # decoding from memory gives back the same tiles
+    x, y, w, h = bbox
+    sshot, frame_size = tiledsurface.decode_png(data, x, y)
+    assert frame_size == (x, y, w, h)
+    s.load_snapshot(sshot)
+    assert s.encode_as_png(*bbox) == data
+    # slower profiles make smaller files of the same pixels
+    sizes = []
+    for profile in pixbufsurface.SAVE_PROFILES_BY_SIZE:
+        profile_data = s.encode_as_png(*bbox, save_profile=profile)
+        sizes.append(len(profile_data))
+        sshot, frame_size = tiledsurface.decode_png(profile_data, x, y)
+        s2 = tiledsurface.Surface()
+        s2.load_snapshot(sshot)
+        assert s2.encode_as_png(*bbox) == data
+    print 'PNG sizes by save profile:', zip(pixbufsurface.SAVE_PROFILES_BY_SIZE, sizes)
+    assert sizes == sorted(sizes, reverse=True)
+
 def files_equal(a, b):
     return open(a, 'rb').read() == open(b, 'rb').read()
 
@@ -271,6 +427,238 @@ def docPaint():
     assert pngs_equal('test_docPaint_flat.png', 'correct_docPaint_flat.png')
     assert pngs_equal('test_docPaint_alpha.png', 'correct_docPaint_alpha.png')
 
+def incrementalSave():
+    doc = document.Document()
+    doc.load('bigimage.ora')
+    doc.save('test_incrementalSave_a.png', alpha=True)
+    # nothing changed, all layers are copied from bigimage.ora
+    doc.save('test_incrementalSave_1.ora')
+    doc2 = document.Document()
+    doc2.load('test_incrementalSave_1.ora')
+    doc2.save('test_incrementalSave_b.png', alpha=True)
+    assert pngs_equal('test_incrementalSave_a.png', 'test_incrementalSave_b.png')
+
+    # change a layer, only that one gets encoded
+    doc.layers[0].translate(mypaintlib.TILE_SIZE, 0)
+    doc.save('test_incrementalSave_a.png', alpha=True)
+    doc.save('test_incrementalSave_2.ora')
+    doc2 = document.Document()
+    doc2.load('test_incrementalSave_2.ora')
+    doc2.save('test_incrementalSave_b.png', alpha=True)
+    assert pngs_equal('test_incrementalSave_a.png', 'test_incrementalSave_b.png')
+
+def backgroundSave():
+    doc = document.Document()
+    doc.load('bigimage.ora')
+    doc.layers[0].translate(mypaintlib.TILE_SIZE, 0)
+    doc.save('test_backgroundSave_a.png', alpha=True)
+    job = doc.save_in_background('test_backgroundSave.ora')
+    # edits after the save started don't make it into the file
+    doc.layers[0].translate(mypaintlib.TILE_SIZE, 0)
+    job.finish()
+    doc2 = document.Document()
+    doc2.load('test_backgroundSave.ora')
+    doc2.save('test_backgroundSave_b.png', alpha=True)
+    assert pngs_equal('test_backgroundSave_a.png', 'test_backgroundSave_b.png')
+
+def lazyLoading():
+    N = tiledsurface.N
+    docs = []
+    for lazy in False, True:
+        doc = document.Document()
+        # the prefetcher would load the layers behind our back
+        doc.ani.prefetch_enabled = False
+        doc.load('bigimage.ora', lazy=lazy)
+        docs.append(doc)
+    doc = docs[1]
+    assert doc.lazy_layers.pending > 0
+    # loaded on demand, the layers render the same as loaded right away
+    x, y, w, h = docs[0].get_bbox()
+    for level in 0, 1:
+        for ty in range(y/N >> level, ((y+h-1)/N >> level) + 1):
+            for tx in range(x/N >> level, ((x+w-1)/N >> level) + 1):
+                dsts = []
+                for d in docs:
+                    dst = zeros((N, N, 4), 'uint16')
+                    d.blit_tile_into(dst, False, tx, ty, mipmap_level=level)
+                    dsts.append(dst)
+                assert (dsts[0] == dsts[1]).all()
+    assert doc.lazy_layers.pending == 0
+
+    # layers cleared before they were loaded are forgotten
+    doc = document.Document()
+    doc.ani.prefetch_enabled = False
+    doc.load('bigimage.ora', lazy=True)
+    pending = doc.lazy_layers.pending
+    doc.layers[0]._surface.clear()
+    assert doc.lazy_layers.pending == pending - 1
+    assert doc.layers[0].is_empty()
+
+def lazyLoadFailure():
+    import zipfile
+    doc = document.Document()
+    doc.ani.prefetch_enabled = False
+    doc.load('bigimage.ora', lazy=True)
+    bad_src = doc._ora_layers[doc.layers[0]][1]
+    # keep the PNG header, so that the layer still gets its bbox
+    z = zipfile.ZipFile('bigimage.ora')
+    bad_data = z.read(bad_src)[:33] + 'garbage'
+    out = zipfile.ZipFile('test_lazyLoadFailure.ora', 'w')
+    for info in z.infolist():
+        data = z.read(info.filename)
+        if info.filename == bad_src:
+            data = bad_data
+        out.writestr(info, data)
+    out.close()
+    z.close()
+
+    doc = document.Document()
+    doc.ani.prefetch_enabled = False
+    doc.load('test_lazyLoadFailure.ora', lazy=True)
+    bad = doc.layers[0]
+    bad._surface.load_lazy()
+    # the layer is kept, empty, and listed as failed
+    assert bad in doc.layers
+    assert bad.is_empty()
+    assert doc.lazy_layers.failed.get(bad._surface) == bad_src
+    try:
+        doc.check_failed_layers()
+    except document.SaveLoadError:
+        pass
+    else:
+        assert False, 'check_failed_layers() did not report the layer'
+    # exporting would lose it...
+    try:
+        doc.save('test_lazyLoadFailure.png')
+    except document.SaveLoadError:
+        pass
+    else:
+        assert False, 'exported a layer that failed to load'
+    # ...saving copies its PNG over, as it was
+    doc.save('test_lazyLoadFailure_2.ora')
+    z = zipfile.ZipFile('test_lazyLoadFailure_2.ora')
+    assert z.read(doc._ora_layers[bad][1]) == bad_data
+    z.close()
+
+def aniExportPng():
+    N = tiledsurface.N
+    doc = document.Document()
+    doc.ani.prefetch_enabled = False
+    # two opaque cels over the same area, in frames 1 and 3; the others
+    # hold the cel before them. Pure colours come out of the dithering
+    # unchanged, whichever way they are converted to 8 bit.
+    for idx, color in (0, (1.0, 0.0, 0.0)), (2, (0.0, 1.0, 0.0)):
+        doc.ani.select_frame(idx)
+        doc.ani.add_cel()
+        s = doc.layers[doc.layer_idx]._surface
+        s.flood_fill(0, 0, color, (0, 0, 2*N, 2*N), 0.0, s)
+    frames = doc.ani.frames
+    assert frames.cel_at(1) is frames.cel_at(0)
+    assert frames.cel_at(3) is frames.cel_at(2)
+
+    prefix = 'test_aniExportPng-'
+    for fn in os.listdir('.'):
+        if fn.startswith(prefix):
+            os.remove(fn)
+    doc.ani.save_png(prefix + '001.png')
+    filenames = sorted(fn for fn in os.listdir('.') if fn.startswith(prefix))
+    assert len(filenames) == len(frames)
+    assert filenames[0] == prefix + '001.png'
+    assert not files_equal(filenames[0], filenames[2])
+    for i, fn in enumerate(filenames):
+        # frames holding a cel get its file again, linked or copied
+        first = filenames[0 if i < 2 else 2]
+        if fn != first:
+            assert files_equal(first, fn)
+        # the pixels of the frame as played
+        arr = helpers.gdkpixbuf2numpy(helpers.get_pixbuf(fn))
+        expected = helpers.gdkpixbuf2numpy(doc.ani.render_frame(i).pixbuf)
+        assert arr.shape[:2] == expected.shape[:2] == (2*N, 2*N)
+        assert (arr[:,:,3] == 255).all()
+        assert (arr[:,:,:3] == expected[:,:,:3]).all()
+
+def riff_chunks(data, start, end):
+    """Yields (fourcc, offset of the data, size) of the chunks in a range"""
+    import struct
+    pos = start
+    while pos < end:
+        fourcc, size = data[pos:pos+4], struct.unpack('<I', data[pos+4:pos+8])[0]
+        yield fourcc, pos+8, size
+        pos += 8 + size + size % 2
+    assert pos == end
+
+def aniExportAvi():
+    import struct
+    N = tiledsurface.N
+    doc = document.Document()
+    doc.ani.prefetch_enabled = False
+    frames = doc.ani.frames
+    frames.select(3)
+    frames.remove_frames(len(frames) - 3)
+    for idx, color in (0, (1.0, 0.0, 0.0)), (2, (0.0, 1.0, 0.0)):
+        doc.ani.select_frame(idx)
+        doc.ani.add_cel()
+        s = doc.layers[doc.layer_idx]._surface
+        s.flood_fill(0, 0, color, (0, 0, 2*N, 2*N), 0.0, s)
+    assert len(frames) == 3
+
+    # without ffmpeg, the AVI is written by lib/avi.py
+    path = os.environ.get('PATH')
+    os.environ['PATH'] = ''
+    try:
+        doc.ani.save_avi('test_aniExport.avi', vid_width=N)
+    finally:
+        if path is None:
+            del os.environ['PATH']
+        else:
+            os.environ['PATH'] = path
+
+    data = open('test_aniExport.avi', 'rb').read()
+    assert data[:4] == 'RIFF' and data[8:12] == 'AVI '
+    assert struct.unpack('<I', data[4:8])[0] == len(data) - 8
+    chunks = list(riff_chunks(data, 12, len(data)))
+    assert [(c[0], data[c[1]:c[1]+4]) for c in chunks[:2]] == \
+        [('LIST', 'hdrl'), ('LIST', 'movi')]
+    assert chunks[2][0] == 'idx1'
+
+    fourcc, pos, size = chunks[0]
+    hdrl = list(riff_chunks(data, pos+4, pos+size))
+    assert [c[0] for c in hdrl] == ['avih', 'LIST']
+    fourcc, pos, size = hdrl[0]
+    avih = struct.unpack('<IIIIIIIIII', data[pos:pos+40])
+    assert avih[4] == len(frames)
+    assert avih[8:10] == (N, N)
+    fourcc, pos, size = hdrl[1]
+    strl = list(riff_chunks(data, pos+4, pos+size))
+    assert [c[0] for c in strl] == ['strh', 'strf']
+    codec = data[strl[0][1]+4:strl[0][1]+8]
+    assert codec in ('MJPG', 'DIB ')
+
+    fourcc, movi_pos, size = chunks[1]
+    movi = list(riff_chunks(data, movi_pos+4, movi_pos+size))
+    assert len(movi) == len(frames)
+    payloads = []
+    for fourcc, pos, size in movi:
+        assert fourcc == '00dc'
+        payload = data[pos:pos+size]
+        if codec == 'MJPG':
+            assert payload[:2] == '\xff\xd8'
+        else:
+            assert size == N*N*3
+        payloads.append(payload)
+    # the first two frames hold the same cel
+    assert payloads[0] == payloads[1] != payloads[2]
+
+    fourcc, pos, size = chunks[2]
+    assert size == 16 * len(frames)
+    for i in range(len(frames)):
+        entry = data[pos+16*i:pos+16*(i+1)]
+        fourcc, flags, offset, length = struct.unpack('<4sIII', entry)
+        assert fourcc == '00dc'
+        # offsets are from the 'movi' fourcc, to the chunk header
+        assert movi_pos + offset == movi[i][1] - 8
+        assert length == movi[i][2]
+
 def saveFrame():
     print 'test-saving various frame sizes...'
     cnt=0
@@ -305,6 +693,18 @@ options, tests = parser.parse_args()
 #layerModes()
 directPaint()
 brushPaint()
+tileCompression()
+tilePool()
+uniformTiles()
+emptyTiles()
+mipmaps()
+pngEncoding()
+incrementalSave()
+backgroundSave()
+lazyLoading()
+lazyLoadFailure()
+aniExportPng()
+aniExportAvi()
 
 # FIXME: make these tests pass with MyPaint+GEGL
 #if not os.environ.get('MYPAINT_ENABLE_GEGL', 0):
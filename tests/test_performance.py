@@ -158,6 +158,34 @@ def save_ora_again():
     d.save('test_save.ora')
     yield stop_measurement
 
+def _bytes_written():
+    """Bytes this process passed to write() calls so far (Linux only)"""
+    for line in open('/proc/self/io'):
+        key, value = line.split(':')
+        if key == 'wchar':
+            return int(value)
+
+@nogui_test
+def load_ora_bytes_written():
+    from lib import document
+    d = document.Document()
+    before = _bytes_written()
+    d.load('bigimage.ora')
+    print 'result =', _bytes_written() - before
+    if False:
+        yield None # just to make this function iterator
+
+@nogui_test
+def save_ora_bytes_written():
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    before = _bytes_written()
+    d.save('test_save.ora')
+    print 'result =', _bytes_written() - before
+    if False:
+        yield None # just to make this function iterator
+
 @nogui_test
 def save_png():
     from lib import document
@@ -176,6 +204,31 @@ def save_png_layer():
     d.layer.save_as_png('test_save.png')
     yield stop_measurement
 
+def _onionskin_steps(length):
+    """Step through a sheet, computing the onion skin at each frame"""
+    from lib.framelist import FrameList
+    frames = FrameList(length)
+    for i, f in enumerate(frames):
+        if i % 2 == 0:
+            f.add_cel('cel%d' % (i % 200))
+        if i % 12 == 0:
+            f.set_key()
+    yield start_measurement
+    for i in xrange(0, length, max(1, length // 500)):
+        frames.select(i)
+        frames.get_opacities()
+    yield stop_measurement
+
+@nogui_test
+def onionskin_steps_1k():
+    for res in _onionskin_steps(1000):
+        yield res
+
+@nogui_test
+def onionskin_steps_10k():
+    for res in _onionskin_steps(10000):
+        yield res
+
 
 @nogui_test
 def brushengine_paint_hires():